@@ -0,0 +1,7 @@
+#!/usr/bin/env bash
+
+source ./pre_run.sh
+
+printf "\nStarting async app\n\n"
+
+hypercorn --bind "0.0.0.0:${APP_PORT:-8888}" docchatai.main_asgi:asgi_app
@@ -0,0 +1,107 @@
+import argparse
+import time
+
+import faiss
+import numpy as np
+
+from docchatai.app.ann_indexes import AnnIndexes
+from docchatai.app.config import AppConfig
+
+# Compares the recall and latency of each ANN index type, against a flat index of the same vectors.
+#
+# Usage, from the src dir:
+#   python -m benchmark.ann_index_benchmark --vectors 200000 --dimension 768
+#   python -m benchmark.ann_index_benchmark --index-types flat hnsw --vector-encoding int8
+#
+# Random vectors are clustered, as embeddings are, so that the results are not overly pessimistic.
+
+
+class BenchmarkAppConfig(AppConfig):
+    def __init__(self, vector_index_type: str, args):
+        super().__init__()
+        self.__vector_index_type = vector_index_type
+        self.__args = args
+
+    @property
+    def vector_index_type(self) -> str:
+        return self.__vector_index_type
+
+    @property
+    def vector_encoding(self) -> str:
+        return self.__args.vector_encoding
+
+    @property
+    def ivf_nprobe(self) -> int:
+        return self.__args.nprobe
+
+    @property
+    def hnsw_ef_search(self) -> int:
+        return self.__args.ef_search
+
+
+def clustered_vectors(count: int, dimension: int, clusters: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = rng.standard_normal((clusters, dimension), dtype=np.float32)
+    vectors = centroids[rng.integers(0, clusters, count)]
+    vectors += 0.3 * rng.standard_normal((count, dimension), dtype=np.float32)
+    return vectors
+
+
+def search(index: faiss.Index, queries: np.ndarray, k: int) -> tuple[np.ndarray, float]:
+    # Queries are searched one at a time, as they are when chatting.
+    ids = np.empty((len(queries), k), dtype=np.int64)
+    started = time.perf_counter()
+    for i, query in enumerate(queries):
+        _, ids[i] = index.search(query.reshape(1, -1), k)
+    return ids, (time.perf_counter() - started) / len(queries)
+
+
+def size_in_mb(index: faiss.Index) -> float:
+    return len(faiss.serialize_index(index)) / (1024 * 1024)
+
+
+def recall(expected_ids: np.ndarray, ids: np.ndarray) -> float:
+    k = expected_ids.shape[1]
+    return float(np.mean([len(set(e) & set(i)) / k for e, i in zip(expected_ids, ids)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ANN index recall vs latency benchmark')
+    parser.add_argument('--vectors', type=int, default=100000)
+    parser.add_argument('--dimension', type=int, default=384)
+    parser.add_argument('--clusters', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--nprobe', type=int, default=AppConfig().ivf_nprobe)
+    parser.add_argument('--ef-search', type=int, default=AppConfig().hnsw_ef_search)
+    parser.add_argument('--index-types', nargs='+', default=['ivf', 'hnsw', 'ivfpq'])
+    parser.add_argument('--vector-encoding', default='float32', choices=AnnIndexes.get_supported_vector_encodings())
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = clustered_vectors(args.vectors, args.dimension, args.clusters, rng)
+    queries = clustered_vectors(args.queries, args.dimension, args.clusters, rng)
+
+    flat_index = faiss.IndexFlatL2(args.dimension)
+    flat_index.add(vectors)
+    expected_ids, flat_latency = search(flat_index, queries, args.k)
+
+    print(f'vectors: {args.vectors}, dimension: {args.dimension}, queries: {args.queries}, k: {args.k}, '
+          f'nprobe: {args.nprobe}, efSearch: {args.ef_search}, encoding: {args.vector_encoding}')
+    print(f'{"index":<24}{"build s":>10}{"recall@k":>10}{"query ms":>10}{"speedup":>10}{"MB":>10}')
+    print(f'{"Flat":<24}{0:>10.2f}{1:>10.3f}{flat_latency * 1000:>10.3f}{1:>10.1f}{size_in_mb(flat_index):>10.1f}')
+
+    for index_type in args.index_types:
+        app_config = BenchmarkAppConfig(index_type, args)
+        factory_string = AnnIndexes.factory_string(app_config, flat_index.ntotal, flat_index.d)
+        if factory_string is None:
+            continue
+        started = time.perf_counter()
+        index = AnnIndexes.build(flat_index, app_config)
+        build_seconds = time.perf_counter() - started
+        ids, latency = search(index, queries, args.k)
+        print(f'{factory_string:<24}{build_seconds:>10.2f}{recall(expected_ids, ids):>10.3f}'
+              f'{latency * 1000:>10.3f}{flat_latency / latency:>10.1f}{size_in_mb(index):>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import argparse
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+# A stand in for an Ollama server, which answers chat and embed requests after a set latency.
+# Vectors are deterministic, so that the same text always has the same vector.
+#
+# Usage, from the src dir:
+#   python -m benchmark.fake_ollama --port 11434 --latency-ms 200 --token-latency-ms 20
+#
+# Then point the app at it with OLLAMA_HOST=http://127.0.0.1:11434
+
+
+class FakeOllamaServer:
+    def __init__(self,
+                 port: int = 0,
+                 latency_seconds: float = 0.0,
+                 token_latency_seconds: float = 0.0,
+                 embed_latency_seconds: float = 0.0,
+                 response_tokens: int = 30,
+                 dimension: int = 384):
+        self.latency_seconds = latency_seconds
+        self.token_latency_seconds = token_latency_seconds
+        self.embed_latency_seconds = embed_latency_seconds
+        self.response_tokens = response_tokens
+        self.dimension = dimension
+        self.__server = ThreadingHTTPServer(('127.0.0.1', port), _handler(self))
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.__server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'FakeOllamaServer':
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def vector(self, text: str) -> [float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+        vector = np.random.default_rng(seed).standard_normal(self.dimension)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def tokens(self, prompt: str) -> [str]:
+        words = (prompt.split() or ['ok'])[-self.response_tokens:]
+        return [word if i == 0 else f' {word}' for i, word in enumerate(words)]
+
+
+def _handler(server: FakeOllamaServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == '/api/tags':
+                self.__send_json({'models': []})
+            else:
+                self.__send_json({'error': f'Not found: {self.path}'}, 404)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if self.path == '/api/embed':
+                time.sleep(server.embed_latency_seconds)
+                texts = body.get('input', '')
+                texts = [texts] if isinstance(texts, str) else texts
+                self.__send_json({'model': body.get('model'), 'embeddings': [server.vector(t) for t in texts]})
+            elif self.path == '/api/chat':
+                self.__chat(body)
+            else:
+                self.__send_json({'error': f'Not found: {self.path}'}, 404)
+
+        def __chat(self, body: dict):
+            time.sleep(server.latency_seconds)
+            messages = body.get('messages', [])
+            tokens = server.tokens(messages[-1].get('content', '') if messages else '')
+            if body.get('stream', True) is False:
+                time.sleep(server.token_latency_seconds * len(tokens))
+                self.__send_json(self.__chat_response(body, ''.join(tokens), True))
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for token in tokens:
+                time.sleep(server.token_latency_seconds)
+                self.__send_chunk(self.__chat_response(body, token, False))
+            self.__send_chunk(self.__chat_response(body, '', True))
+            self.wfile.write(b'0\r\n\r\n')
+
+        @staticmethod
+        def __chat_response(body: dict, content: str, done: bool) -> dict:
+            response = {
+                'model': body.get('model'),
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'message': {'role': 'assistant', 'content': content},
+                'done': done,
+            }
+            if done:
+                response.update({'done_reason': 'stop', 'eval_count': 0, 'prompt_eval_count': 0})
+            return response
+
+        def __send_chunk(self, data: dict):
+            line = json.dumps(data).encode('utf-8') + b'\n'
+            self.wfile.write(f'{len(line):x}\r\n'.encode('ascii') + line + b'\r\n')
+            self.wfile.flush()
+
+        def __send_json(self, data: dict, status: int = 200):
+            content = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Ollama server')
+    parser.add_argument('--port', type=int, default=11434)
+    parser.add_argument('--latency-ms', type=float, default=200, help='Before the first token of each chat')
+    parser.add_argument('--token-latency-ms', type=float, default=20)
+    parser.add_argument('--embed-latency-ms', type=float, default=20, help='Of each embed call')
+    parser.add_argument('--response-tokens', type=int, default=30)
+    parser.add_argument('--dimension', type=int, default=384)
+    args = parser.parse_args()
+    server = FakeOllamaServer(args.port, args.latency_ms / 1000, args.token_latency_ms / 1000,
+                              args.embed_latency_ms / 1000, args.response_tokens, args.dimension).start()
+    print(f'Fake Ollama server running at: {server.url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
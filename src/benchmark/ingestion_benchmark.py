@@ -0,0 +1,253 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+# Measures how fast documents are parsed, and loaded into vectorstores, by each loader.
+#
+# Usage, from the src dir:
+#   python -m benchmark.ingestion_benchmark --pages 200 --latency-ms 20 --output results.json
+#   python -m benchmark.ingestion_benchmark --formats pdf --max-worker-threads 8 --embed-worker-threads 4
+#
+# Each case runs in a fresh process, with an empty app dir, so that peak RSS is per case
+# and nothing is served from the embeddings or index caches. Embeddings are fake, and
+# deterministic, with a fixed latency per call, so that results are reproducible.
+
+_vocabulary = ['grandmother', 'wolf', 'forest', 'basket', 'cake', 'butter', 'door', 'path', 'flowers',
+               'hunter', 'cottage', 'village', 'morning', 'little', 'red', 'hood', 'eyes', 'ears', 'teeth',
+               'the', 'a', 'and', 'to', 'of', 'in', 'she', 'he', 'was', 'went', 'said', 'with', 'her']
+
+
+class LatencyEmbeddings(DeterministicFakeEmbedding):
+    latency_seconds: float = 0.0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(self.latency_seconds)
+        return super().embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        time.sleep(self.latency_seconds)
+        return super().embed_query(text)
+
+
+def generate_pages(count: int, words_per_page: int, words_per_line: int = 12) -> [[str]]:
+    rng = np.random.default_rng(0)
+    pages = []
+    for _ in range(count):
+        words = rng.choice(_vocabulary, words_per_page)
+        pages.append([' '.join(words[i:i + words_per_line]) for i in range(0, words_per_page, words_per_line)])
+    return pages
+
+
+def write_txt(path: str, pages: [[str]]):
+    with open(path, 'w') as file:
+        file.write('\n\n'.join('\n'.join(lines) for lines in pages))
+
+
+def write_csv(path: str, pages: [[str]]):
+    # One row per page.
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['id', 'text'])
+        for i, lines in enumerate(pages):
+            writer.writerow([i, ' '.join(lines)])
+
+
+def write_docx(path: str, pages: [[str]]):
+    # The minimum a docx reader needs: the content types, the package relationships and the document.
+    paragraphs = ''.join(f'<w:p><w:r><w:t>{line}</w:t></w:r></w:p>' for lines in pages for line in lines)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as file:
+        file.writestr('[Content_Types].xml',
+                      '<?xml version="1.0" encoding="UTF-8"?>'
+                      '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                      '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                      '<Default Extension="xml" ContentType="application/xml"/>'
+                      '<Override PartName="/word/document.xml" ContentType="application/'
+                      'vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/></Types>')
+        file.writestr('_rels/.rels',
+                      '<?xml version="1.0" encoding="UTF-8"?>'
+                      '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                      '<Relationship Id="rId1" Target="word/document.xml" Type="http://schemas.openxmlformats.org/'
+                      'officeDocument/2006/relationships/officeDocument"/></Relationships>')
+        file.writestr('word/document.xml',
+                      '<?xml version="1.0" encoding="UTF-8"?>'
+                      '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                      f'<w:body>{paragraphs}</w:body></w:document>')
+
+
+def write_pdf(path: str, pages: [[str]]):
+    # One PDF page per page, each line of text drawn in Helvetica.
+    def escape(text: str) -> str:
+        return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', b'',
+               b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    page_ids = []
+    for lines in pages:
+        content = ('BT /F1 10 Tf 12 TL 50 780 Td ' + ' '.join(f'({escape(line)}) \'' for line in lines) + ' ET')
+        content = content.encode('latin-1')
+        page_ids.append(len(objects) + 1)
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> '
+                       f'/Contents {len(objects) + 2} 0 R >>'.encode('latin-1'))
+        objects.append(b'<< /Length ' + str(len(content)).encode('latin-1') + b' >>\nstream\n' + content + b'\nendstream')
+    kids = ' '.join(f'{page_id} 0 R' for page_id in page_ids)
+    objects[1] = f'<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>'.encode('latin-1')
+
+    data = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(len(data))
+        data += f'{i + 1} 0 obj\n'.encode('latin-1') + obj + b'\nendobj\n'
+    xref_offset = len(data)
+    data += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode('latin-1')
+    data += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode('latin-1')
+    data += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n'.encode('latin-1')
+    with open(path, 'wb') as file:
+        file.write(data)
+
+
+_writers = {'txt': write_txt, 'csv': write_csv, 'docx': write_docx, 'pdf': write_pdf}
+
+
+class Sampler:
+    # Samples the number of threads, and notes when the vectorstore first has a searchable chunk.
+    def __init__(self, get_chunk_count, interval_seconds: float = 0.005):
+        self.__get_chunk_count = get_chunk_count
+        self.__interval_seconds = interval_seconds
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.started = time.perf_counter()
+        self.first_chunk_seconds = None
+        self.peak_threads = threading.active_count()
+
+    def start(self) -> 'Sampler':
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__stopped.set()
+        self.__thread.join()
+        self.__sample()
+
+    def __run(self):
+        while not self.__stopped.wait(self.__interval_seconds):
+            self.__sample()
+
+    def __sample(self):
+        # Excludes this thread.
+        self.peak_threads = max(self.peak_threads, threading.active_count() - 1)
+        if self.first_chunk_seconds is None and self.__get_chunk_count() > 0:
+            self.first_chunk_seconds = time.perf_counter() - self.started
+
+
+def run_case(file_path: str, loader_name: str, env: dict[str, str], latency_seconds: float) -> dict[str, any]:
+    # Runs in a process of its own. The env is set before the app reads its config.
+    os.environ.update(env)
+    from docchatai.app.app import App
+    from docchatai.app.config import AppConfig, ChatConfig, ChatVar
+    from docchatai.app.doc_loader import DocLoader
+    from docchatai.app.vectorstores import VectorStores, VectorStoreLoaderMultiThreaded, VectorStoreLoaderSync
+
+    app_config = AppConfig()
+    App.init(app_config)
+    try:
+        if loader_name == 'parse':
+            parsed = []
+            sampler = Sampler(lambda: len(parsed)).start()
+            # Pages are split into chunks as they are parsed.
+            for chunk in DocLoader.yield_pages(file_path, DocLoader.new_text_splitter(app_config),
+                                               app_config.parse_pages_per_task):
+                parsed.append(chunk)
+            sampler.stop()
+            chunks = len(parsed)
+        else:
+            chat_config = ChatConfig.from_dict(app_config, {ChatVar.FILE.value: file_path})
+            loader = VectorStoreLoaderSync() if loader_name == 'sync' else VectorStoreLoaderMultiThreaded()
+            embeddings = LatencyEmbeddings(size=384, latency_seconds=latency_seconds)
+            sampler = Sampler(lambda: VectorStores.len(loader.get())).start()
+            chunks = VectorStores.len(loader.load(chat_config, embeddings).wait_till_completed())
+            sampler.stop()
+        seconds = time.perf_counter() - sampler.started
+        return {
+            'chunks': chunks,
+            'seconds': seconds,
+            'chunks_per_sec': chunks / seconds,
+            'first_chunk_seconds': sampler.first_chunk_seconds,
+            # Of this process only. Parse processes, if any, are not included.
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'peak_threads': sampler.peak_threads,
+        }
+    finally:
+        App.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Document ingestion benchmark')
+    parser.add_argument('--formats', nargs='+', default=list(_writers.keys()), choices=list(_writers.keys()))
+    parser.add_argument('--loaders', nargs='+', default=['parse', 'sync', 'multi_threaded'],
+                        choices=['parse', 'sync', 'multi_threaded'])
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--words-per-page', type=int, default=400)
+    parser.add_argument('--latency-ms', type=float, default=10, help='Of each fake embedding call')
+    parser.add_argument('--max-worker-threads', type=int, default=50)
+    parser.add_argument('--parse-worker-threads', type=int, default=8)
+    parser.add_argument('--embed-worker-threads', type=int, default=8)
+    parser.add_argument('--build-worker-threads', type=int, default=8)
+    parser.add_argument('--parse-processes', type=int, default=0)
+    parser.add_argument('--embedding-batch-size', type=int, default=16)
+    parser.add_argument('--output', help='A JSON file, to write the results to')
+    args = parser.parse_args()
+
+    pages = generate_pages(args.pages, args.words_per_page)
+    results = []
+    print(f'pages: {args.pages}, words per page: {args.words_per_page}, latency ms: {args.latency_ms}, '
+          f'max worker threads: {args.max_worker_threads}, embed worker threads: {args.embed_worker_threads}')
+    print(f'{"format":<8}{"loader":<16}{"chunks":>8}{"seconds":>10}{"chunks/s":>10}'
+          f'{"first s":>10}{"rss MB":>10}{"threads":>9}')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for file_format in args.formats:
+            file_path = os.path.join(temp_dir, f'corpus.{file_format}')
+            _writers[file_format](file_path, pages)
+            for loader_name in args.loaders:
+                env = {
+                    'APP_DIR': os.path.join(temp_dir, f'app-{file_format}-{loader_name}'),
+                    'MAX_WORKER_THREADS': str(args.max_worker_threads),
+                    'PARSE_WORKER_THREADS': str(args.parse_worker_threads),
+                    'EMBED_WORKER_THREADS': str(args.embed_worker_threads),
+                    'BUILD_WORKER_THREADS': str(args.build_worker_threads),
+                    'PARSE_PROCESSES': str(args.parse_processes),
+                    'EMBEDDING_BATCH_SIZE': str(args.embedding_batch_size),
+                }
+                result = {'format': file_format, 'loader': loader_name}
+                try:
+                    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                        result.update(executor.submit(
+                            run_case, file_path, loader_name, env, args.latency_ms / 1000).result())
+                except Exception as ex:
+                    result['error'] = str(ex)
+                    print(f'{file_format:<8}{loader_name:<16} failed: {ex}')
+                    results.append(result)
+                    continue
+                results.append(result)
+                first_chunk = result['first_chunk_seconds']
+                print(f'{file_format:<8}{loader_name:<16}{result["chunks"]:>8}{result["seconds"]:>10.2f}'
+                      f'{result["chunks_per_sec"]:>10.1f}{"-" if first_chunk is None else f"{first_chunk:.3f}":>10}'
+                      f'{result["peak_rss_mb"]:>10.1f}{result["peak_threads"]:>9}')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'config': vars(args), 'results': results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
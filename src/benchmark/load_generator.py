@@ -0,0 +1,197 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+from benchmark.fake_ollama import FakeOllamaServer
+
+# Simulates many concurrent users of the web app. Each session uploads a file, polls the upload
+# progress till the file is loaded, then sends chat requests, one after the other.
+#
+# Usage, from the src dir:
+#   python -m benchmark.load_generator --sessions 500 --chat-service echo --echo-seconds 1
+#   python -m benchmark.load_generator --sessions 50 --chat-service default --server asgi --llm-latency-ms 300
+#   python -m benchmark.load_generator --url http://127.0.0.1:8888 --sessions 20
+#
+# Unless --url is given, the app is started with an empty app dir. With the default chat service,
+# models and embeddings are served by a fake Ollama server, started here, with the given latencies.
+
+_src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_default_file = os.path.join(_src_dir, 'test', 'resources', 'LITTLE RED RIDING HOOD.pdf')
+_requests = ['Who is the main character?', 'What did she carry in her basket?',
+             'Where did her grandmother live?', 'What did the wolf say?', 'How does the story end?']
+
+
+class Stats:
+    # Latencies and errors, by endpoint.
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__latencies: dict[str, list[float]] = {}
+        self.__errors: dict[str, int] = {}
+
+    def record(self, endpoint: str, seconds: float, error: bool):
+        with self.__lock:
+            self.__latencies.setdefault(endpoint, []).append(seconds)
+            self.__errors[endpoint] = self.__errors.get(endpoint, 0) + (1 if error else 0)
+
+    def summary(self, elapsed_seconds: float) -> dict[str, dict[str, float]]:
+        with self.__lock:
+            result = {}
+            for endpoint, latencies in self.__latencies.items():
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+                result[endpoint] = {
+                    'requests': len(latencies),
+                    'errors': self.__errors[endpoint],
+                    'error_rate': self.__errors[endpoint] / len(latencies),
+                    'throughput_per_sec': len(latencies) / elapsed_seconds,
+                    'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99,
+                    'max_ms': max(latencies) * 1000,
+                }
+            return result
+
+
+def timed(stats: Stats, endpoint: str, call) -> requests.Response or None:
+    started = time.perf_counter()
+    response = None
+    try:
+        response = call()
+    except requests.RequestException:
+        pass
+    stats.record(endpoint, time.perf_counter() - started, response is None or response.status_code >= 400)
+    return response
+
+
+def run_session(url: str, args, stats: Stats, index: int):
+    with requests.Session() as session:
+        with open(args.file, 'rb') as file:
+            # Each session uploads different content, unless --same-file, so that nothing is shared.
+            # The suffix is a comment in a PDF, and trailing data to zip based formats.
+            content = file.read() if args.same_file else file.read() + f'\n% Session {index}\n'.encode('utf-8')
+        files = {'chat_file': (os.path.basename(args.file), content)}
+        response = timed(stats, '/chat/file/upload',
+                         lambda: session.post(f'{url}/chat/file/upload', files=files, timeout=args.timeout))
+        if response is None or response.status_code >= 400:
+            return
+
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline:
+            response = timed(stats, '/chat/file/upload/progress',
+                             lambda: session.get(f'{url}/chat/file/upload/progress', timeout=args.timeout))
+            if response is not None and response.status_code < 400 and json.loads(response.text).get('completed'):
+                break
+            time.sleep(args.progress_interval)
+
+        for i in range(args.requests_per_session):
+            chat_request = _requests[(index + i) % len(_requests)]
+            timed(stats, '/chat/request',
+                  lambda: session.get(f'{url}/chat/request', params={'chat_request': chat_request},
+                                      timeout=args.timeout))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(args, app_dir: str, ollama_url: str or None) -> tuple[subprocess.Popen, str]:
+    port = free_port()
+    env = {
+        **os.environ,
+        'APP_DIR': app_dir,
+        'APP_PORT': str(port),
+        'APP_PROFILE': 'prod',
+        'APP_SECRET_KEY': os.environ.get('APP_SECRET_KEY', 'load-generator'),
+        'CHAT_SERVICE': args.chat_service,
+        'ECHO_CHAT_SECONDS': str(args.echo_seconds),
+        'MAX_SESSIONS': str(max(args.sessions, 1000)),
+    }
+    if ollama_url is not None:
+        env['OLLAMA_HOST'] = ollama_url
+    if args.server == 'asgi':
+        command = [sys.executable, '-m', 'hypercorn', '--bind', f'127.0.0.1:{port}', 'docchatai.main_asgi:asgi_app']
+    else:
+        command = [sys.executable, '-m', 'docchatai.main_web']
+    process = subprocess.Popen(command, cwd=_src_dir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=open(os.path.join(app_dir, 'app.log'), 'w'))
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'App exited with code {process.returncode}. See: {app_dir}/app.log')
+        try:
+            requests.get(url, timeout=1)
+            return process, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'App did not start within 60 seconds. See: {app_dir}/app.log')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Web app load generator')
+    parser.add_argument('--url', help='Of a running app. If not given, an app is started')
+    parser.add_argument('--server', default='web', choices=['web', 'asgi'])
+    parser.add_argument('--chat-service', default='echo', choices=['echo', 'default'])
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=0, help='Sessions at once. Default: all of them')
+    parser.add_argument('--requests-per-session', type=int, default=5)
+    parser.add_argument('--file', default=_default_file)
+    parser.add_argument('--same-file', action='store_true', help='Every session uploads the same content')
+    parser.add_argument('--echo-seconds', type=float, default=1)
+    parser.add_argument('--llm-latency-ms', type=float, default=200, help='Before the first token of each chat')
+    parser.add_argument('--token-latency-ms', type=float, default=10)
+    parser.add_argument('--embed-latency-ms', type=float, default=20, help='Of each embed call')
+    parser.add_argument('--progress-interval', type=float, default=0.5)
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--output', help='A JSON file, to write the results to')
+    args = parser.parse_args()
+
+    ollama = None
+    process = None
+    with tempfile.TemporaryDirectory() as app_dir:
+        try:
+            url = args.url
+            if url is None:
+                if args.chat_service == 'default':
+                    ollama = FakeOllamaServer(0, args.llm_latency_ms / 1000, args.token_latency_ms / 1000,
+                                              args.embed_latency_ms / 1000).start()
+                process, url = start_app(args, app_dir, None if ollama is None else ollama.url)
+
+            stats = Stats()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(args.concurrency or args.sessions) as executor:
+                for future in [executor.submit(run_session, url, args, stats, i) for i in range(args.sessions)]:
+                    future.result()
+            elapsed = time.perf_counter() - started
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+            if ollama is not None:
+                ollama.stop()
+
+    summary = stats.summary(elapsed)
+    print(f'sessions: {args.sessions}, requests per session: {args.requests_per_session}, '
+          f'server: {args.url or args.server}, chat service: {args.chat_service}, seconds: {elapsed:.1f}')
+    print(f'{"endpoint":<28}{"requests":>9}{"errors":>8}{"req/s":>9}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for endpoint, s in summary.items():
+        print(f'{endpoint:<28}{s["requests"]:>9}{s["errors"]:>8}{s["throughput_per_sec"]:>9.1f}'
+              f'{s["p50_ms"]:>10.1f}{s["p95_ms"]:>10.1f}{s["p99_ms"]:>10.1f}')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'config': vars(args), 'seconds': elapsed, 'endpoints': summary}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
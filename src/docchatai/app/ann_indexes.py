@@ -0,0 +1,85 @@
+import logging
+import math
+
+import faiss
+import numpy as np
+
+from .config import AppConfig
+
+logger = logging.getLogger(__name__)
+
+
+class AnnIndexes:
+    # A flat index compares a query with every vector. An approximate nearest neighbour (ANN)
+    # index compares it only with the most promising vectors. This is much faster for large
+    # indexes, at some loss of recall. Quantized vectors (float16, int8, PQ) use less memory.
+    __encodings = {'float32': 'Flat', 'float16': 'SQfp16', 'int8': 'SQ8'}
+
+    @staticmethod
+    def get_supported_index_types() -> [str]:
+        return ['auto', 'flat', 'ivf', 'hnsw', 'ivfpq']
+
+    @staticmethod
+    def get_supported_vector_encodings() -> [str]:
+        return list(AnnIndexes.__encodings.keys())
+
+    @staticmethod
+    def factory_string(app_config: AppConfig, ntotal: int, dimension: int) -> str or None:
+        # Returns the faiss.index_factory() string of the index to build, or None for a flat float32 index.
+        encoding = AnnIndexes.__encodings.get(app_config.vector_encoding, None)
+        if encoding is None:
+            raise ValueError(f'Unsupported vector encoding: `{app_config.vector_encoding}`. '
+                             f'Supported: {AnnIndexes.get_supported_vector_encodings()}')
+        index_type = app_config.vector_index_type
+        if index_type == 'auto':
+            if ntotal < app_config.ann_index_min_vectors:
+                index_type = 'flat'
+            else:
+                index_type = 'ivfpq' if ntotal >= app_config.pq_index_min_vectors else 'ivf'
+        if index_type == 'flat':
+            return None if encoding == 'Flat' else encoding
+        if index_type == 'hnsw':
+            return f'HNSW{app_config.hnsw_m}' if encoding == 'Flat' else f'HNSW{app_config.hnsw_m},{encoding}'
+        if index_type == 'ivf':
+            return f'IVF{AnnIndexes.nlist(ntotal)},{encoding}'
+        if index_type == 'ivfpq':
+            # The number of sub-quantizers must divide the dimension. Polysemous training (np), is
+            # skipped, as it is slow, and only speeds up searches that filter by hamming distance.
+            return f'IVF{AnnIndexes.nlist(ntotal)},PQ{math.gcd(dimension, app_config.pq_subquantizers)}np'
+        raise ValueError(f'Unsupported vector index type: `{index_type}`. '
+                         f'Supported: {AnnIndexes.get_supported_index_types()}')
+
+    @staticmethod
+    def nlist(ntotal: int) -> int:
+        # About 4 x sqrt(n) inverted lists, with at least 39 vectors per list to train each, as faiss advises.
+        return max(1, min(int(4 * math.sqrt(ntotal)), ntotal // 39))
+
+    @staticmethod
+    def build(index: faiss.Index, app_config: AppConfig) -> faiss.Index or None:
+        # Returns an index of the same vectors, in the same order, or None if the index should stay as it is.
+        factory_string = AnnIndexes.factory_string(app_config, index.ntotal, index.d)
+        if factory_string is None:
+            return None
+        vectors = index.reconstruct_n(0, index.ntotal)
+        ann_index = faiss.index_factory(index.d, factory_string, index.metric_type)
+        if not ann_index.is_trained:
+            # Train on a sample, as training on every vector of a large index takes too long.
+            ivf_index = faiss.try_extract_index_ivf(ann_index)
+            min_sample_size = 0 if ivf_index is None else 39 * ivf_index.nlist
+            sample_size = min(index.ntotal, max(app_config.ann_training_sample_size, min_sample_size))
+            sample = np.random.default_rng(0).choice(index.ntotal, sample_size, replace=False)
+            ann_index.train(vectors[np.sort(sample)])
+        ann_index.add(vectors)
+        AnnIndexes.set_search_params(ann_index, app_config)
+        logger.debug('Built index: %s, size: %s', factory_string, ann_index.ntotal)
+        return ann_index
+
+    @staticmethod
+    def set_search_params(index: faiss.Index, app_config: AppConfig):
+        # More lists probed, or a larger HNSW search queue, trade latency for recall.
+        ivf_index = faiss.try_extract_index_ivf(index)
+        if ivf_index is not None:
+            ivf_index.nprobe = app_config.ivf_nprobe
+        hnsw = getattr(index, 'hnsw', None)
+        if hnsw is not None:
+            hnsw.efSearch = app_config.hnsw_ef_search
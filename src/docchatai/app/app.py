@@ -5,7 +5,10 @@ import sys
 from datetime import datetime
 
 from .config import AppConfig
-from .concurrency import Threads
+from .concurrency import Processes, Threads
+from .embedding_scheduler import EmbeddingScheduler
+from .embedding_stores import EmbeddingStores
+from .metrics import Metrics
 
 logger = logging.getLogger(__name__)
 
@@ -15,7 +18,16 @@ class App:
 
     @staticmethod
     def init(app_config: AppConfig):
-        Threads.init(app_config.max_worker_threads)
+        Threads.init(app_config.max_worker_threads, {
+            Threads.PARSE: app_config.parse_worker_threads,
+            Threads.EMBED: app_config.embed_worker_threads,
+            Threads.BUILD: app_config.build_worker_threads,
+        })
+        Processes.init(app_config.parse_processes)
+        EmbeddingScheduler.init(app_config)
+        Metrics.init(app_config)
+        Metrics.register('threads', App.__thread_metrics)
+        Metrics.register('embeddings_cache', App.__embeddings_cache_metrics)
 
     @staticmethod
     def shutdown(wait: bool = False, cancel_futures: bool = True):
@@ -26,8 +38,25 @@ class App:
         App.__shutting_down = True
         logger.info("Shutting down...")
         Threads.shutdown(wait=wait, cancel_futures=cancel_futures)
+        Processes.shutdown(wait=wait, cancel_futures=cancel_futures)
+        EmbeddingStores.close()
         App.__shutdown = True
 
+    @staticmethod
+    def __thread_metrics() -> list:
+        samples = []
+        for pool, metrics in Threads.get_metrics().items():
+            samples.extend(Metrics.samples_of('docchatai_pool', metrics, {'pool': pool}, ('completed',)))
+        return samples
+
+    @staticmethod
+    def __embeddings_cache_metrics() -> list:
+        samples = []
+        for cache, metrics in EmbeddingStores.get_metrics().items():
+            samples.extend(Metrics.samples_of(
+                'docchatai_embeddings_cache', metrics, {'cache': cache}, ('hits', 'store_hits', 'misses')))
+        return samples
+
     @staticmethod
     def is_shutdown() -> bool:
         return App.__shutdown
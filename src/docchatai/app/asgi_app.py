@@ -0,0 +1,32 @@
+from quart import Quart
+
+from docchatai.app.config import AppConfig
+from docchatai.app.file_service import FileService
+from docchatai.app.web_service import WebService
+from docchatai.app.chat_service import ChatService
+from docchatai.app.metrics import Metrics
+
+def create_asgi_app(app_config: AppConfig = AppConfig(),
+                    static_folder='../static',
+                    template_folder='../templates') -> Quart:
+    # The async counterpart of the Flask web app. Chat requests wait on the model without
+    # holding a thread, so one process can serve many slow chat requests at once.
+    app = Quart(__name__, static_folder=static_folder, template_folder=template_folder)
+    app.secret_key = app_config.secret_key
+    # Larger requests are rejected with 413. From their Content-Length, before their body is read,
+    # or else once more than this has been read.
+    app.config['MAX_CONTENT_LENGTH'] = app_config.max_upload_bytes
+
+    app.config['app_config'] = app_config
+    chat_service = ChatService.of(app_config)
+    Metrics.register('chat_service', lambda: Metrics.samples_of(
+        'docchatai_chat', chat_service.get_metrics(), counters=('response_cache_hits', 'response_cache_misses')))
+    app.config['web_service'] = WebService(app_config,
+                                           chat_service,
+                                           FileService(app_config.uploads_dir,
+                                                       max_file_bytes=app_config.max_upload_bytes,
+                                                       max_session_bytes=app_config.max_session_upload_bytes))
+
+    return app
+
+asgi_app = create_asgi_app()
@@ -1,41 +1,103 @@
+import asyncio
 import logging
 
 import time
+from typing import AsyncIterator, Callable, Iterator
+
 from langchain_core.language_models import BaseChatModel
 
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 
-from .config import ChatConfig
-from .vectorstores import VectorStoreLoader, VectorStoreLoaderMultiThreaded
+from .concurrency import SingleFlight
+from .config import AppConfig, ChatConfig
+from .metrics import Metrics, StageTimer
+from .resource_pool import ResourcePool
+from .response_cache import ResponseCache
+from .session_store import SessionStore
+from .vectorstores import VectorStoreLoader, VectorStoreLoaderMultiThreaded, VectorStoreLoaderSharded, \
+    VectorStores
 
 logger = logging.getLogger(__name__)
 
 class ChatAI:
+    # Shared by every chat AI, as it only keeps the start times of the runs in progress.
+    __stage_timer = StageTimer()
+
     def __init__(self,
                  loader: VectorStoreLoader,
                  model: BaseChatModel,
                  prompt: ChatPromptTemplate,
-                 search_kwargs: dict[str, any]):
+                 search_kwargs: dict[str, any],
+                 on_close: Callable[[], None] = lambda: None,
+                 response_cache: ResponseCache or None = None):
         self.__loader: VectorStoreLoader = loader
         self.__model: BaseChatModel = model
         self.__prompt: ChatPromptTemplate = prompt
         self.__search_kwargs = search_kwargs
+        self.__on_close = on_close
+        self.__response_cache = response_cache
+        self.__handler = None
+        self.__handler_vectorstore = None
 
     def invoke(self, request: str) -> str:
-        return self.get_handler().invoke(request)
+        response = self.__get_cached_response(request)
+        if response is not None:
+            return response
+        response = self.get_handler().invoke(request, ChatAI.__run_config())
+        self.__cache_response(request, response)
+        return response
+
+    def stream(self, request: str) -> Iterator[str]:
+        response = self.__get_cached_response(request)
+        if response is not None:
+            yield response
+            return
+        tokens = []
+        for token in self.get_handler().stream(request, ChatAI.__run_config()):
+            tokens.append(token)
+            yield token
+        self.__cache_response(request, ''.join(tokens))
+
+    async def ainvoke(self, request: str) -> str:
+        # The response cache may embed the request, or write to disk, so it is used off the event loop.
+        response = await asyncio.to_thread(self.__get_cached_response, request)
+        if response is not None:
+            return response
+        response = await self.get_handler().ainvoke(request, ChatAI.__run_config())
+        await asyncio.to_thread(self.__cache_response, request, response)
+        return response
+
+    async def astream(self, request: str) -> AsyncIterator[str]:
+        response = await asyncio.to_thread(self.__get_cached_response, request)
+        if response is not None:
+            yield response
+            return
+        tokens = []
+        async for token in self.get_handler().astream(request, ChatAI.__run_config()):
+            tokens.append(token)
+            yield token
+        await asyncio.to_thread(self.__cache_response, request, ''.join(tokens))
 
     def get_handler(self):
-        return (
-                {
-                    'request': RunnablePassthrough(),
-                    'context': self.__loader.get().as_retriever(search_kwargs=self.__search_kwargs),
-                }
-                | self.__prompt
-                | self.__model
-                | StrOutputParser()
-        )
+        # The handler is built once per vectorstore. It is rebuilt only if the loader replaces
+        # its vectorstore, as pages added to the same vectorstore are visible to its retriever.
+        vectorstore = self.__loader.get()
+        handler = self.__handler
+        if handler is None or self.__handler_vectorstore is not vectorstore:
+            handler = (
+                    {
+                        'request': RunnablePassthrough(),
+                        'context': vectorstore.as_retriever(search_kwargs=self.__search_kwargs),
+                    }
+                    | self.__prompt
+                    | self.__model
+                    | StrOutputParser()
+            )
+            self.__handler, self.__handler_vectorstore = handler, vectorstore
+            logger.debug('Built chat handler for vectorstore: %s', id(vectorstore))
+        return handler
 
     def get_loader(self) -> VectorStoreLoader:
         return self.__loader
@@ -49,8 +111,47 @@ class ChatAI:
     def get_search_kwargs(self) -> dict[str, any]:
         return self.__search_kwargs
 
+    def get_response_cache(self) -> ResponseCache or None:
+        return self.__response_cache
+
+    def close(self):
+        self.__on_close()
+
+    @staticmethod
+    def __run_config() -> dict[str, any] or None:
+        return {'callbacks': [ChatAI.__stage_timer]} if Metrics.is_enabled() else None
+
+    def __get_cached_response(self, request: str) -> str or None:
+        if self.__response_cache is None:
+            return None
+        try:
+            with Metrics.span('response_cache'):
+                response = self.__response_cache.get(request)
+        except Exception as ex:
+            logger.warning('Failed to read response cache. %s', ex)
+            return None
+        if response is not None:
+            logger.debug('Cached response found for: %s', request)
+        return response
+
+    def __cache_response(self, request: str, response: str):
+        # Responses based on a partially loaded document are not cached, as they may be incomplete.
+        if self.__response_cache is None or not self.__loader.is_completed():
+            return
+        try:
+            self.__response_cache.put(request, response)
+        except Exception as ex:
+            logger.warning('Failed to write response cache. %s', ex)
+
 class ChatService:
-    __store = {}
+    @staticmethod
+    def of(app_config: AppConfig) -> 'ChatService':
+        service = app_config.chat_service
+        if service == 'default':
+            return ChatService(app_config.default_chat_message_limit, app_config)
+        if service == 'echo':
+            return EchoChatService(app_config.default_chat_message_limit, app_config, app_config.echo_chat_seconds)
+        raise ValueError(f'Unsupported chat service: `{service}`. Supported: default, echo')
 
     @staticmethod
     def get_chat_models() -> [dict[str, str]]:
@@ -72,8 +173,34 @@ class ChatService:
         else:
             raise ValueError(f'Unsupported model provider for embeddings: {provider}')
 
-    def __init__(self, message_display_limit: int = 100):
+    @staticmethod
+    def _size_of(resource: any) -> int:
+        if isinstance(resource, ChatAI):
+            # A chat AI holds its loaders till it is evicted, so it is counted as their size.
+            # Once evicted, its loaders are released, and counted by themselves.
+            loader = resource.get_loader()
+            loaders = loader.get_loaders() if isinstance(loader, VectorStoreLoaderSharded) else [loader]
+            return sum(VectorStores.size_in_bytes(loader.get()) for loader in loaders)
+        if isinstance(resource, VectorStoreLoader):
+            return VectorStores.size_in_bytes(resource.get())
+        return 0
+
+    @staticmethod
+    def _close(_, resource: any):
+        close = getattr(resource, 'close', None)
+        if callable(close):
+            close()
+
+    def __init__(self, message_display_limit: int = 100, app_config: AppConfig = AppConfig()):
         self.__message_display_limit = message_display_limit
+        # Shared by all sessions, so that sessions chatting about the same document
+        # with the same model, also share the model clients and the loaded vectorstore.
+        self.__pool = ResourcePool(app_config.max_idle_pool_items,
+                                   app_config.max_pool_bytes,
+                                   ChatService._size_of,
+                                   ChatService._close)
+        self.__sessions = SessionStore.of(app_config, self.__on_session_evicted)
+        self.__single_flight = SingleFlight()
 
     def new_vectorstore_loader(self) -> VectorStoreLoader:
         return VectorStoreLoaderMultiThreaded()
@@ -82,69 +209,225 @@ class ChatService:
         logger.debug('chat_config: %s', chat_config)
         chat_prompt = ChatPromptTemplate.from_template(chat_config.chat_template)
 
-        chat_model = ChatService.model(chat_config.chat_model_name, chat_config.chat_model_provider)
-        embeddings = ChatService.embeddings(chat_config.chat_model_name, chat_config.chat_model_provider)
+        name, provider = chat_config.chat_model_name, chat_config.chat_model_provider
+        model_key = ('model', provider, name)
+        embeddings_key = ('embeddings', provider, name)
+
+        chat_model = self.__pool.acquire(model_key, lambda: self.model(name, provider))
+        embeddings = self.__pool.acquire(embeddings_key, lambda: self.embeddings(name, provider))
         logger.debug(f'Chat model ready: {chat_config.chat_model_name}')
 
-        loader = self.new_vectorstore_loader().load(chat_config, embeddings)
+        # Each file is loaded into a vectorstore of its own, which is pooled, and so shared
+        # by every chat about that file. A chat about many files searches them all as shards.
+        acquired_keys = [model_key, embeddings_key]
+
+        def release():
+            for key in reversed(acquired_keys):
+                self.__pool.release(key)
+
+        loaders = []
+        try:
+            for file_config in chat_config.for_each_file():
+                loader_key = ('loader', provider, name, file_config.chat_file_digest)
+                loaders.append(self.__pool.acquire(
+                    loader_key, lambda: self.new_vectorstore_loader().load(file_config, embeddings)))
+                acquired_keys.append(loader_key)
+        except Exception:
+            release()
+            raise
+        loader = loaders[0] if len(loaders) == 1 else VectorStoreLoaderSharded(loaders)
         vectorstore = loader.wait_till_completed() if wait_till_completed is True else loader.get()
         logger.debug(f'Vectorstore ready: {vectorstore}')
 
+        response_cache = None
+        if chat_config.app_config.response_cache_enabled:
+            # Shares cached query vectors with the retriever, so a request missing this cache is embedded once.
+            response_cache = ResponseCache.of(chat_config, VectorStores.file_backed_embeddings(chat_config, embeddings))
+
         return ChatAI(loader, chat_model, chat_prompt,
-                      {'k': chat_config.app_config.max_results_per_query})
+                      {'k': chat_config.app_config.max_results_per_query}, release, response_cache)
+
+    def acquire_chat_ai(self, chat_config: ChatConfig, wait_till_completed: bool = True) -> ChatAI:
+        # Release the returned chat AI with release_chat_ai(), using the same chat config.
+        chat_ai = self.__pool.acquire(ChatService._chat_ai_key(chat_config),
+                                      lambda: self.create_chat_ai(chat_config, wait_till_completed))
+        if wait_till_completed is True and hasattr(chat_ai, 'get_loader'):
+            # A pooled chat AI, may have been created without waiting.
+            chat_ai.get_loader().wait_till_completed()
+        return chat_ai
+
+    def release_chat_ai(self, chat_config: ChatConfig):
+        self.__pool.release(ChatService._chat_ai_key(chat_config))
 
     @staticmethod
-    def _get_session_store(session_id: str):
-        session_store = ChatService.__store.get(session_id, None)
-        if session_store is None:
-            session_store = {}
-            ChatService.__store[session_id] = session_store
-        return session_store
+    def _chat_ai_key(chat_config: ChatConfig) -> tuple:
+        return ('chat_ai', chat_config.chat_model_provider, chat_config.chat_model_name,
+                chat_config.chat_file_digest, chat_config.chat_template)
 
     def add_chat_ai(self,
                     session_id: str,
                     chat_config: ChatConfig,
                     wait_till_completed: bool = True) -> ChatAI:
-        session_store = ChatService._get_session_store(session_id)
-        chat_ai = self.create_chat_ai(chat_config, wait_till_completed)
-        session_store['chat_ai'] = chat_ai
+        chat_ai = self.acquire_chat_ai(chat_config, wait_till_completed)
+        previous_chat_config = self.__sessions.set_chat_ai(session_id, chat_ai, chat_config)
+        if previous_chat_config is not None:
+            self.release_chat_ai(previous_chat_config)
         return chat_ai
 
-    @staticmethod
-    def get_chat_ai(session_id: str) -> ChatAI or None:
-        session_store = ChatService._get_session_store(session_id)
-        return session_store.get('chat_ai', None)
+    def get_metrics(self) -> dict[str, any]:
+        resources = self.__pool.get_values()
+        loaders = [r for r in resources if isinstance(r, VectorStoreLoader)]
+        response_caches = [r.get_response_cache() for r in resources if isinstance(r, ChatAI)]
+        response_caches = [c for c in response_caches if c is not None]
+        return {
+            'sessions': len(self.__sessions),
+            'sessions_bytes': self.__sessions.get_size_in_bytes(),
+            'pooled_resources': len(self.__pool),
+            'pooled_bytes': self.__pool.get_size_in_bytes(),
+            'loading_documents': sum(1 for loader in loaders if not loader.is_completed()),
+            'loaded_vectors': sum(VectorStores.len(loader.get()) for loader in loaders),
+            'response_cache_hits': sum(c.get_hits() for c in response_caches),
+            'response_cache_misses': sum(c.get_misses() for c in response_caches),
+        }
+
+    def get_chat_ai(self, session_id: str) -> ChatAI or None:
+        return self.__sessions.get_chat_ai(session_id)
+
+    def get_chats(self, session_id: str) -> [dict[str, any]]:
+        return self.__sessions.get_chats(session_id, self.__message_display_limit)
 
     def chat_request(self, session_id: str, request: str, chat_config: ChatConfig) -> [dict[str, any]]:
         chat_ai = self.get_chat_ai(session_id)
         if chat_ai is None:
-            chat_ai = self.add_chat_ai(session_id, chat_config)
+            # Concurrent requests for the same session, share a single chat AI.
+            chat_ai = self.__single_flight.do(session_id, self.__get_or_add_chat_ai, session_id, chat_config)
 
         response = chat_ai.invoke(request)
         logger.debug("Chat response ready")
 
-        session_store = ChatService._get_session_store(session_id)
-        chats = session_store.get('chats', None)
-        if chats is None:
-            chats = []
-            session_store['chats'] = chats
+        chats = self.__sessions.add_chat(
+            session_id, {'request': request, 'response': response}, self.__message_display_limit)
+        logger.debug('Session chats: %s', len(chats))
+
+        return chats
+
+    def chat_request_stream(self, session_id: str, request: str, chat_config: ChatConfig) -> Iterator[str]:
+        # Yields the response a token at a time. The full response is added to the session's chats.
+        chat_ai = self.get_chat_ai(session_id)
+        if chat_ai is None:
+            chat_ai = self.__single_flight.do(session_id, self.__get_or_add_chat_ai, session_id, chat_config)
+
+        tokens = []
+        for token in chat_ai.stream(request):
+            tokens.append(token)
+            yield token
+        logger.debug("Chat response streamed")
+
+        chats = self.__sessions.add_chat(
+            session_id, {'request': request, 'response': ''.join(tokens)}, self.__message_display_limit)
+        logger.debug('Session chats: %s', len(chats))
+
+    async def achat_request(self, session_id: str, request: str, chat_config: ChatConfig) -> [dict[str, any]]:
+        chat_ai = await self.__aget_or_add_chat_ai(session_id, chat_config)
+
+        response = await chat_ai.ainvoke(request)
+        logger.debug("Chat response ready")
+
+        chats = await asyncio.to_thread(self.__sessions.add_chat, session_id,
+                                        {'request': request, 'response': response}, self.__message_display_limit)
+        logger.debug('Session chats: %s', len(chats))
+
+        return chats
+
+    async def achat_request_stream(self,
+                                   session_id: str,
+                                   request: str,
+                                   chat_config: ChatConfig) -> AsyncIterator[str]:
+        chat_ai = await self.__aget_or_add_chat_ai(session_id, chat_config)
+
+        tokens = []
+        async for token in chat_ai.astream(request):
+            tokens.append(token)
+            yield token
+        logger.debug("Chat response streamed")
 
-        chats.append({'request': request, 'response': response})
+        chats = await asyncio.to_thread(self.__sessions.add_chat, session_id,
+                                        {'request': request, 'response': ''.join(tokens)},
+                                        self.__message_display_limit)
         logger.debug('Session chats: %s', len(chats))
 
-        return chats[-self.__message_display_limit:]
+    async def __aget_or_add_chat_ai(self, session_id: str, chat_config: ChatConfig) -> ChatAI:
+        chat_ai = self.get_chat_ai(session_id)
+        if chat_ai is None:
+            # Loading a document blocks, so it is done off the event loop.
+            chat_ai = await asyncio.to_thread(
+                self.__single_flight.do, session_id, self.__get_or_add_chat_ai, session_id, chat_config)
+        return chat_ai
+
+    def __get_or_add_chat_ai(self, session_id: str, chat_config: ChatConfig) -> ChatAI:
+        chat_ai = self.get_chat_ai(session_id)
+        return self.add_chat_ai(session_id, chat_config) if chat_ai is None else chat_ai
+
+    def __on_session_evicted(self, _: str, chat_ai: ChatAI or None, chat_config: ChatConfig or None):
+        # Lets the pool evict the session's vectorstore, once no other session is using it.
+        if chat_ai is not None and chat_config is not None:
+            self.release_chat_ai(chat_config)
 
 class EchoChatService(ChatService):
+    # Echoes each request, after a delay, without loading documents or calling a model.
+    def __init__(self, message_display_limit: int = 100, app_config: AppConfig = AppConfig(), sleep_time: float = 3):
+        super().__init__(message_display_limit, app_config)
+        self.__sleep_time = sleep_time
+
     def create_chat_ai(self, chat_config: ChatConfig, _: bool = True):
         class EchoChat:
-            def __init__(self, sleep_time: int = 3):
+            def __init__(self, sleep_time: float = 3):
                 self.__sleep_time = sleep_time
 
+            @property
+            def name(self) -> str:
+                return 'echo'
+
+            def get_model(self):
+                return self
+
+            def get_loader(self):
+                # There is nothing to load.
+                return self
+
+            def get_loaded_pages(self) -> int:
+                return 0
+
+            def get_total_pages(self) -> int:
+                return 0
+
+            def is_completed(self) -> bool:
+                return True
+
+            def wait_till_completed(self):
+                return None
+
             def invoke(self, request: str) -> str:
                 time.sleep(self.__sleep_time)
                 return request
 
-        return EchoChat()
+            def stream(self, request: str) -> Iterator[str]:
+                words = request.split(' ')
+                for i, word in enumerate(words):
+                    time.sleep(self.__sleep_time / len(words))
+                    yield word if i == 0 else f' {word}'
+
+            async def ainvoke(self, request: str) -> str:
+                await asyncio.sleep(self.__sleep_time)
+                return request
+
+            async def astream(self, request: str) -> AsyncIterator[str]:
+                words = request.split(' ')
+                for i, word in enumerate(words):
+                    await asyncio.sleep(self.__sleep_time / len(words))
+                    yield word if i == 0 else f' {word}'
+
+        return EchoChat(self.__sleep_time)
 
 # class ChatModel:
 #     def __init__(self, name: str, provider: str or None = None):
@@ -1,25 +1,250 @@
 import logging
-from concurrent.futures import Future, ThreadPoolExecutor
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Hashable
 
 logger = logging.getLogger(__name__)
 
+class _Task:
+    def __init__(self, future: Future, function: Callable, args: tuple, kwargs: dict):
+        self.future = future
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.submitted = time.monotonic()
+
+
+class WorkerPool:
+    # Runs tasks on at most `max_workers` threads. Tasks are queued per group, and the groups
+    # take turns, so that a group with many queued tasks can not starve the other groups.
+    def __init__(self, name: str, max_workers: int):
+        if max_workers < 1:
+            raise ValueError(f'max workers must be at least 1, found: {max_workers}')
+        self.__name = name
+        self.__max_workers = max_workers
+        self.__condition = threading.Condition()
+        # By group, in the order that the groups will next be served.
+        self.__queues: OrderedDict[Hashable, deque[_Task]] = OrderedDict()
+        self.__threads: list[threading.Thread] = []
+        self.__idle_workers = 0
+        self.__is_shutdown = False
+        self.__queue_depth = 0
+        self.__running = 0
+        self.__completed = 0
+        self.__total_wait_seconds = 0.0
+        self.__max_wait_seconds = 0.0
+        self.__total_run_seconds = 0.0
+
+    def submit(self, group: Hashable, function: Callable, /, *args, **kwargs) -> Future:
+        future = Future()
+        with self.__condition:
+            if self.__is_shutdown is True:
+                raise RuntimeError(f'Can not submit to {self.__name} pool, after shutdown')
+            queue = self.__queues.get(group, None)
+            if queue is None:
+                queue = deque()
+                self.__queues[group] = queue
+            queue.append(_Task(future, function, args, kwargs))
+            self.__queue_depth += 1
+            # Idle workers may not have woken up yet, to take the tasks already queued.
+            if self.__queue_depth > self.__idle_workers and len(self.__threads) < self.__max_workers:
+                self.__start_worker()
+            self.__condition.notify()
+        return future
+
+    def get_metrics(self) -> dict[str, any]:
+        with self.__condition:
+            completed = self.__completed
+            return {
+                'max_workers': self.__max_workers,
+                'workers': len(self.__threads),
+                'queue_depth': self.__queue_depth,
+                'queued_groups': len(self.__queues),
+                'running': self.__running,
+                'completed': completed,
+                'mean_wait_seconds': 0.0 if completed == 0 else self.__total_wait_seconds / completed,
+                'max_wait_seconds': self.__max_wait_seconds,
+                'mean_run_seconds': 0.0 if completed == 0 else self.__total_run_seconds / completed,
+            }
+
+    def shutdown(self, wait: bool = False, cancel_futures: bool = True):
+        with self.__condition:
+            self.__is_shutdown = True
+            if cancel_futures is True:
+                for queue in self.__queues.values():
+                    for task in queue:
+                        task.future.cancel()
+                self.__queues.clear()
+                self.__queue_depth = 0
+            self.__condition.notify_all()
+            threads = list(self.__threads)
+        if wait is True:
+            for thread in threads:
+                thread.join()
+
+    def __start_worker(self):
+        # Workers are daemons, so that an idle pool never holds up the exit of the process.
+        # Workers are idle from when they are started, until they take a task.
+        thread = threading.Thread(target=self.__work, daemon=True,
+                                  name=f'{self.__name}-worker-{len(self.__threads)}')
+        self.__threads.append(thread)
+        self.__idle_workers += 1
+        thread.start()
+
+    def __next_task(self) -> _Task:
+        # The group served is moved to the back of the line.
+        group, queue = next(iter(self.__queues.items()))
+        task = queue.popleft()
+        del self.__queues[group]
+        if len(queue) > 0:
+            self.__queues[group] = queue
+        self.__queue_depth -= 1
+        return task
+
+    def __work(self):
+        while True:
+            with self.__condition:
+                while len(self.__queues) == 0 and self.__is_shutdown is False:
+                    self.__condition.wait()
+                self.__idle_workers -= 1
+                if len(self.__queues) == 0:
+                    return
+                task = self.__next_task()
+                wait_seconds = time.monotonic() - task.submitted
+                self.__running += 1
+
+            started = time.monotonic()
+            try:
+                if task.future.set_running_or_notify_cancel():
+                    try:
+                        task.future.set_result(task.function(*task.args, **task.kwargs))
+                    except BaseException as ex:
+                        task.future.set_exception(ex)
+            finally:
+                with self.__condition:
+                    self.__running -= 1
+                    self.__idle_workers += 1
+                    self.__completed += 1
+                    self.__total_wait_seconds += wait_seconds
+                    self.__max_wait_seconds = max(self.__max_wait_seconds, wait_seconds)
+                    self.__total_run_seconds += time.monotonic() - started
+
+
 class Threads:
-    __executor = None
+    # Each workload has its own pool, so that e.g. documents being parsed can not hold up
+    # the embedding of other documents. Work submitted without a workload, goes to the default pool.
+    DEFAULT = 'default'
+    PARSE = 'parse'
+    EMBED = 'embed'
+    BUILD = 'build'
+
+    __pools: dict[str, WorkerPool] = {}
 
     @staticmethod
-    def init(max_workers: int = 50):
-        logger.info("Initializing app thread pool executor.")
-        Threads.__executor = ThreadPoolExecutor(max_workers=max_workers)
+    def init(max_workers: int = 50, workload_workers: dict[str, int] or None = None):
+        logger.info("Initializing app thread pools.")
+        if len(Threads.__pools) > 0:
+            Threads.shutdown()
+        pools = {Threads.DEFAULT: WorkerPool(Threads.DEFAULT, max_workers)}
+        for workload, workers in (workload_workers or {}).items():
+            pools[workload] = WorkerPool(workload, workers)
+        Threads.__pools = pools
 
     @staticmethod
     def submit(function, /, *args, **kwargs) -> Future:
-        return Threads.__executor.submit(function, *args, **kwargs)
+        return Threads.submit_to(Threads.DEFAULT, None, function, *args, **kwargs)
+
+    @staticmethod
+    def submit_to(workload: str, group: Hashable, function, /, *args, **kwargs) -> Future:
+        # Tasks of the same group are started in order. Groups take turns, within each workload.
+        pool = Threads.__pools.get(workload, None)
+        if pool is None:
+            pool = Threads.__pools.get(Threads.DEFAULT, None)
+        if pool is None:
+            raise RuntimeError('Threads.init() must be called before submitting tasks')
+        return pool.submit(group, function, *args, **kwargs)
+
+    @staticmethod
+    def get_metrics() -> dict[str, dict[str, any]]:
+        return {workload: pool.get_metrics() for workload, pool in Threads.__pools.items()}
 
     @staticmethod
     def shutdown(wait: bool = False, cancel_futures: bool = True):
-        if Threads.__executor is None:
+        if len(Threads.__pools) == 0:
             logger.warning(
-                'Skipping shutdown of app thread pool executor, as it was never initialized.')
+                'Skipping shutdown of app thread pools, as they were never initialized.')
             return
-        logger.info('Shutting app down thread pool executor.')
-        Threads.__executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+        logger.info('Shutting down app thread pools.')
+        for pool in Threads.__pools.values():
+            pool.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+
+class Processes:
+    # For CPU bound work, which threads would run one at a time because of the GIL.
+    __executor: ProcessPoolExecutor or None = None
+    __max_workers = 0
+
+    @staticmethod
+    def init(max_workers: int = 0):
+        if max_workers < 1:
+            logger.info("App process pool is disabled.")
+            return
+        logger.info("Initializing app process pool, max workers: %s", max_workers)
+        # Spawned, rather than forked, as forking a process while other threads are running is unsafe.
+        Processes.__executor = ProcessPoolExecutor(max_workers=max_workers,
+                                                   mp_context=multiprocessing.get_context('spawn'))
+        Processes.__max_workers = max_workers
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return Processes.__executor is not None
+
+    @staticmethod
+    def get_max_workers() -> int:
+        return Processes.__max_workers
+
+    @staticmethod
+    def submit(function, /, *args, **kwargs) -> Future:
+        return Processes.__executor.submit(function, *args, **kwargs)
+
+    @staticmethod
+    def shutdown(wait: bool = False, cancel_futures: bool = True):
+        if Processes.__executor is None:
+            return
+        logger.info('Shutting down app process pool.')
+        Processes.__executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+        Processes.__executor = None
+        Processes.__max_workers = 0
+
+
+class SingleFlight:
+    # Concurrent calls for the same key share a single call, and its result or exception.
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__calls: dict[Hashable, Future] = {}
+
+    def do(self, key: Hashable, function: Callable, /, *args, **kwargs) -> any:
+        with self.__lock:
+            future = self.__calls.get(key, None)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self.__calls[key] = future
+
+        if not is_leader:
+            logger.debug('Waiting for in-flight call: %s', key)
+            return future.result()
+
+        try:
+            result = function(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
@@ -1,8 +1,11 @@
+import hashlib
 import logging
 import os
 from enum import unique, Enum
 from sys import argv
 
+from .utils import file_digest
+
 logger = logging.getLogger(__name__)
 
 class AppConfig:
@@ -26,6 +29,48 @@ class AppConfig:
     def uploads_dir(self) -> str:
         return os.path.join(self.app_dir, 'uploads')
 
+    @property
+    def max_upload_bytes(self) -> int:
+        # Per request. Larger requests are rejected as they are read. Also the max size of each file.
+        return int(os.environ.get('MAX_UPLOAD_BYTES', str(100 * 1024 * 1024)))
+
+    @property
+    def max_session_upload_bytes(self) -> int:
+        # The total size of the files uploaded by each session.
+        return int(os.environ.get('MAX_SESSION_UPLOAD_BYTES', str(500 * 1024 * 1024)))
+
+    @property
+    def embeddings_cache_dir(self) -> str:
+        return os.path.join(self.app_dir, '.embeddings-cache')
+
+    @property
+    def embeddings_cache_store(self) -> str:
+        # One of: file, sqlite. File stores each vector in its own file.
+        return os.environ.get('EMBEDDINGS_CACHE_STORE', 'sqlite')
+
+    @property
+    def embeddings_cache_max_bytes(self) -> int:
+        # For sqlite. The least recently used vectors are evicted beyond this. 0 for no limit.
+        return int(os.environ.get('EMBEDDINGS_CACHE_MAX_BYTES', str(2 * 1024 * 1024 * 1024)))
+
+    @property
+    def embeddings_memory_cache_max_bytes(self) -> int:
+        # Recently used document vectors held in memory, in front of the embeddings cache. 0 to disable.
+        return int(os.environ.get('EMBEDDINGS_MEMORY_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+    @property
+    def query_embeddings_cache_max_bytes(self) -> int:
+        # Recently used query vectors held in memory. 0 to disable.
+        return int(os.environ.get('QUERY_EMBEDDINGS_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+
+    @property
+    def index_cache_dir(self) -> str:
+        return os.path.join(self.app_dir, '.index-cache')
+
+    @property
+    def response_cache_dir(self) -> str:
+        return os.path.join(self.app_dir, '.response-cache')
+
     @property
     def app_port(self) -> int:
         return int(os.environ.get('APP_PORT', '8888'))
@@ -34,6 +79,21 @@ class AppConfig:
     def is_production(self) -> bool:
         return os.environ.get('APP_PROFILE') == 'prod'
 
+    @property
+    def metrics_enabled(self) -> bool:
+        # Time each stage of loading documents and answering requests, for the /metrics endpoint.
+        return os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+    @property
+    def chat_service(self) -> str:
+        # One of: default, echo. Echo answers each request with the request, for load testing.
+        return os.environ.get('CHAT_SERVICE', 'default')
+
+    @property
+    def echo_chat_seconds(self) -> float:
+        # How long the echo chat service takes to answer.
+        return float(os.environ.get('ECHO_CHAT_SECONDS', '3'))
+
     @property
     def max_results_per_query(self) -> int:
         return int(os.environ.get('MAX_RESULTS_PER_QUERY', '3'))
@@ -50,10 +110,179 @@ class AppConfig:
     def default_chat_message_limit(self) -> int:
         return 100
 
+    @property
+    def chat_history_store(self) -> str:
+        # One of: memory, sqlite
+        return os.environ.get('CHAT_HISTORY_STORE', 'memory')
+
+    @property
+    def max_sessions(self) -> int:
+        return int(os.environ.get('MAX_SESSIONS', '1000'))
+
+    @property
+    def session_ttl_seconds(self) -> int:
+        return int(os.environ.get('SESSION_TTL_SECONDS', '3600'))
+
+    @property
+    def max_sessions_bytes(self) -> int:
+        # The memory budget for the chats kept in memory, for all sessions. 0 means no limit.
+        return int(os.environ.get('MAX_SESSIONS_BYTES', str(256 * 1024 * 1024)))
+
+    @property
+    def max_session_bytes(self) -> int:
+        # The memory budget for the chats kept in memory, per session.
+        return int(os.environ.get('MAX_SESSION_BYTES', str(1024 * 1024)))
+
+    @property
+    def max_idle_pool_items(self) -> int:
+        # The max number of chat models and vectorstores kept after their last session is done.
+        return int(os.environ.get('MAX_IDLE_POOL_ITEMS', '16'))
+
+    @property
+    def max_pool_bytes(self) -> int:
+        # Idle vectorstores are evicted once the pool is larger than this. 0 means no limit.
+        return int(os.environ.get('MAX_POOL_BYTES', str(2 * 1024 * 1024 * 1024)))
+
+    @property
+    def response_cache_enabled(self) -> bool:
+        return os.environ.get('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+
+    @property
+    def response_cache_similarity_threshold(self) -> float:
+        # The min cosine similarity, for an earlier request's response to be reused.
+        return float(os.environ.get('RESPONSE_CACHE_SIMILARITY_THRESHOLD', '0.95'))
+
+    @property
+    def response_cache_ttl_seconds(self) -> int:
+        return int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', '86400'))
+
+    @property
+    def response_cache_max_entries(self) -> int:
+        # Per document, model and template.
+        return int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', '1000'))
+
     @property
     def max_worker_threads(self) -> int:
         return int(os.environ.get('MAX_WORKER_THREADS', '50'))
 
+    @property
+    def parse_worker_threads(self) -> int:
+        # The max number of documents parsed at the same time.
+        return int(os.environ.get('PARSE_WORKER_THREADS', '8'))
+
+    @property
+    def embed_worker_threads(self) -> int:
+        # Shared fairly by the documents being loaded, which take turns embedding a batch.
+        return int(os.environ.get('EMBED_WORKER_THREADS', '8'))
+
+    @property
+    def build_worker_threads(self) -> int:
+        # The max number of indexes built at the same time.
+        return int(os.environ.get('BUILD_WORKER_THREADS', '8'))
+
+    @property
+    def parse_processes(self) -> int:
+        # PDFs are parsed in this many processes. Zero, parses each PDF in a single thread.
+        return int(os.environ.get('PARSE_PROCESSES', '0'))
+
+    @property
+    def parse_pages_per_task(self) -> int:
+        # The pages of a PDF, parsed by each task in the process pool.
+        return int(os.environ.get('PARSE_PAGES_PER_TASK', '32'))
+
+    @property
+    def text_splitter(self) -> str:
+        # One of: recursive, character, token
+        return os.environ.get('TEXT_SPLITTER', 'recursive')
+
+    @property
+    def chunk_size(self) -> int:
+        # In characters, or in tokens for the token text splitter.
+        return int(os.environ.get('CHUNK_SIZE', '4000'))
+
+    @property
+    def chunk_overlap(self) -> int:
+        return int(os.environ.get('CHUNK_OVERLAP', '200'))
+
+    @property
+    def vector_index_type(self) -> str:
+        # One of: auto, flat, ivf, hnsw, ivfpq. Auto keeps small indexes flat.
+        # Only the vectors of saved ivf and ivfpq indexes are memory-mapped. The others are held in RAM.
+        return os.environ.get('VECTOR_INDEX_TYPE', 'auto')
+
+    @property
+    def vector_encoding(self) -> str:
+        # One of: float32, float16, int8. Applies to flat, ivf and hnsw indexes.
+        return os.environ.get('VECTOR_ENCODING', 'float32')
+
+    @property
+    def mmap_docstore(self) -> bool:
+        # Read the text of saved documents from disk, only when they are retrieved.
+        # The ids of the documents, by position and by id, are still held in memory.
+        return os.environ.get('MMAP_DOCSTORE', 'true').lower() == 'true'
+
+    @property
+    def ann_index_min_vectors(self) -> int:
+        # For auto, the min number of vectors for an IVF index.
+        return int(os.environ.get('ANN_INDEX_MIN_VECTORS', '100000'))
+
+    @property
+    def pq_index_min_vectors(self) -> int:
+        # For auto, the min number of vectors for an IVF index with product quantized vectors.
+        return int(os.environ.get('PQ_INDEX_MIN_VECTORS', '1000000'))
+
+    @property
+    def pq_subquantizers(self) -> int:
+        # The bytes per product quantized vector.
+        return int(os.environ.get('PQ_SUBQUANTIZERS', '64'))
+
+    @property
+    def ann_training_sample_size(self) -> int:
+        return int(os.environ.get('ANN_TRAINING_SAMPLE_SIZE', '100000'))
+
+    @property
+    def ivf_nprobe(self) -> int:
+        # The number of IVF lists searched per query.
+        return int(os.environ.get('IVF_NPROBE', '16'))
+
+    @property
+    def hnsw_m(self) -> int:
+        # The number of neighbours of each HNSW node.
+        return int(os.environ.get('HNSW_M', '32'))
+
+    @property
+    def hnsw_ef_search(self) -> int:
+        return int(os.environ.get('HNSW_EF_SEARCH', '64'))
+
+    @property
+    def embedding_batch_size(self) -> int:
+        # The number of chunks sent to the embeddings model at once.
+        return int(os.environ.get('EMBEDDING_BATCH_SIZE', '16'))
+
+    @property
+    def max_concurrent_embeddings(self) -> int:
+        # The max number of embedding calls in flight, for all documents being loaded.
+        return int(os.environ.get('MAX_CONCURRENT_EMBEDDINGS', '4'))
+
+    @property
+    def embedding_max_retries(self) -> int:
+        return int(os.environ.get('EMBEDDING_MAX_RETRIES', '3'))
+
+    @property
+    def embedding_retry_delay_seconds(self) -> float:
+        # Doubled after each retry, and jittered.
+        return float(os.environ.get('EMBEDDING_RETRY_DELAY_SECONDS', '0.5'))
+
+    @property
+    def ingestion_queue_size(self) -> int:
+        # The max number of parsed batches waiting to be embedded, per document.
+        return int(os.environ.get('INGESTION_QUEUE_SIZE', '8'))
+
+    @property
+    def index_build_block_size(self) -> int:
+        # The max number of embedding batches appended to an index at once.
+        return int(os.environ.get('INDEX_BUILD_BLOCK_SIZE', '64'))
+
     @property
     def default_chat_template(self) -> str:
         return """
@@ -111,15 +340,22 @@ class ChatConfig:
     @staticmethod
     def from_dict(app_config: AppConfig = AppConfig(), values: dict[str, str] = None) -> 'ChatConfig':
         chat_file = values.get(str(ChatVar.FILE.value), None)
+        if isinstance(chat_file, list) and len(chat_file) > 0:
+            # Many files. The first stands in for all of them, where only one is expected.
+            values = {**values, 'chat_files': chat_file, str(ChatVar.FILE.value): chat_file[0]}
+            chat_file = chat_file[0]
         if isinstance(chat_file, dict):
             # Use a copy
-            values = {**values, str(ChatVar.FILE.value): chat_file['output_path']}
+            values = {**values,
+                      str(ChatVar.FILE.value): chat_file['output_path'],
+                      'chat_file_digest': chat_file.get('digest', None)}
         return ChatConfig(app_config, values)
 
     def __init__(self, app_config: AppConfig = AppConfig(), values: dict[str, str] = None):
         super().__init__()
         self.__app_config = app_config
         self.__values = {} if values is None else values
+        self.__chat_file_digest = None
 
     def to_dict(self) -> dict[str, str]:
         return {
@@ -136,7 +372,7 @@ class ChatConfig:
     @property
     def chat_model_provider(self) -> str:
         return self._get_val_key_case_insensitive(
-            ChatVar.MODEL_PROVIDER, self.app_config.default_chat_model_name)
+            ChatVar.MODEL_PROVIDER, self.app_config.default_chat_model_provider)
 
     @property
     def chat_model_name(self) -> str:
@@ -146,6 +382,32 @@ class ChatConfig:
     def chat_file(self) -> str:
         return self._get_val_key_case_insensitive(ChatVar.FILE, None)
 
+    @property
+    def chat_file_digest(self) -> str or None:
+        if self.__chat_file_digest is None and self.chat_file is not None:
+            file_configs = self.for_each_file()
+            if len(file_configs) > 1:
+                # Independent of the order of the files.
+                digests = sorted(file_config.chat_file_digest for file_config in file_configs)
+                self.__chat_file_digest = hashlib.sha256(','.join(digests).encode()).hexdigest()
+            else:
+                # Uploads are hashed when saved, other files when first needed.
+                digest = self.__values.get('chat_file_digest', None)
+                self.__chat_file_digest = file_digest(self.chat_file) if digest is None else digest
+        return self.__chat_file_digest
+
+    def for_each_file(self) -> ['ChatConfig']:
+        # One chat config per file, for chats about many files at once.
+        chat_files = self.__values.get('chat_files', None)
+        if not chat_files:
+            return [self]
+        return [ChatConfig.from_dict(self.app_config,
+                                     {**self.__values,
+                                      'chat_files': None,
+                                      'chat_file_digest': None,
+                                      str(ChatVar.FILE.value): chat_file})
+                for chat_file in chat_files]
+
     @property
     def chat_template(self) -> str:
         return self._get_val_key_case_insensitive(ChatVar.TEMPLATE, self.app_config.default_chat_template)
@@ -1,10 +1,18 @@
 import logging
+from collections import deque
 from typing import Iterator
 
+import pypdf
+
 from langchain_community.document_loaders import PyPDFLoader, CSVLoader, Docx2txtLoader, TextLoader
 from langchain_core.document_loaders import BaseLoader
 from langchain_core.documents import Document
-from langchain_text_splitters import TextSplitter, RecursiveCharacterTextSplitter
+from langchain_text_splitters import TextSplitter, RecursiveCharacterTextSplitter, \
+    CharacterTextSplitter, TokenTextSplitter
+
+from .concurrency import Processes
+from .config import AppConfig
+from .metrics import Metrics
 
 logger = logging.getLogger(__name__)
 
@@ -21,30 +29,120 @@ class DocLoader:
         return ['.txt', '.csv', '.docx', '.pdf']
 
     @staticmethod
-    def yield_pages(input_file_path: str) -> Iterator[Document]:
+    def get_supported_text_splitters() -> [str]:
+        return ['recursive', 'character', 'token']
+
+    @staticmethod
+    def new_text_splitter(app_config: AppConfig = AppConfig()) -> TextSplitter:
+        # Record the offset of each chunk within its page, as metadata `start_index`.
+        kwargs = {'chunk_size': app_config.chunk_size,
+                  'chunk_overlap': app_config.chunk_overlap,
+                  'add_start_index': True}
+        text_splitter = app_config.text_splitter
+        if text_splitter == 'recursive':
+            return RecursiveCharacterTextSplitter(**kwargs)
+        if text_splitter == 'character':
+            return CharacterTextSplitter(**kwargs)
+        if text_splitter == 'token':
+            return TokenTextSplitter(**kwargs)
+        raise ValueError(f'Unsupported text splitter: `{text_splitter}`. '
+                         f'Supported: {DocLoader.get_supported_text_splitters()}')
+
+    @staticmethod
+    def yield_pages(input_file_path: str,
+                    text_splitter: TextSplitter = None,
+                    pages_per_task: int = 0) -> Iterator[Document]:
+        # Yields every chunk of every page. Each chunk records its `page`, `chunk` and `start_index`.
+        # Chunks are identified across document versions by the embeddings cache, which keys vectors by content.
+        # PDFs with more than `pages_per_task` pages are parsed in the process pool, when it is enabled.
+        if text_splitter is None:
+            text_splitter = DocLoader.new_text_splitter()
+        return Metrics.timed('parse', DocLoader.__yield_pages(input_file_path, text_splitter, pages_per_task))
+
+    @staticmethod
+    def __yield_pages(input_file_path: str, text_splitter: TextSplitter, pages_per_task: int) -> Iterator[Document]:
+        if pages_per_task > 0 and Processes.is_enabled() and input_file_path.lower().endswith('.pdf'):
+            total_pages = len(pypdf.PdfReader(input_file_path).pages)
+            if total_pages > pages_per_task:
+                yield from DocLoader.__yield_pdf_pages_in_parallel(
+                    input_file_path, text_splitter, total_pages, pages_per_task)
+                return
+
         loader = DocLoader.get_loader(input_file_path)
         page_iterator: Iterator[Document] = loader.lazy_load()
-        text_splitter: TextSplitter = RecursiveCharacterTextSplitter()
+        for page_index, page in enumerate(page_iterator):
+            yield from DocLoader.split_page(text_splitter, page_index, page)
+
+    @staticmethod
+    def split_page(text_splitter: TextSplitter, page_index: int, page: Document) -> [Document]:
+        # Not every loader numbers its pages, e.g. TextLoader.
+        metadata = {'page': page_index, **page.metadata}
+        # We pass only one page as an array
+        docs = text_splitter.create_documents([page.page_content], [metadata])
+        if docs is None or len(docs) == 0:
+            logger.debug(f'Skipped page: {page.metadata}')
+            return []
+        logger.debug(f' Parsed page: {page.metadata}, chunks: {len(docs)}')
+        for chunk_index, doc in enumerate(docs):
+            doc.metadata['chunk'] = chunk_index
+        return docs
+
+    @staticmethod
+    def __yield_pdf_pages_in_parallel(input_file_path: str,
+                                      text_splitter: TextSplitter,
+                                      total_pages: int,
+                                      pages_per_task: int) -> Iterator[Document]:
+        # Page ranges are parsed out of order, but yielded in page order. Only a few ranges
+        # are submitted ahead of the one being yielded, so that memory stays bounded.
+        logger.debug('Parsing %s pages in parallel: %s', total_pages, input_file_path)
+        ranges = iter(range(0, total_pages, pages_per_task))
+        pending = deque()
+
+        def submit_next() -> bool:
+            start = next(ranges, None)
+            if start is None:
+                return False
+            end = min(start + pages_per_task, total_pages)
+            pending.append(Processes.submit(_parse_pdf_pages, input_file_path, start, end, text_splitter))
+            return True
 
-        for page in page_iterator:
-            # We pass only one page as an array
-            docs = text_splitter.create_documents([page.page_content], [page.metadata])
-            if docs is None or len(docs) == 0:
-                logger.debug(f'Skipped page: {page.metadata}')
-                continue
-            logger.debug(f' Parsed page: {page.metadata}')
-            yield docs[0]
+        try:
+            for _ in range(Processes.get_max_workers() * 2):
+                if not submit_next():
+                    break
+            while len(pending) > 0:
+                docs = pending.popleft().result()
+                submit_next()
+                yield from docs
+        finally:
+            for future in pending:
+                future.cancel()
 
     @staticmethod
     def get_loader(input_file_path: str) -> BaseLoader:
-        input_file_path = input_file_path.lower()
-        if input_file_path.endswith('.txt'):
+        lower_case_path = input_file_path.lower()
+        if lower_case_path.endswith('.txt'):
             return TextLoader(input_file_path)
-        if input_file_path.endswith('.csv'):
+        if lower_case_path.endswith('.csv'):
             return CSVLoader(input_file_path)
-        if input_file_path.endswith('.docx'):
+        if lower_case_path.endswith('.docx'):
             return Docx2txtLoader(input_file_path)
-        if input_file_path.endswith('.pdf'):
+        if lower_case_path.endswith('.pdf'):
             return PyPDFLoader(input_file_path)
         raise UnsupportedFileTypeError(f'Unsupported file type: `{input_file_path}`. '
                                        f'Supported: {DocLoader.get_supported_file_extensions()}')
+
+
+def _parse_pdf_pages(input_file_path: str, start: int, end: int, text_splitter: TextSplitter) -> [Document]:
+    # Runs in the process pool. The metadata matches that of PyPDFLoader, for the main fields.
+    reader = pypdf.PdfReader(input_file_path)
+    total_pages = len(reader.pages)
+    docs = []
+    for page_index in range(start, end):
+        metadata = {'source': input_file_path,
+                    'total_pages': total_pages,
+                    'page': page_index,
+                    'page_label': reader.page_labels[page_index]}
+        page = Document(page_content=reader.pages[page_index].extract_text().strip(), metadata=metadata)
+        docs.extend(DocLoader.split_page(text_splitter, page_index, page))
+    return docs
@@ -0,0 +1,66 @@
+import json
+import logging
+import mmap
+import os
+
+import numpy as np
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+
+class MmapDocstore(Docstore):
+    # A read only docstore. Documents are stored as JSON, one after the other, in a file that is
+    # memory-mapped. Each is decoded only when retrieved, so the text of the other documents is
+    # held, if at all, by the OS page cache, rather than as Python objects. Only the ids are held
+    # in memory, here by id and, in the vectorstore, by position.
+    __data_file_name = 'docstore.bin'
+    __offsets_file_name = 'docstore.offsets.npy'
+    __ids_file_name = 'docstore.ids.json'
+
+    @staticmethod
+    def write(store_dir: str, ids: [str], docs: [Document]):
+        offsets = np.zeros(len(docs) + 1, dtype=np.int64)
+        with open(os.path.join(store_dir, MmapDocstore.__data_file_name), 'wb') as file:
+            for i, doc in enumerate(docs):
+                data = json.dumps({'page_content': doc.page_content, 'metadata': doc.metadata},
+                                  default=str).encode('utf-8')
+                file.write(data)
+                offsets[i + 1] = offsets[i] + len(data)
+        np.save(os.path.join(store_dir, MmapDocstore.__offsets_file_name), offsets)
+        with open(os.path.join(store_dir, MmapDocstore.__ids_file_name), 'w') as file:
+            json.dump(ids, file)
+
+    @staticmethod
+    def exists(store_dir: str) -> bool:
+        return all(os.path.exists(os.path.join(store_dir, name)) for name in [
+            MmapDocstore.__data_file_name, MmapDocstore.__offsets_file_name, MmapDocstore.__ids_file_name])
+
+    def __init__(self, store_dir: str):
+        self.__offsets = np.load(os.path.join(store_dir, MmapDocstore.__offsets_file_name), mmap_mode='r')
+        with open(os.path.join(store_dir, MmapDocstore.__ids_file_name)) as file:
+            self.__rows: dict[str, int] = {_id: row for row, _id in enumerate(json.load(file))}
+        data_file = os.path.join(store_dir, MmapDocstore.__data_file_name)
+        # Empty files can not be memory-mapped.
+        self.__data = b''
+        if os.path.getsize(data_file) > 0:
+            with open(data_file, 'rb') as file:
+                self.__data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def search(self, search: str) -> Document or str:
+        row = self.__rows.get(search, None)
+        if row is None:
+            return f"ID {search} not found."
+        data = json.loads(self.__data[int(self.__offsets[row]):int(self.__offsets[row + 1])])
+        return Document(id=search, page_content=data['page_content'], metadata=data['metadata'])
+
+    def get_ids(self) -> [str]:
+        return list(self.__rows.keys())
+
+    def to_in_memory_docstore(self) -> InMemoryDocstore:
+        return InMemoryDocstore({_id: self.search(_id) for _id in self.__rows.keys()})
+
+    def __len__(self) -> int:
+        return len(self.__rows)
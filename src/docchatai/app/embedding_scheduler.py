@@ -0,0 +1,83 @@
+import logging
+import random
+import threading
+import time
+
+from langchain_core.embeddings import Embeddings
+
+from .config import AppConfig
+from .metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingScheduler:
+    # Caps the number of embedding calls in flight, across all documents being loaded.
+    # Callers beyond the cap wait for a slot, which applies backpressure to the loaders.
+    __in_flight: threading.BoundedSemaphore or None = None
+    __batch_size = 16
+    __max_retries = 3
+    __retry_delay_seconds = 0.5
+
+    @staticmethod
+    def init(app_config: AppConfig):
+        logger.info("Initializing embedding scheduler, max in-flight calls: %s",
+                    app_config.max_concurrent_embeddings)
+        EmbeddingScheduler.__in_flight = threading.BoundedSemaphore(app_config.max_concurrent_embeddings)
+        EmbeddingScheduler.__batch_size = app_config.embedding_batch_size
+        EmbeddingScheduler.__max_retries = app_config.embedding_max_retries
+        EmbeddingScheduler.__retry_delay_seconds = app_config.embedding_retry_delay_seconds
+
+    @staticmethod
+    def schedule(embeddings: Embeddings) -> Embeddings:
+        if EmbeddingScheduler.__in_flight is None:
+            EmbeddingScheduler.init(AppConfig())
+        return _ScheduledEmbeddings(embeddings)
+
+    @staticmethod
+    def embed_documents(embeddings: Embeddings, texts: list[str]) -> list[list[float]]:
+        # Each call embeds at most one batch, so calls are of even size.
+        vectors = []
+        batch_size = EmbeddingScheduler.__batch_size
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+
+            def embed():
+                with EmbeddingScheduler.__in_flight, Metrics.span('embed'):
+                    return embeddings.embed_documents(batch)
+
+            vectors.extend(EmbeddingScheduler.__with_retry(embed))
+        return vectors
+
+    @staticmethod
+    def embed_query(embeddings: Embeddings, text: str) -> list[float]:
+        # Queries are not queued behind documents, as a user is waiting for each of them.
+        with Metrics.span('embed_query'):
+            return EmbeddingScheduler.__with_retry(lambda: embeddings.embed_query(text))
+
+    @staticmethod
+    def __with_retry(function):
+        attempt = 0
+        while True:
+            try:
+                return function()
+            except Exception as ex:
+                if attempt >= EmbeddingScheduler.__max_retries:
+                    raise
+                # Exponential backoff with full jitter, so that failed callers do not retry in lockstep.
+                delay = random.uniform(0, EmbeddingScheduler.__retry_delay_seconds * (2 ** attempt))
+                attempt += 1
+                logger.warning('Embedding failed, retry %s of %s in %.2f seconds. %s',
+                               attempt, EmbeddingScheduler.__max_retries, delay, ex)
+                time.sleep(delay)
+
+
+class _ScheduledEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings):
+        self.__embeddings = embeddings
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return EmbeddingScheduler.embed_documents(self.__embeddings, texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return EmbeddingScheduler.embed_query(self.__embeddings, text)
@@ -0,0 +1,299 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, Iterator, Optional, Sequence
+
+from langchain.storage import LocalFileStore
+from langchain_core.stores import ByteStore
+
+from .config import AppConfig
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingStores:
+    # Stores are shared by every loader and chat in the process, one of each kind per cache dir.
+    __lock = threading.Lock()
+    __stores: dict[tuple[str, str], ByteStore] = {}
+
+    @staticmethod
+    def of(app_config: AppConfig) -> ByteStore:
+        # For document embeddings. Recently used vectors are held in memory, in front of the disk store.
+        def create() -> ByteStore:
+            store = EmbeddingStores.__disk_store(app_config)
+            max_bytes = app_config.embeddings_memory_cache_max_bytes
+            return store if max_bytes <= 0 else LruByteStore(max_bytes, store)
+        return EmbeddingStores.__get_or_create('documents', app_config, create)
+
+    @staticmethod
+    def for_queries(app_config: AppConfig) -> ByteStore or None:
+        # Query embeddings are only held in memory, as most queries are not repeated.
+        max_bytes = app_config.query_embeddings_cache_max_bytes
+        if max_bytes <= 0:
+            return None
+        return EmbeddingStores.__get_or_create('queries', app_config, lambda: LruByteStore(max_bytes))
+
+    @staticmethod
+    def get_metrics() -> dict[str, dict[str, any]]:
+        with EmbeddingStores.__lock:
+            stores = list(EmbeddingStores.__stores.items())
+        return {kind: store.get_metrics() for (_, kind), store in stores if isinstance(store, LruByteStore)}
+
+    @staticmethod
+    def close():
+        with EmbeddingStores.__lock:
+            stores = list(EmbeddingStores.__stores.items())
+            EmbeddingStores.__stores.clear()
+        for (_, kind), store in stores:
+            if isinstance(store, LruByteStore):
+                logger.info('Embeddings cache: %s, %s', kind, store.get_metrics())
+            if hasattr(store, 'close'):
+                store.close()
+
+    @staticmethod
+    def __get_or_create(kind: str, app_config: AppConfig, create: Callable[[], ByteStore]) -> ByteStore:
+        key = (app_config.embeddings_cache_dir, kind)
+        with EmbeddingStores.__lock:
+            store = EmbeddingStores.__stores.get(key, None)
+            if store is None:
+                store = create()
+                EmbeddingStores.__stores[key] = store
+            return store
+
+    @staticmethod
+    def __disk_store(app_config: AppConfig) -> ByteStore:
+        backend = app_config.embeddings_cache_store
+        cache_dir = app_config.embeddings_cache_dir
+        if backend == 'file':
+            return LocalFileStore(cache_dir)
+        if backend == 'sqlite':
+            return SqliteByteStore(os.path.join(cache_dir, 'embeddings.sqlite'), app_config.embeddings_cache_max_bytes)
+        raise ValueError(f'Unsupported embeddings cache store: `{backend}`. Supported: file, sqlite')
+
+
+class LruByteStore(ByteStore):
+    # Holds the most recently used values in memory, within a byte budget, in front of an optional
+    # backing store. Values missing from memory are read from the backing store in one batch.
+    def __init__(self, max_bytes: int, store: ByteStore or None = None):
+        self.__max_bytes = max_bytes
+        self.__store = store
+        self.__lock = threading.Lock()
+        # In least recently used order.
+        self.__values: OrderedDict[str, bytes] = OrderedDict()
+        self.__size = 0
+        self.__hits = 0
+        self.__store_hits = 0
+        self.__misses = 0
+
+    def mget(self, keys: Sequence[str]) -> list[Optional[bytes]]:
+        values = {}
+        with self.__lock:
+            for key in keys:
+                value = self.__values.get(key, None)
+                if value is not None:
+                    self.__values.move_to_end(key)
+                    values[key] = value
+            self.__hits += len(values)
+        missing = [key for key in keys if key not in values]
+        if len(missing) == 0:
+            return [values[key] for key in keys]
+        found = {}
+        if self.__store is not None:
+            found = {key: value for key, value in zip(missing, self.__store.mget(missing)) if value is not None}
+        with self.__lock:
+            self.__store_hits += len(found)
+            self.__misses += len(missing) - len(found)
+            self.__put(found.items())
+        values.update(found)
+        return [values.get(key, None) for key in keys]
+
+    def mset(self, key_value_pairs: Sequence[tuple[str, bytes]]):
+        if self.__store is not None:
+            self.__store.mset(key_value_pairs)
+        with self.__lock:
+            self.__put(key_value_pairs)
+
+    def mdelete(self, keys: Sequence[str]):
+        with self.__lock:
+            for key in keys:
+                value = self.__values.pop(key, None)
+                if value is not None:
+                    self.__size -= LruByteStore.__size_of(key, value)
+        if self.__store is not None:
+            self.__store.mdelete(keys)
+
+    def yield_keys(self, *, prefix: Optional[str] = None) -> Iterator[str]:
+        if self.__store is not None:
+            yield from self.__store.yield_keys(prefix=prefix)
+            return
+        with self.__lock:
+            keys = list(self.__values.keys())
+        yield from (key for key in keys if prefix is None or key.startswith(prefix))
+
+    def get_metrics(self) -> dict[str, any]:
+        with self.__lock:
+            requests = self.__hits + self.__store_hits + self.__misses
+            return {
+                'entries': len(self.__values),
+                'size_bytes': self.__size,
+                'max_bytes': self.__max_bytes,
+                'hits': self.__hits,
+                'store_hits': self.__store_hits,
+                'misses': self.__misses,
+                'hit_rate': 0.0 if requests == 0 else self.__hits / requests,
+            }
+
+    def get_size_in_bytes(self) -> int:
+        return self.__size
+
+    def close(self):
+        if hasattr(self.__store, 'close'):
+            self.__store.close()
+
+    def __len__(self) -> int:
+        return len(self.__values)
+
+    def __put(self, key_value_pairs: Iterable[tuple[str, bytes]]):
+        for key, value in key_value_pairs:
+            previous = self.__values.pop(key, None)
+            if previous is not None:
+                self.__size -= LruByteStore.__size_of(key, previous)
+            size = LruByteStore.__size_of(key, value)
+            if size > self.__max_bytes:
+                continue
+            self.__values[key] = value
+            self.__size += size
+        while self.__size > self.__max_bytes:
+            key, value = self.__values.popitem(last=False)
+            self.__size -= LruByteStore.__size_of(key, value)
+
+    @staticmethod
+    def __size_of(key: str, value: bytes) -> int:
+        return len(key) + len(value)
+
+
+class SqliteByteStore(ByteStore):
+    # Keeps every value in a single file, so that a batch of keys is read or written in one statement,
+    # rather than one file per key. When over max_bytes, the least recently used values are evicted.
+    __max_batch_size = 500
+
+    def __init__(self, db_file: str, max_bytes: int = 0):
+        os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        self.__max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(db_file, check_same_thread=False)
+        with self.__lock:
+            # Must be set before the first table is created. Lets evictions return their pages to the OS.
+            self.__connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self.__connection.execute('PRAGMA journal_mode = WAL')
+            self.__connection.execute('PRAGMA synchronous = NORMAL')
+            with self.__connection:
+                self.__connection.execute(
+                    'CREATE TABLE IF NOT EXISTS entries ('
+                    'key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)')
+                self.__connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+            self.__size = self.__connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def mget(self, keys: Sequence[str]) -> list[Optional[bytes]]:
+        values = {}
+        with self.__lock:
+            for batch in SqliteByteStore.__batches(keys):
+                rows = self.__connection.execute(
+                    f'SELECT key, value FROM entries WHERE key IN ({SqliteByteStore.__params(batch)})',
+                    batch).fetchall()
+                values.update(rows)
+                if self.__max_bytes > 0 and len(rows) > 0:
+                    # Access times are only needed for eviction.
+                    found = [row[0] for row in rows]
+                    with self.__connection:
+                        self.__connection.execute(
+                            f'UPDATE entries SET accessed = ? WHERE key IN ({SqliteByteStore.__params(found)})',
+                            [time.time(), *found])
+        return [values.get(key, None) for key in keys]
+
+    def mset(self, key_value_pairs: Sequence[tuple[str, bytes]]):
+        # The last value of a key repeated in the batch wins.
+        pairs = dict(key_value_pairs)
+        now = time.time()
+        with self.__lock:
+            with self.__connection:
+                for batch in SqliteByteStore.__batches(list(pairs.keys())):
+                    self.__size -= self.__connection.execute(
+                        f'SELECT COALESCE(SUM(size), 0) FROM entries '
+                        f'WHERE key IN ({SqliteByteStore.__params(batch)})', batch).fetchone()[0]
+                self.__connection.executemany(
+                    'INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)',
+                    [(key, value, len(value), now) for key, value in pairs.items()])
+            self.__size += sum(len(value) for value in pairs.values())
+            if 0 < self.__max_bytes < self.__size:
+                self.__evict()
+
+    def mdelete(self, keys: Sequence[str]):
+        with self.__lock, self.__connection:
+            for batch in SqliteByteStore.__batches(keys):
+                params = SqliteByteStore.__params(batch)
+                self.__size -= self.__connection.execute(
+                    f'SELECT COALESCE(SUM(size), 0) FROM entries WHERE key IN ({params})', batch).fetchone()[0]
+                self.__connection.execute(f'DELETE FROM entries WHERE key IN ({params})', batch)
+
+    def yield_keys(self, *, prefix: Optional[str] = None) -> Iterator[str]:
+        with self.__lock:
+            if prefix is None:
+                rows = self.__connection.execute('SELECT key FROM entries').fetchall()
+            else:
+                rows = self.__connection.execute(
+                    "SELECT key FROM entries WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)).fetchall()
+        for row in rows:
+            yield row[0]
+
+    def compact(self):
+        # Rewrites the file, to reclaim the space left by deleted and replaced values.
+        with self.__lock:
+            self.__connection.execute('VACUUM')
+
+    def get_size_in_bytes(self) -> int:
+        return self.__size
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return self.__connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def __evict(self):
+        # Evict down to 90% of the budget, so that each eviction makes room for many more values.
+        target = int(self.__max_bytes * 0.9)
+        evicted = 0
+        with self.__connection:
+            while self.__size > target:
+                rows = self.__connection.execute(
+                    'SELECT key, size FROM entries ORDER BY accessed LIMIT ?',
+                    (SqliteByteStore.__max_batch_size,)).fetchall()
+                if len(rows) == 0:
+                    break
+                keys = []
+                for key, size in rows:
+                    if self.__size <= target:
+                        break
+                    keys.append(key)
+                    self.__size -= size
+                self.__connection.execute(
+                    f'DELETE FROM entries WHERE key IN ({SqliteByteStore.__params(keys)})', keys)
+                evicted += len(keys)
+        self.__connection.execute('PRAGMA incremental_vacuum')
+        logger.debug('Evicted %s embeddings, size: %s, max: %s', evicted, self.__size, self.__max_bytes)
+
+    @staticmethod
+    def __batches(keys: Sequence[str]) -> Iterator[list[str]]:
+        # Keeps the number of parameters per statement below the SQLite limit.
+        for start in range(0, len(keys), SqliteByteStore.__max_batch_size):
+            yield list(keys[start:start + SqliteByteStore.__max_batch_size])
+
+    @staticmethod
+    def __params(keys: Sequence[str]) -> str:
+        return ', '.join('?' * len(keys))
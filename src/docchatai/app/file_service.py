@@ -1,34 +1,61 @@
+import hashlib
 import logging
 import os
+import shutil
+import uuid
 from typing import Union
 
-from pyu.io.file import create_file
-
+from docchatai.app.doc_loader import DocLoader, UnsupportedFileTypeError
 from docchatai.app.utils import safe_unique_path_name
 
 logger = logging.getLogger(__name__)
 
+class UploadTooLargeError(Exception):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.message = args[0]
+
+
 class UploadedFile:
-    def __init__(self, name: str, original_filename: str, output_path: str):
+    def __init__(self, name: str, original_filename: str, output_path: str, digest: str or None = None):
         self.name = name
         self.original_filename = original_filename
         self.output_path = output_path
+        # The SHA-256 of the file's content.
+        self.digest = digest
 
     def to_dict(self) -> dict[str, str]:
         return {
             "name": self.name,
             "original_filename": self.original_filename,
-            "output_path": self.output_path
+            "output_path": self.output_path,
+            "digest": self.digest
         }
 
     def __str__(self):
         return f"UploadedFile({self.to_dict()})"
 
 class FileService:
-    def __init__(self, output_dir):
+    # Uploads are stored once, under the digest of their content, in the blobs dir.
+    # Each session references its uploads through hard links to the blobs.
+    __blobs_dir_name = 'blobs'
+
+    # Files must start with these bytes. Text files are only checked for being text.
+    __magic_bytes = {'.pdf': b'%PDF-', '.docx': b'PK\x03\x04'}
+    __head_size = max(len(magic_bytes) for magic_bytes in __magic_bytes.values())
+
+    def __init__(self,
+                 output_dir,
+                 chunk_size: int = 1024 * 1024,
+                 max_file_bytes: int = 0,
+                 max_session_bytes: int = 0):
         if not output_dir:
             raise ValueError('output dir is required')
         self.__output_dir = output_dir
+        self.__chunk_size = chunk_size
+        # Zero means no limit.
+        self.__max_file_bytes = max_file_bytes
+        self.__max_session_bytes = max_session_bytes
 
     def _get_upload_file(self, session_id: str, filename: str) -> str:
         if not session_id:
@@ -37,6 +64,10 @@ class FileService:
             raise ValueError('file name is required')
         return os.path.join(self.__output_dir, session_id, filename)
 
+    def _get_blob_file(self, digest: str, ext: str) -> str:
+        # The extension is kept, as documents are loaded according to their extension.
+        return os.path.join(self.__output_dir, self.__blobs_dir_name, f'{digest}{ext.lower()}')
+
     def list_files(self, session_id: str) -> list[str]:
         if not session_id:
             raise ValueError('session id is required')
@@ -50,18 +81,114 @@ class FileService:
             return None
         if not uploaded_file.filename:
             return None
+        ext = os.path.splitext(uploaded_file.filename)[1].lower()
+        if ext not in DocLoader.get_supported_file_extensions():
+            raise UnsupportedFileTypeError(f'Unsupported file type: `{uploaded_file.filename}`. '
+                                           f'Supported: {DocLoader.get_supported_file_extensions()}')
         filepath = self._get_upload_file(session_id, safe_unique_path_name(uploaded_file.filename))
         logger.debug(f"Will save: {input_name} to {filepath}")
-        create_file(filepath)
-        uploaded_file.save(filepath)
-        return UploadedFile(input_name, uploaded_file.filename, filepath)
+        digest, blob_path = self._save_blob(uploaded_file, self._get_max_bytes(session_id))
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # Never write into an existing path, as it may be a link to a blob shared by other sessions.
+        # Link, or copy, to a temporary name, then replace the path with it.
+        temp_path = f'{filepath}.{uuid.uuid4().hex}.tmp'
+        try:
+            try:
+                os.link(blob_path, temp_path)
+            except OSError as ex:
+                # E.g. the file system does not support hard links.
+                logger.debug('Could not link: %s, will copy it instead. %s', blob_path, ex)
+                shutil.copyfile(blob_path, temp_path)
+            os.replace(temp_path, filepath)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return UploadedFile(input_name, uploaded_file.filename, filepath, digest)
+
+    def _get_max_bytes(self, session_id: str) -> int:
+        # The max size of the next file uploaded by the session. Zero means no limit.
+        if self.__max_session_bytes <= 0:
+            return self.__max_file_bytes
+        used_bytes = sum(os.path.getsize(path) for path in self.list_files(session_id))
+        remaining_bytes = self.__max_session_bytes - used_bytes
+        if remaining_bytes <= 0:
+            raise UploadTooLargeError('Upload quota exceeded, for this session')
+        return remaining_bytes if self.__max_file_bytes <= 0 else min(remaining_bytes, self.__max_file_bytes)
+
+    def _save_blob(self, uploaded_file, max_bytes: int = 0) -> tuple[str, str]:
+        # In one pass, the file's type is checked from its first bytes, its size is checked
+        # against the limit, and it is hashed while being written to a temporary file.
+        # The temporary file then becomes the blob, unless the blob already exists.
+        # By now the request has been read, and large files spooled to disk, by the form parser.
+        # So these checks spare the blob and its loading, not the upload. Only the request limit,
+        # MAX_CONTENT_LENGTH, is enforced while the request is read.
+        ext = os.path.splitext(uploaded_file.filename)[1]
+        blobs_dir = os.path.join(self.__output_dir, self.__blobs_dir_name)
+        os.makedirs(blobs_dir, exist_ok=True)
+        temp_path = os.path.join(blobs_dir, f'.{uuid.uuid4().hex}.tmp')
+        sha256 = hashlib.sha256()
+        size = 0
+        # Reads may be short. So the type is checked once enough bytes for it have been read.
+        head = b''
+        is_type_checked = False
+        try:
+            with open(temp_path, 'wb') as file:
+                for chunk in iter(lambda: uploaded_file.stream.read(self.__chunk_size), b''):
+                    if is_type_checked is False:
+                        head += chunk
+                        if len(head) >= FileService.__head_size:
+                            FileService._check_type(uploaded_file.filename, ext, head)
+                            is_type_checked = True
+                    size += len(chunk)
+                    if 0 < max_bytes < size:
+                        raise UploadTooLargeError(
+                            f'File too large: `{uploaded_file.filename}`. Max: {max_bytes} bytes')
+                    sha256.update(chunk)
+                    file.write(chunk)
+            if size == 0:
+                raise UnsupportedFileTypeError(f'The file `{uploaded_file.filename}` is empty')
+            if is_type_checked is False:
+                FileService._check_type(uploaded_file.filename, ext, head)
+            digest = sha256.hexdigest()
+            blob_path = self._get_blob_file(digest, ext)
+            if os.path.exists(blob_path):
+                logger.debug(f"Already saved: {blob_path}")
+            else:
+                os.replace(temp_path, blob_path)
+            return digest, blob_path
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @staticmethod
+    def _check_type(filename: str, ext: str, head: bytes):
+        magic_bytes = FileService.__magic_bytes.get(ext.lower(), None)
+        if magic_bytes is None:
+            is_valid = b'\x00' not in head
+        else:
+            is_valid = head.startswith(magic_bytes)
+        if not is_valid:
+            raise UnsupportedFileTypeError(f'The content of `{filename}` is not of type: {ext}')
 
     def save_files(self, session_id, files: dict[str, any]) -> [UploadedFile]:
+        # All or nothing. If any file is rejected, the files already saved by this call are removed.
         saved_files = []
         input_names = files.keys()
-        for input_name in input_names:
-            saved_file = self._save_file(session_id, input_name, files.get(input_name))
-            if not saved_file:
-                continue
-            saved_files.append(saved_file)
+        try:
+            for input_name in input_names:
+                # An input may hold many files, e.g. <input type="file" multiple>
+                uploaded_files = files.getlist(input_name) if hasattr(files, 'getlist') else [files.get(input_name)]
+                for uploaded_file in uploaded_files:
+                    saved_file = self._save_file(session_id, input_name, uploaded_file)
+                    if not saved_file:
+                        continue
+                    saved_files.append(saved_file)
+        except Exception:
+            for saved_file in saved_files:
+                # Only the session's link is removed. The blob may be shared by other sessions.
+                try:
+                    os.remove(saved_file.output_path)
+                except OSError as ex:
+                    logger.warning('Failed to remove: %s. %s', saved_file.output_path, ex)
+            raise
         return saved_files
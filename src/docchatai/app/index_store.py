@@ -0,0 +1,88 @@
+import logging
+import os
+import shutil
+import uuid
+
+import faiss
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+
+from .config import ChatConfig
+from .docstores import MmapDocstore
+from .utils import safe_unique_key
+
+logger = logging.getLogger(__name__)
+
+
+class IndexStore:
+    __index_name = 'index'
+
+    @staticmethod
+    def of(chat_config: ChatConfig) -> 'IndexStore':
+        return IndexStore(chat_config.app_config.index_cache_dir, chat_config.app_config.mmap_docstore)
+
+    @staticmethod
+    def key(chat_config: ChatConfig) -> str:
+        # Indexes built with different embeddings, chunking or index types can not be reused for each other.
+        # Providers may serve models of the same name, with different embeddings.
+        app_config = chat_config.app_config
+        model = f'{chat_config.chat_model_provider}-{chat_config.chat_model_name}'
+        chunking = f'{app_config.text_splitter}-{app_config.chunk_size}-{app_config.chunk_overlap}'
+        index_type = f'{app_config.vector_index_type}-{app_config.vector_encoding}'
+        return safe_unique_key(chat_config.chat_file_digest, f'{model}-{chunking}-{index_type}')
+
+    def __init__(self, store_dir: str, mmap_docstore: bool = True):
+        if not store_dir:
+            raise ValueError('store dir is required')
+        self.__store_dir = store_dir
+        self.__mmap_docstore = mmap_docstore
+
+    def _get_index_dir(self, key: str) -> str:
+        return os.path.join(self.__store_dir, key)
+
+    def contains(self, key: str) -> bool:
+        index_dir = self._get_index_dir(key)
+        return os.path.exists(os.path.join(index_dir, f'{self.__index_name}.faiss')) and MmapDocstore.exists(index_dir)
+
+    def load(self, key: str, embeddings: Embeddings) -> FAISS or None:
+        if not self.contains(key):
+            return None
+        index_dir = self._get_index_dir(key)
+        try:
+            # Only the inverted lists of IVF indexes are memory-mapped, so IVF vectors are read from disk
+            # as they are searched. Flat and HNSW indexes are still read into RAM whole.
+            index = faiss.read_index(os.path.join(index_dir, f'{self.__index_name}.faiss'),
+                                     faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            docstore = MmapDocstore(index_dir)
+        except Exception as ex:
+            logger.warning('Failed to load index: %s. %s', index_dir, ex)
+            return None
+        # The documents are stored in the order of their vectors.
+        index_to_docstore_id = dict(enumerate(docstore.get_ids()))
+        if not self.__mmap_docstore:
+            docstore = docstore.to_in_memory_docstore()
+        logger.debug('Loaded index: %s, size: %s', index_dir, index.ntotal)
+        return FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+    def save(self, key: str, vectorstore: FAISS) -> bool:
+        # Returns True if the index is saved, by this or an earlier call.
+        index_dir = self._get_index_dir(key)
+        # Save to a temporary dir, then rename it, so that readers never see a partial index.
+        temp_dir = f'{index_dir}.{uuid.uuid4().hex}.tmp'
+        try:
+            os.makedirs(temp_dir)
+            faiss.write_index(vectorstore.index, os.path.join(temp_dir, f'{self.__index_name}.faiss'))
+            ids = [vectorstore.index_to_docstore_id[i] for i in range(len(vectorstore.index_to_docstore_id))]
+            MmapDocstore.write(temp_dir, ids, [vectorstore.docstore.search(_id) for _id in ids])
+            if self.contains(key):
+                logger.debug('Index already saved: %s', index_dir)
+                return True
+            shutil.rmtree(index_dir, ignore_errors=True)
+            os.replace(temp_dir, index_dir)
+            logger.debug('Saved index: %s, size: %s', index_dir, vectorstore.index.ntotal)
+            return True
+        except Exception as ex:
+            logger.error('Failed to save index: %s. %s', index_dir, ex, exc_info=True)
+            return False
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
@@ -0,0 +1,242 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from typing import Callable, Iterator
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from .config import AppConfig
+
+logger = logging.getLogger(__name__)
+
+# In seconds. From a fast vector search to a slow document load.
+_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# name, type, labels, value
+Sample = tuple[str, str, dict[str, str], float]
+
+
+class _Histogram:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # The last count is for values beyond the last bucket.
+        self.__counts = [0] * (len(_buckets) + 1)
+        self.__sum = 0.0
+
+    def observe(self, value: float):
+        i = bisect_left(_buckets, value)
+        with self.__lock:
+            self.__counts[i] += 1
+            self.__sum += value
+
+    def samples(self, name: str, labels: dict[str, str]) -> [Sample]:
+        with self.__lock:
+            counts, total = list(self.__counts), self.__sum
+        samples = []
+        cumulative = 0
+        for le, count in zip([*_buckets, '+Inf'], counts):
+            cumulative += count
+            samples.append((f'{name}_bucket', 'histogram', {**labels, 'le': str(le)}, cumulative))
+        samples.append((f'{name}_sum', 'histogram', labels, total))
+        samples.append((f'{name}_count', 'histogram', labels, cumulative))
+        return samples
+
+
+class _Span:
+    __slots__ = ('__stage', '__started')
+
+    def __init__(self, stage: str):
+        self.__stage = stage
+        self.__started = 0.0
+
+    def __enter__(self):
+        self.__started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        Metrics.observe(self.__stage, time.perf_counter() - self.__started)
+
+
+class Metrics:
+    # Times each stage of loading documents and answering requests, into histograms. Gauges, such
+    # as queue depths and cache hit rates, are read from registered collectors only when scraped,
+    # so they add nothing to the hot path. Exposed in the Prometheus text format.
+    STAGE = 'docchatai_stage_seconds'
+    REQUEST = 'docchatai_request_seconds'
+    __enabled = True
+    __lock = threading.Lock()
+    __histograms: dict[tuple[str, str, str], _Histogram] = {}
+    __collectors: dict[str, Callable[[], list[Sample]]] = {}
+
+    @staticmethod
+    def init(app_config: AppConfig):
+        Metrics.__enabled = app_config.metrics_enabled
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return Metrics.__enabled
+
+    @staticmethod
+    def span(stage: str):
+        # Usage: with Metrics.span('parse'): ...
+        return _Span(stage) if Metrics.__enabled else nullcontext()
+
+    @staticmethod
+    def timed(stage: str, iterator: Iterator) -> Iterator:
+        # Times only the time spent producing items, not the time the consumer spends on them.
+        if not Metrics.__enabled:
+            yield from iterator
+            return
+        spent = 0.0
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                spent += time.perf_counter() - started
+            yield item
+        Metrics.observe(stage, spent)
+
+    @staticmethod
+    def observe(stage: str, seconds: float):
+        Metrics.__observe(Metrics.STAGE, 'stage', stage, seconds)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Span: %s, seconds: %.4f', stage, seconds)
+
+    @staticmethod
+    def observe_request(endpoint: str, seconds: float):
+        Metrics.__observe(Metrics.REQUEST, 'endpoint', endpoint, seconds)
+
+    @staticmethod
+    def register(name: str, collector: Callable[[], list[Sample]]):
+        # Replaces any collector of the same name.
+        with Metrics.__lock:
+            Metrics.__collectors[name] = collector
+
+    @staticmethod
+    def samples_of(prefix: str, values: dict[str, any], labels: dict[str, str] = None,
+                   counters: tuple[str, ...] = ()) -> [Sample]:
+        # Numeric values become gauges, or counters if named in counters.
+        samples = []
+        for key, value in values.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if key in counters:
+                samples.append((f'{prefix}_{key}_total', 'counter', labels or {}, value))
+            else:
+                samples.append((f'{prefix}_{key}', 'gauge', labels or {}, value))
+        return samples
+
+    @staticmethod
+    def to_prometheus() -> str:
+        with Metrics.__lock:
+            histograms = list(Metrics.__histograms.items())
+            collectors = list(Metrics.__collectors.items())
+        samples = []
+        for (name, label, value), histogram in sorted(histograms, key=lambda item: item[0]):
+            samples.extend(histogram.samples(name, {label: value}))
+        collected = []
+        for name, collector in collectors:
+            try:
+                collected.extend(collector())
+            except Exception as ex:
+                logger.warning('Failed to collect metrics: %s. %s', name, ex)
+        # The samples of each metric must be together. Sorting is stable, so labels keep their order.
+        samples.extend(sorted(collected, key=lambda sample: sample[0]))
+        return Metrics.__format(samples)
+
+    @staticmethod
+    def __observe(name: str, label: str, value: str, seconds: float):
+        if not Metrics.__enabled:
+            return
+        key = (name, label, value)
+        histogram = Metrics.__histograms.get(key, None)
+        if histogram is None:
+            with Metrics.__lock:
+                histogram = Metrics.__histograms.setdefault(key, _Histogram())
+        histogram.observe(seconds)
+
+    @staticmethod
+    def __format(samples: [Sample]) -> str:
+        lines = []
+        typed = set()
+        for name, metric_type, labels, value in samples:
+            # Histograms are typed by family, without their _bucket, _sum or _count suffix.
+            family = name.rsplit('_', 1)[0] if metric_type == 'histogram' else name
+            if family not in typed:
+                typed.add(family)
+                lines.append(f'# TYPE {family} {metric_type}')
+            label_text = ','.join(f'{k}="{Metrics.__escape(str(v))}"' for k, v in labels.items())
+            lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def __escape(value: str) -> str:
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class StageTimer(BaseCallbackHandler):
+    # Times the stages of a chat chain: retrieval, prompt assembly and generation,
+    # including the time to the first generated token, when streaming.
+    run_inline = True
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # By run id: the stage, and when it started.
+        self.__runs: dict[UUID, tuple[str, float]] = {}
+        self.__first_token_pending: set[UUID] = set()
+
+    def on_retriever_start(self, serialized, query, *, run_id: UUID, **kwargs):
+        self.__start(run_id, 'retrieve')
+
+    def on_retriever_end(self, documents, *, run_id: UUID, **kwargs):
+        self.__end(run_id)
+
+    def on_chain_start(self, serialized, inputs, *, run_id: UUID, **kwargs):
+        if kwargs.get('run_type', None) == 'prompt':
+            self.__start(run_id, 'prompt')
+
+    def on_chain_end(self, outputs, *, run_id: UUID, **kwargs):
+        self.__end(run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs):
+        self.__start(run_id, 'generate')
+        with self.__lock:
+            self.__first_token_pending.add(run_id)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs):
+        with self.__lock:
+            if run_id not in self.__first_token_pending:
+                return
+            self.__first_token_pending.discard(run_id)
+            run = self.__runs.get(run_id, None)
+        if run is not None:
+            Metrics.observe('first_token', time.perf_counter() - run[1])
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs):
+        self.__end(run_id)
+
+    def on_chain_error(self, error, *, run_id: UUID, **kwargs):
+        self.__end(run_id, False)
+
+    def on_retriever_error(self, error, *, run_id: UUID, **kwargs):
+        self.__end(run_id, False)
+
+    def on_llm_error(self, error, *, run_id: UUID, **kwargs):
+        self.__end(run_id, False)
+
+    def __start(self, run_id: UUID, stage: str):
+        with self.__lock:
+            self.__runs[run_id] = (stage, time.perf_counter())
+
+    def __end(self, run_id: UUID, observe: bool = True):
+        with self.__lock:
+            run = self.__runs.pop(run_id, None)
+            self.__first_token_pending.discard(run_id)
+        if run is not None and observe:
+            Metrics.observe(run[0], time.perf_counter() - run[1])
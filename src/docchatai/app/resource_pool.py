@@ -0,0 +1,123 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+from .concurrency import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class _PoolEntry:
+    def __init__(self, value: any):
+        self.value = value
+        self.ref_count = 0
+        self.size = 0
+
+
+class ResourcePool:
+    # Resources are created once per key, and shared by every caller of acquire() for that key.
+    # A resource becomes idle once all its holders have released it. Idle resources are evicted,
+    # least recently used first, when there are too many of them or the pool is over budget.
+    def __init__(self,
+                 max_idle_items: int = 16,
+                 max_bytes: int = 0,
+                 size_of: Callable[[any], int] = lambda value: 0,
+                 on_evict: Callable[[Hashable, any], None] = lambda key, value: None):
+        self.__max_idle_items = max_idle_items
+        self.__max_bytes = max_bytes
+        self.__size_of = size_of
+        self.__on_evict = on_evict
+        self.__lock = threading.Lock()
+        self.__single_flight = SingleFlight()
+        # In least recently used order.
+        self.__entries: OrderedDict[Hashable, _PoolEntry] = OrderedDict()
+
+    def acquire(self, key: Hashable, create: Callable[[], any]) -> any:
+        while True:
+            with self.__lock:
+                entry = self.__entries.get(key, None)
+                if entry is not None:
+                    self.__mark_in_use(entry)
+                    self.__entries.move_to_end(key)
+                    return entry.value
+
+            # Concurrent callers for the same key wait for a single creation. The resource is pooled
+            # before they are released, so no caller ever creates a duplicate. Should it be evicted
+            # before they take it, it is created again.
+            self.__single_flight.do(key, self.__create, key, create)
+
+    def release(self, key: Hashable):
+        with self.__lock:
+            entry = self.__entries.get(key, None)
+            if entry is None:
+                logger.warning('Released resource is not in pool: %s', key)
+                return
+            entry.ref_count = max(0, entry.ref_count - 1)
+            if entry.ref_count == 0:
+                # Resources may grow while in use, e.g. vectorstores that are still loading.
+                entry.size = self.__size_of(entry.value)
+                self.__entries.move_to_end(key)
+            evicted = self.__collect_evictable()
+        self.__evict(evicted)
+
+    def evict_idle(self):
+        with self.__lock:
+            evicted = [(key, entry) for key, entry in self.__entries.items() if entry.ref_count == 0]
+            for key, _ in evicted:
+                del self.__entries[key]
+        self.__evict(evicted)
+
+    def get_ref_count(self, key: Hashable) -> int:
+        with self.__lock:
+            entry = self.__entries.get(key, None)
+            return 0 if entry is None else entry.ref_count
+
+    def get_size_in_bytes(self) -> int:
+        with self.__lock:
+            return sum(entry.size for entry in self.__entries.values())
+
+    def get_values(self) -> [any]:
+        with self.__lock:
+            return [entry.value for entry in self.__entries.values()]
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __create(self, key: Hashable, create: Callable[[], any]):
+        with self.__lock:
+            if key in self.__entries:
+                return
+        value = create()
+        with self.__lock:
+            self.__entries[key] = _PoolEntry(value)
+
+    @staticmethod
+    def __mark_in_use(entry: _PoolEntry):
+        if entry.ref_count == 0:
+            # Only idle resources are counted. Resources in use may be counted as part of the
+            # idle resources holding them, and are sized again once released.
+            entry.size = 0
+        entry.ref_count += 1
+
+    def __collect_evictable(self) -> [tuple[Hashable, _PoolEntry]]:
+        idle_keys = [key for key, entry in self.__entries.items() if entry.ref_count == 0]
+        total_bytes = sum(entry.size for entry in self.__entries.values())
+        evicted = []
+        for key in idle_keys:
+            too_many = len(idle_keys) - len(evicted) > self.__max_idle_items
+            too_large = 0 < self.__max_bytes < total_bytes
+            if not too_many and not too_large:
+                break
+            entry = self.__entries.pop(key)
+            total_bytes -= entry.size
+            evicted.append((key, entry))
+        return evicted
+
+    def __evict(self, evicted: [tuple[Hashable, _PoolEntry]]):
+        for key, entry in evicted:
+            logger.debug('Evicting resource: %s, size: %s', key, entry.size)
+            try:
+                self.__on_evict(key, entry.value)
+            except Exception as ex:
+                logger.error('Error evicting resource: %s. %s', key, ex, exc_info=True)
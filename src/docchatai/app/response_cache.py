@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from .concurrency import Threads
+from .config import ChatConfig
+from .utils import safe_unique_key
+
+logger = logging.getLogger(__name__)
+
+_whitespace_pattern = re.compile(r'\s+')
+
+
+class _CachedResponse:
+    def __init__(self, request: str, response: str, vector: np.ndarray, created: float):
+        self.request = request
+        self.response = response
+        self.vector = vector
+        self.created = created
+
+
+class ResponseCache:
+    # Caches responses to requests about one document, for one model and template.
+    # A request hits the cache if it matches an earlier request after normalisation,
+    # or if its embedding is at least `threshold` similar (cosine) to an earlier one.
+    @staticmethod
+    def of(chat_config: ChatConfig, embeddings: Embeddings) -> 'ResponseCache':
+        app_config = chat_config.app_config
+        # The provider is part of the key, as providers may serve models of the same name.
+        model = f'{chat_config.chat_model_provider}-{chat_config.chat_model_name}'
+        key = safe_unique_key(chat_config.chat_file_digest, f'{model}-{chat_config.chat_template}')
+        return ResponseCache(embeddings,
+                             app_config.response_cache_similarity_threshold,
+                             app_config.response_cache_ttl_seconds,
+                             app_config.response_cache_max_entries,
+                             os.path.join(app_config.response_cache_dir, f'{key}.npz'))
+
+    @staticmethod
+    def normalize(request: str) -> str:
+        return _whitespace_pattern.sub(' ', request).strip().rstrip('?!. ').lower()
+
+    def __init__(self,
+                 embeddings: Embeddings or None,
+                 threshold: float = 0.95,
+                 ttl_seconds: int = 86400,
+                 max_entries: int = 1000,
+                 file_path: str or None = None):
+        self.__embeddings = embeddings
+        self.__threshold = threshold
+        self.__ttl_seconds = ttl_seconds
+        self.__max_entries = max_entries
+        self.__file_path = file_path
+        self.__lock = threading.Lock()
+        # By normalised request, in least recently used order.
+        self.__entries: OrderedDict[str, _CachedResponse] = OrderedDict()
+        self.__save_pending = False
+        self.__hits = 0
+        self.__misses = 0
+        self.__load()
+
+    def get(self, request: str) -> str or None:
+        normalized = ResponseCache.normalize(request)
+        with self.__lock:
+            self.__remove_expired()
+            entry = self.__entries.get(normalized, None)
+            if entry is not None:
+                self.__entries.move_to_end(normalized)
+                self.__hits += 1
+                return entry.response
+            if self.__embeddings is None or len(self.__entries) == 0:
+                self.__misses += 1
+                return None
+
+        vector = self.__embed(request)
+        with self.__lock:
+            keys = list(self.__entries.keys())
+            if len(keys) == 0:
+                self.__misses += 1
+                return None
+            matrix = np.stack([self.__entries[key].vector for key in keys])
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.__threshold:
+                self.__misses += 1
+                return None
+            logger.debug('Similar request found, similarity: %.4f, request: %s',
+                         similarities[best], self.__entries[keys[best]].request)
+            self.__entries.move_to_end(keys[best])
+            self.__hits += 1
+            return self.__entries[keys[best]].response
+
+    def put(self, request: str, response: str):
+        normalized = ResponseCache.normalize(request)
+        vector = None if self.__embeddings is None else self.__embed(request)
+        with self.__lock:
+            self.__entries[normalized] = _CachedResponse(request, response, vector, time.time())
+            self.__entries.move_to_end(normalized)
+            while len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+            schedule_save = self.__file_path is not None and self.__save_pending is False
+            self.__save_pending = True
+        if schedule_save:
+            # Saves are coalesced, so that a burst of puts results in a single save.
+            Threads.submit(self.__save)
+
+    def get_hits(self) -> int:
+        return self.__hits
+
+    def get_misses(self) -> int:
+        return self.__misses
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __embed(self, request: str) -> np.ndarray:
+        vector = np.asarray(self.__embeddings.embed_query(request), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector if norm == 0 else vector / norm
+
+    def __remove_expired(self):
+        expired_before = time.time() - self.__ttl_seconds
+        expired = [key for key, entry in self.__entries.items() if entry.created < expired_before]
+        for key in expired:
+            del self.__entries[key]
+
+    def __save(self):
+        with self.__lock:
+            self.__save_pending = False
+            entries = list(self.__entries.values())
+        if len(entries) == 0:
+            return
+        metadata = [{'request': e.request, 'response': e.response, 'created': e.created} for e in entries]
+        has_vectors = all(e.vector is not None for e in entries)
+        vectors = np.stack([e.vector for e in entries]) if has_vectors else np.empty((0, 0), dtype=np.float32)
+        os.makedirs(os.path.dirname(self.__file_path), exist_ok=True)
+        temp_path = f'{self.__file_path}.{uuid.uuid4().hex}.tmp.npz'
+        try:
+            np.savez(temp_path, metadata=np.array(json.dumps(metadata)), vectors=vectors)
+            os.replace(temp_path, self.__file_path)
+            logger.debug('Saved %s responses to: %s', len(entries), self.__file_path)
+        except Exception as ex:
+            logger.error('Failed to save responses to: %s. %s', self.__file_path, ex, exc_info=True)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def __load(self):
+        if self.__file_path is None or not os.path.exists(self.__file_path):
+            return
+        try:
+            with np.load(self.__file_path) as data:
+                metadata = json.loads(str(data['metadata']))
+                vectors = data['vectors']
+        except Exception as ex:
+            logger.warning('Failed to load responses from: %s. %s', self.__file_path, ex)
+            return
+        has_vectors = len(vectors) == len(metadata)
+        if self.__embeddings is not None and not has_vectors:
+            return
+        for i, m in enumerate(metadata):
+            vector = vectors[i] if has_vectors else None
+            entry = _CachedResponse(m['request'], m['response'], vector, m['created'])
+            self.__entries[ResponseCache.normalize(m['request'])] = entry
+        self.__remove_expired()
+        logger.debug('Loaded %s responses from: %s', len(self.__entries), self.__file_path)
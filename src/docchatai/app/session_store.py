@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import abstractmethod
+from collections import OrderedDict
+from typing import Callable
+
+from .config import AppConfig
+
+logger = logging.getLogger(__name__)
+
+
+class ChatHistory:
+    @staticmethod
+    def of(app_config: AppConfig) -> 'ChatHistory':
+        backend = app_config.chat_history_store
+        if backend == 'memory':
+            return InMemoryChatHistory()
+        if backend == 'sqlite':
+            return SqliteChatHistory(os.path.join(app_config.app_dir, '.chat-history.sqlite'))
+        raise ValueError(f'Unsupported chat history store: `{backend}`. Supported: memory, sqlite')
+
+    @abstractmethod
+    def add(self, session_id: str, chat: dict[str, str]):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get(self, session_id: str, limit: int) -> [dict[str, str]]:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def on_session_evicted(self, session_id: str):
+        raise NotImplementedError()
+
+    def keeps_chats(self) -> bool:
+        # Whether chats are kept beyond those of the session.
+        return True
+
+
+class InMemoryChatHistory(ChatHistory):
+    # Keeps nothing. The session's recent chats are the only copy, so that they are within the
+    # session budget. Chat histories do not survive the eviction of their session.
+    def add(self, session_id: str, chat: dict[str, str]):
+        pass
+
+    def get(self, session_id: str, limit: int) -> [dict[str, str]]:
+        return []
+
+    def on_session_evicted(self, session_id: str):
+        pass
+
+    def keeps_chats(self) -> bool:
+        return False
+
+
+class SqliteChatHistory(ChatHistory):
+    # Chat histories are kept on disk, and survive the eviction of their session.
+    def __init__(self, db_file: str):
+        os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(db_file, check_same_thread=False)
+        with self.__lock, self.__connection:
+            self.__connection.execute(
+                'CREATE TABLE IF NOT EXISTS chats ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, chat TEXT NOT NULL)')
+            self.__connection.execute(
+                'CREATE INDEX IF NOT EXISTS chats_session_id ON chats (session_id, id)')
+
+    def add(self, session_id: str, chat: dict[str, str]):
+        with self.__lock, self.__connection:
+            self.__connection.execute(
+                'INSERT INTO chats (session_id, chat) VALUES (?, ?)', (session_id, json.dumps(chat)))
+
+    def get(self, session_id: str, limit: int) -> [dict[str, str]]:
+        with self.__lock:
+            rows = self.__connection.execute(
+                'SELECT chat FROM chats WHERE session_id = ? ORDER BY id DESC LIMIT ?',
+                (session_id, limit)).fetchall()
+        return [json.loads(row[0]) for row in reversed(rows)]
+
+    def on_session_evicted(self, session_id: str):
+        pass
+
+
+class _Session:
+    def __init__(self):
+        self.chat_ai = None
+        self.chat_config = None
+        # The most recent chats. Older chats are only in the chat history, if it keeps chats.
+        self.chats: list[dict[str, str]] or None = None
+        self.size = 0
+        self.last_accessed = time.monotonic()
+
+
+class SessionStore:
+    # Sessions are evicted when idle for longer than the ttl, least recently used first when
+    # there are too many of them, or when together they use more than the memory budget.
+    @staticmethod
+    def of(app_config: AppConfig, on_evict: Callable[[str, any, any], None]) -> 'SessionStore':
+        return SessionStore(ChatHistory.of(app_config),
+                            app_config.max_sessions,
+                            app_config.session_ttl_seconds,
+                            app_config.max_sessions_bytes,
+                            app_config.max_session_bytes,
+                            on_evict)
+
+    def __init__(self,
+                 chat_history: ChatHistory,
+                 max_sessions: int = 1000,
+                 ttl_seconds: int = 3600,
+                 max_bytes: int = 256 * 1024 * 1024,
+                 max_session_bytes: int = 1024 * 1024,
+                 on_evict: Callable[[str, any, any], None] = lambda session_id, chat_ai, chat_config: None):
+        self.__chat_history = chat_history
+        self.__max_sessions = max_sessions
+        self.__ttl_seconds = ttl_seconds
+        self.__max_bytes = max_bytes
+        self.__max_session_bytes = max_session_bytes
+        self.__on_evict = on_evict
+        self.__lock = threading.RLock()
+        # In least recently used order.
+        self.__sessions: OrderedDict[str, _Session] = OrderedDict()
+        self.__size = 0
+
+    def get_chat_ai(self, session_id: str) -> any:
+        with self.__lock:
+            session = self.__sessions.get(session_id, None)
+            if session is not None:
+                self.__touch(session_id, session)
+            chat_ai = None if session is None else session.chat_ai
+        self.evict()
+        return chat_ai
+
+    def set_chat_ai(self, session_id: str, chat_ai: any, chat_config: any) -> any:
+        # Returns the chat config of the replaced chat AI, if any.
+        with self.__lock:
+            session = self.__get_or_create(session_id)
+            previous_chat_config = session.chat_config
+            session.chat_ai = chat_ai
+            session.chat_config = chat_config
+        self.evict()
+        return previous_chat_config
+
+    def add_chat(self, session_id: str, chat: dict[str, str], limit: int) -> [dict[str, str]]:
+        # Returns the most recent chats, up to the limit.
+        self.__chat_history.add(session_id, chat)
+        with self.__lock:
+            session = self.__get_or_create(session_id)
+            if session.chats is None:
+                # The chat history, if it keeps chats, already has this chat.
+                session.chats = self.__chat_history.get(session_id, limit) \
+                    if self.__chat_history.keeps_chats() else [chat]
+            else:
+                session.chats.append(chat)
+            self.__trim(session, limit)
+            chats = list(session.chats)
+        self.evict()
+        return chats
+
+    def get_chats(self, session_id: str, limit: int) -> [dict[str, str]]:
+        with self.__lock:
+            session = self.__sessions.get(session_id, None)
+            if session is not None and session.chats is not None \
+                    and (len(session.chats) >= limit or not self.__chat_history.keeps_chats()):
+                self.__touch(session_id, session)
+                return list(session.chats[-limit:])
+        return self.__chat_history.get(session_id, limit)
+
+    def evict(self):
+        now = time.monotonic()
+        evicted = []
+        with self.__lock:
+            while len(self.__sessions) > 0:
+                session_id, session = next(iter(self.__sessions.items()))
+                expired = now - session.last_accessed > self.__ttl_seconds
+                too_many = len(self.__sessions) > self.__max_sessions
+                too_large = 0 < self.__max_bytes < self.__size
+                if not expired and not too_many and not too_large:
+                    break
+                del self.__sessions[session_id]
+                self.__size -= session.size
+                evicted.append((session_id, session))
+        for session_id, session in evicted:
+            logger.debug('Evicting session: %s', session_id)
+            try:
+                self.__chat_history.on_session_evicted(session_id)
+                self.__on_evict(session_id, session.chat_ai, session.chat_config)
+            except Exception as ex:
+                logger.error('Error evicting session: %s. %s', session_id, ex, exc_info=True)
+
+    def get_size_in_bytes(self) -> int:
+        return self.__size
+
+    def __len__(self) -> int:
+        return len(self.__sessions)
+
+    def __get_or_create(self, session_id: str) -> _Session:
+        session = self.__sessions.get(session_id, None)
+        if session is None:
+            session = _Session()
+            self.__sessions[session_id] = session
+        self.__touch(session_id, session)
+        return session
+
+    def __touch(self, session_id: str, session: _Session):
+        session.last_accessed = time.monotonic()
+        self.__sessions.move_to_end(session_id)
+
+    def __trim(self, session: _Session, limit: int):
+        # Keep the most recent chats that fit within the per session budget.
+        del session.chats[:-limit]
+        size = sum(SessionStore.__size_of(chat) for chat in session.chats)
+        while len(session.chats) > 1 and size > self.__max_session_bytes:
+            size -= SessionStore.__size_of(session.chats.pop(0))
+        self.__size += size - session.size
+        session.size = size
+
+    @staticmethod
+    def __size_of(chat: dict[str, str]) -> int:
+        return sum(len(value) for value in chat.values() if isinstance(value, str))
@@ -13,8 +13,18 @@ def safe_unique_key(name: str, discriminator: str) -> str:
     hash_hex = hashlib.sha256(f'{discriminator}{name}'.encode()).hexdigest()
     return f'{formatted_discr}_{formatted_name}_{hash_hex}'
 
-def safe_unique_path_name(path: str, discriminator: str = str(uuid.uuid4().hex)) -> str:
+def safe_unique_path_name(path: str, discriminator: str or None = None) -> str:
+    # A default argument would be evaluated once, giving every call the same discriminator.
+    if discriminator is None:
+        discriminator = uuid.uuid4().hex
     formatted_discr = _non_alpha_numeric_pattern.sub('_', discriminator[:64])
     name, ext = os.path.splitext(path)
     formatted_name = _non_alpha_numeric_pattern.sub('_', os.path.basename(name)[-64:])
     return f'{formatted_discr}_{formatted_name}{ext}'
+
+def file_digest(path: str, chunk_size: int = 1024 * 1024) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
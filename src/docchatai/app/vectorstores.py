@@ -1,17 +1,29 @@
 import logging
+import threading
+import uuid
 from abc import abstractmethod
+from collections import deque
 from concurrent import futures
+from typing import Any, Callable, Hashable, Iterable, Iterator
+
+import faiss
+import numpy as np
 
 from langchain.embeddings import CacheBackedEmbeddings
-from langchain.storage import LocalFileStore
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
 from langchain_core.vectorstores import VectorStore
 
+from .ann_indexes import AnnIndexes
 from .config import ChatConfig
 from .concurrency import Threads
 from .doc_loader import DocLoader
+from .embedding_scheduler import EmbeddingScheduler
+from .embedding_stores import EmbeddingStores
+from .index_store import IndexStore
+from .metrics import Metrics
 from .utils import safe_unique_key
 
 logger = logging.getLogger(__name__)
@@ -20,13 +32,259 @@ logger = logging.getLogger(__name__)
 class VectorStores:
     @staticmethod
     def len(vectorstore) -> int:
-        return 0 if vectorstore is None else len(vectorstore.index_to_docstore_id)
+        # The vectors in the index. Documents are mapped before their vectors are added.
+        return 0 if vectorstore is None else vectorstore.index.ntotal
+
+    @staticmethod
+    def size_in_bytes(vectorstore) -> int:
+        # An estimate, of the vectors plus the text of the documents.
+        if vectorstore is None or not isinstance(vectorstore, FAISS):
+            return 0
+        index = vectorstore.index
+        vectors_size = index.ntotal * getattr(index, 'code_size', index.d * 4)
+        # Memory-mapped docstores have no _dict, and hold no documents in memory.
+        docs = getattr(vectorstore.docstore, '_dict', {})
+        return vectors_size + sum(len(doc.page_content) for doc in docs.values())
+
+    @staticmethod
+    def add_embeddings(vectorstore: VectorStore, pages: [Document], vectors: np.ndarray):
+        if not isinstance(vectorstore, FAISS):
+            vectorstore.add_embeddings(zip([page.page_content for page in pages], vectors),
+                                       [page.metadata for page in pages])
+            return
+        # The vectorstore may be searched while pages are added. So the documents, and their positions
+        # in the index, are added before their vectors, so that no search finds a vector without its document.
+        ids = [str(uuid.uuid4()) for _ in pages]
+        vectorstore.docstore.add({id_: Document(id=id_, page_content=page.page_content, metadata=page.metadata)
+                                  for id_, page in zip(ids, pages)})
+        start = len(vectorstore.index_to_docstore_id)
+        vectorstore.index_to_docstore_id.update({start + i: id_ for i, id_ in enumerate(ids)})
+        try:
+            vectors = np.array(vectors, dtype=np.float32)
+            if getattr(vectorstore, '_normalize_L2', False):
+                faiss.normalize_L2(vectors)
+            vectorstore.index.add(vectors)
+        except Exception:
+            for i in range(len(ids)):
+                del vectorstore.index_to_docstore_id[start + i]
+            vectorstore.docstore.delete(ids)
+            raise
 
     @staticmethod
     def file_backed_embeddings(chat_config: ChatConfig, embeddings: Embeddings) -> Embeddings:
-        store = LocalFileStore(chat_config.app_config.app_dir + "/.embeddings-cache/")
-        namespace = safe_unique_key(chat_config.chat_file, chat_config.chat_model_name)
-        return CacheBackedEmbeddings.from_bytes_store(embeddings, store, namespace=namespace)
+        app_config = chat_config.app_config
+        # Vectors are cached by model and chunk content, not by file. So a revised document
+        # only embeds its changed chunks, and a chunk shared by documents is embedded once.
+        namespace = safe_unique_key(chat_config.chat_model_provider, chat_config.chat_model_name)
+        # Queries are cached apart from documents, as some models embed them differently.
+        query_store = EmbeddingStores.for_queries(app_config)
+        return CacheBackedEmbeddings.from_bytes_store(embeddings, EmbeddingStores.of(app_config), namespace=namespace,
+                                                      query_embedding_cache=False if query_store is None else query_store)
+
+    @staticmethod
+    def yield_batches(pages: Iterator[Document], batch_size: int) -> Iterator[list[Document]]:
+        batch = []
+        for page in pages:
+            batch.append(page)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    @staticmethod
+    def load_saved(chat_config: ChatConfig, embeddings: Embeddings) -> VectorStore or None:
+        with Metrics.span('index_load'):
+            vectorstore = IndexStore.of(chat_config).load(IndexStore.key(chat_config), embeddings)
+        if vectorstore is not None:
+            # Search params are set per process, rather than saved with the index.
+            AnnIndexes.set_search_params(vectorstore.index, chat_config.app_config)
+        return vectorstore
+
+    @staticmethod
+    def optimize(chat_config: ChatConfig, vectorstore: VectorStore):
+        # Replaces a large flat index with an ANN index, once all its vectors have been added.
+        # Vectors are added to a flat index while loading, so that early pages are searchable at once.
+        if not isinstance(vectorstore, FAISS):
+            return
+        try:
+            with Metrics.span('index_build'):
+                index = AnnIndexes.build(vectorstore.index, chat_config.app_config)
+        except Exception as ex:
+            logger.warning('Failed to build ANN index, keeping flat index. %s', ex, exc_info=True)
+            return
+        if index is not None:
+            vectorstore.index = index
+
+    @staticmethod
+    def save(chat_config: ChatConfig, vectorstore: VectorStore):
+        if not isinstance(vectorstore, FAISS):
+            logger.debug('Only FAISS indexes are saved, not: %s', type(vectorstore))
+            return
+        index_store = IndexStore.of(chat_config)
+        key = IndexStore.key(chat_config)
+        with Metrics.span('index_save'):
+            is_saved = index_store.save(key, vectorstore)
+        if not is_saved:
+            return
+        # Serve from the saved index, which is memory-mapped, and free the copy built in memory.
+        saved = index_store.load(key, vectorstore.embeddings)
+        if saved is not None and VectorStores.len(saved) == VectorStores.len(vectorstore):
+            AnnIndexes.set_search_params(saved.index, chat_config.app_config)
+            # Positions and ids match, so searches are correct whichever of these they see.
+            vectorstore.docstore = saved.docstore
+            vectorstore.index = saved.index
+
+
+class ShardedVectorStore(VectorStore):
+    # Searches many vectorstores, one per document, as one. The query is embedded once,
+    # then searched in every shard in parallel, and the results are merged by score.
+    def __init__(self, shards: [FAISS]):
+        if len(shards) == 0:
+            raise ValueError('At least one shard is required')
+        self.__shards = shards
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.__shards[0].embeddings
+
+    def get_shards(self) -> [FAISS]:
+        return self.__shards
+
+    def add_texts(self, texts: Iterable[str], metadatas: list[dict] or None = None, **kwargs: Any) -> list[str]:
+        raise NotImplementedError('Add texts to the shards instead')
+
+    @classmethod
+    def from_texts(cls, texts: list[str], embedding: Embeddings, metadatas: list[dict] or None = None,
+                   **kwargs: Any) -> 'ShardedVectorStore':
+        raise NotImplementedError('Create the shards instead')
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> [Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> [tuple[Document, float]]:
+        embedding = self.embeddings.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k, **kwargs)
+
+    def similarity_search_with_score_by_vector(self,
+                                               embedding: [float],
+                                               k: int = 4,
+                                               **kwargs: Any) -> [tuple[Document, float]]:
+        def search(shard: FAISS) -> [tuple[Document, float]]:
+            return shard.similarity_search_with_score_by_vector(embedding, k, **kwargs)
+
+        if len(self.__shards) == 1:
+            results = [search(self.__shards[0])]
+        else:
+            results = [f.result() for f in [Threads.submit(search, shard) for shard in self.__shards]]
+
+        # The shards share a model, so their scores are comparable.
+        higher_is_better = self.__shards[0].distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT
+        merged = [result for shard_results in results for result in shard_results]
+        merged.sort(key=lambda result: result[1], reverse=higher_is_better)
+        return merged[:k]
+
+class _VectorStoreBuilder:
+    # The single writer of a vectorstore. Embedding workers hand it their vectors, and it
+    # appends them to the index in large contiguous blocks, so no two threads ever write at once.
+    # Each block is appended by a build task of its own, so that a large document never holds
+    # a build worker, and documents take turns in the build pool.
+    def __init__(self,
+                 vectorstore: VectorStore,
+                 max_block_size: int,
+                 group: Hashable,
+                 on_added: Callable[[int], None] = lambda batch_count: None,
+                 on_completed: Callable[[], None] = lambda: None):
+        self.__vectorstore = vectorstore
+        self.__max_block_size = max_block_size
+        self.__group = group
+        # Called with the number of batches appended, or failed, once they are no longer held.
+        self.__on_added = on_added
+        # Called once every batch has been appended, or failed.
+        self.__on_completed = on_completed
+        self.__lock = threading.Lock()
+        self.__batches = deque()
+        self.__batch_count = None
+        self.__received = 0
+        self.__is_scheduled = False
+        self.__completed = futures.Future()
+        self.__failed_pages = 0
+
+    def get_failed_pages(self) -> int:
+        return self.__failed_pages
+
+    def get_completed(self) -> futures.Future:
+        return self.__completed
+
+    def add(self, pages: [Document], vectors: [[float]] or None):
+        with self.__lock:
+            self.__batches.append((pages, vectors))
+        self.__schedule()
+
+    def close(self, batch_count: int):
+        # Tells the builder how many batches to expect in total.
+        with self.__lock:
+            self.__batch_count = batch_count
+        self.__schedule()
+
+    def __is_all_received(self) -> bool:
+        return self.__batch_count is not None and self.__received >= self.__batch_count
+
+    def __schedule(self):
+        # At most one build task at a time, per vectorstore.
+        with self.__lock:
+            if self.__is_scheduled is True or self.__completed.done():
+                return
+            if len(self.__batches) == 0 and not self.__is_all_received():
+                return
+            self.__is_scheduled = True
+        Threads.submit_to(Threads.BUILD, self.__group, self.__build_block)
+
+    def __build_block(self):
+        with self.__lock:
+            # Take whatever is ready, so that many batches are appended in one block.
+            items = [self.__batches.popleft() for _ in range(min(len(self.__batches), self.__max_block_size))]
+
+        pages, vector_blocks = [], []
+        for item in items:
+            if item[1] is None:
+                self.__failed_pages += len(item[0])
+            else:
+                pages.extend(item[0])
+                vector_blocks.append(np.asarray(item[1], dtype=np.float32))
+
+        if len(pages) > 0:
+            self.__append(pages, vector_blocks)
+        if len(items) > 0:
+            self.__on_added(len(items))
+
+        with self.__lock:
+            self.__received += len(items)
+            self.__is_scheduled = False
+            is_completed = self.__is_all_received()
+            if is_completed:
+                # Claimed under the lock, so that completion happens once.
+                self.__is_scheduled = True
+
+        if is_completed is False:
+            self.__schedule()
+            return
+        try:
+            self.__on_completed()
+            self.__completed.set_result(None)
+        except BaseException as ex:
+            self.__completed.set_exception(ex)
+            raise
+
+    def __append(self, pages: [Document], vector_blocks: [np.ndarray]):
+        try:
+            with Metrics.span('index_add'):
+                VectorStores.add_embeddings(self.__vectorstore, pages, np.concatenate(vector_blocks))
+            logger.debug('Saved pages: %s', ','.join([str(p.metadata.get('page')) for p in pages]))
+        except Exception as ex:
+            self.__failed_pages += len(pages)
+            logger.error('Error saving %s pages. %s', len(pages), ex, exc_info=True)
+
 
 class VectorStoreLoader:
     @abstractmethod
@@ -41,6 +299,10 @@ class VectorStoreLoader:
     def get_total_pages(self) -> int:
         raise NotImplementedError()
 
+    @abstractmethod
+    def is_completed(self) -> bool:
+        raise NotImplementedError()
+
     @abstractmethod
     def get(self) -> VectorStore:
         raise NotImplementedError()
@@ -57,10 +319,32 @@ class VectorStoreLoaderSync(VectorStoreLoader):
         self.__vectorstore: VectorStore or None = None
 
     def load(self, chat_config: ChatConfig, embeddings: Embeddings) -> VectorStoreLoader:
-        page_list: [Document] = list(DocLoader.yield_pages(chat_config.chat_file))
-        self.__total_pages = len(page_list)
-        embeddings = VectorStores.file_backed_embeddings(chat_config, embeddings)
-        self.__vectorstore = self.__cls.from_documents(page_list, embeddings)
+        embeddings = VectorStores.file_backed_embeddings(chat_config, EmbeddingScheduler.schedule(embeddings))
+
+        if self.__cls is FAISS:
+            self.__vectorstore = VectorStores.load_saved(chat_config, embeddings)
+            if self.__vectorstore is not None:
+                self.__total_pages = VectorStores.len(self.__vectorstore)
+                return self
+
+        # Embed the pages a batch at a time, rather than holding the whole document in memory.
+        total_pages = 0
+        text_splitter = DocLoader.new_text_splitter(chat_config.app_config)
+        pages = DocLoader.yield_pages(
+            chat_config.chat_file, text_splitter, chat_config.app_config.parse_pages_per_task)
+        for batch in VectorStores.yield_batches(pages, chat_config.app_config.embedding_batch_size):
+            if self.__vectorstore is None:
+                self.__vectorstore = self.__cls.from_documents(batch, embeddings)
+            else:
+                self.__vectorstore.add_documents(batch)
+            total_pages += len(batch)
+        self.__total_pages = total_pages
+
+        if self.__vectorstore is None:
+            raise ValueError('No valid pages found in the document')
+
+        VectorStores.optimize(chat_config, self.__vectorstore)
+        VectorStores.save(chat_config, self.__vectorstore)
         return self
 
     def get_loaded_pages(self) -> int:
@@ -73,6 +357,9 @@ class VectorStoreLoaderSync(VectorStoreLoader):
             raise ValueError('First call load(), before querying total pages')
         return self.__total_pages
 
+    def is_completed(self) -> bool:
+        return self.__total_pages is not None
+
     def get(self) -> VectorStore:
         return self.__vectorstore
 
@@ -84,53 +371,100 @@ class VectorStoreLoaderMultiThreaded(VectorStoreLoader):
     def __init__(self, cls=FAISS):
         self.__cls = cls
         self.__total_pages = None
+        self.__parsed = False
+        self.__parse_failed = False
         self.__futures = []
+        self.__parsed_future = futures.Future()
+        self.__builder: _VectorStoreBuilder or None = None
         self.__vectorstore: VectorStores or None = None
 
     def load(self, chat_config: ChatConfig, embeddings: Embeddings) -> VectorStoreLoader:
-        page_list: [Document] = list(DocLoader.yield_pages(chat_config.chat_file))
-        self.__total_pages = len(page_list)
-        embeddings = VectorStores.file_backed_embeddings(chat_config, embeddings)
+        embeddings = VectorStores.file_backed_embeddings(chat_config, EmbeddingScheduler.schedule(embeddings))
 
-        if self.__total_pages == 0:
-            raise ValueError('No valid pages found in the document')
+        if self.__cls is FAISS:
+            self.__vectorstore = VectorStores.load_saved(chat_config, embeddings)
+            if self.__vectorstore is not None:
+                self.__total_pages = VectorStores.len(self.__vectorstore)
+                self.__parsed = True
+                return self
 
-        batch_size = self.__total_pages / chat_config.app_config.max_worker_threads
-        if batch_size < 1:
-            batch_size = 1
+        text_splitter = DocLoader.new_text_splitter(chat_config.app_config)
+        pages = DocLoader.yield_pages(
+            chat_config.chat_file, text_splitter, chat_config.app_config.parse_pages_per_task)
 
         # First
-        first_page = page_list[0]
+        first_page = next(pages, None)
         if first_page is None:
             raise ValueError('No valid pages found in the document')
         self.__vectorstore = self.__cls.from_documents([first_page], embeddings)
+        self.__total_pages = 1
         logger.debug('Saved first page')
 
         # Remaining
-        def add_pages_to_store(pages: [Document]):
-            page_nums = None
+        # The rest of the document is parsed in the background, while earlier pages are being
+        # embedded. Parsing pauses whenever too many batches are pending, so memory stays bounded.
+        # A batch is pending from when it is parsed till its vectors are appended to the index.
+        # Each batch is parsed by a task of its own, so that a large document never holds a parse
+        # worker, and documents take turns in the parse pool.
+        max_pending_batches = chat_config.app_config.ingestion_queue_size
+        batches = VectorStores.yield_batches(pages, chat_config.app_config.embedding_batch_size)
+        lock = threading.Lock()
+        pending_batches = 0
+        batch_count = 0
+        is_paused = False
+        # Tasks are grouped by document, so that documents take turns in each pool.
+        group = chat_config.chat_file_digest
+
+        def parse_next():
+            nonlocal pending_batches, is_paused
+            with lock:
+                if pending_batches >= max_pending_batches:
+                    # Resumed by the builder, once it has appended a batch.
+                    is_paused = True
+                    return
+                pending_batches += 1
+            Threads.submit_to(Threads.PARSE, group, parse_batch)
+
+        def on_added(added_batches: int):
+            nonlocal pending_batches, is_paused
+            with lock:
+                pending_batches -= added_batches
+                is_resumed, is_paused = is_paused, False
+            if is_resumed is True:
+                parse_next()
+
+        builder = _VectorStoreBuilder(self.__vectorstore, chat_config.app_config.index_build_block_size,
+                                      group, on_added, lambda: self.__on_build_completed(chat_config))
+        self.__builder = builder
+
+        def embed_pages(batch: [Document]):
+            try:
+                vectors = embeddings.embed_documents([page.page_content for page in batch])
+            except Exception as ex:
+                page_nums = ','.join([str(p.metadata.get('page')) for p in batch])
+                logger.error('Error embedding pages: %s. %s', page_nums, ex, exc_info=True)
+                vectors = None
+            # Failed batches are handed over too, so that the builder counts them.
+            builder.add(batch, vectors)
+
+        def parse_batch():
+            nonlocal batch_count
             try:
-                if len(pages) == 0:
+                batch = next(batches, None)
+                if batch is not None:
+                    self.__futures.append(Threads.submit_to(Threads.EMBED, group, embed_pages, batch))
+                    self.__total_pages += len(batch)
+                    batch_count += 1
+                    parse_next()
                     return
-
-                vectorstore = self.__cls.from_documents(pages, embeddings)
-                self.__vectorstore.merge_from(vectorstore)
-
-                page_nums = ','.join([str(p.metadata['page']) for p in pages])
-                logger.debug(f'Saved pages: {page_nums}')
-
             except Exception as ex:
-                logger.error('Error loading pages: %s. %s', page_nums, ex, exc_info=True)
-
-        batch = []
-        for page in page_list[1:]:
-            batch.append(page)
-            if len(batch) >= batch_size:
-                self.__futures.append(Threads.submit(add_pages_to_store, batch))
-                batch = []
+                self.__parse_failed = True
+                logger.error('Error parsing: %s. %s', chat_config.chat_file, ex, exc_info=True)
+            self.__parsed = True
+            builder.close(batch_count)
+            self.__parsed_future.set_result(None)
 
-        if len(batch) > 0:
-            self.__futures.append(Threads.submit(add_pages_to_store, batch))
+        parse_next()
 
         return self
 
@@ -144,10 +478,69 @@ class VectorStoreLoaderMultiThreaded(VectorStoreLoader):
             raise ValueError('First call load(), before querying total pages')
         return self.__total_pages
 
+    def get_failed_pages(self) -> int:
+        # Pages that could not be embedded, or added to the index.
+        return 0 if self.__builder is None else self.__builder.get_failed_pages()
+
+    def is_completed(self) -> bool:
+        return self.__parsed is True and \
+            self.get_loaded_pages() + self.get_failed_pages() >= self.get_total_pages()
+
     def get(self) -> VectorStore:
         return self.__vectorstore
 
     def wait_till_completed(self) -> VectorStore:
-        if len(self.__futures) > 0:
+        if self.__builder is not None:
+            # The parser submits the embedding tasks, so wait for it first.
+            futures.wait([self.__parsed_future])
             futures.wait(self.__futures)
+            futures.wait([self.__builder.get_completed()])
         return self.__vectorstore
+
+    def __on_build_completed(self, chat_config: ChatConfig):
+        # Save only complete indexes, so that later sessions never reload a partial one.
+        if self.__parse_failed is False and VectorStores.len(self.__vectorstore) == self.__total_pages:
+            VectorStores.optimize(chat_config, self.__vectorstore)
+            VectorStores.save(chat_config, self.__vectorstore)
+        else:
+            logger.warning('Not saving incomplete index, pages: %s of %s, failed: %s',
+                           VectorStores.len(self.__vectorstore), self.__total_pages, self.get_failed_pages())
+
+
+class VectorStoreLoaderSharded(VectorStoreLoader):
+    # Loads nothing itself. Its shards, one per document, are loaded and pooled separately,
+    # so that the shard of a document is shared by every session chatting about that document.
+    def __init__(self, loaders: [VectorStoreLoader]):
+        if len(loaders) == 0:
+            raise ValueError('At least one loader is required')
+        self.__loaders = loaders
+        self.__vectorstore: ShardedVectorStore or None = None
+
+    def load(self, chat_config: ChatConfig, embeddings: Embeddings) -> VectorStoreLoader:
+        return self
+
+    def get_loaders(self) -> [VectorStoreLoader]:
+        return self.__loaders
+
+    def get_loaded_pages(self) -> int:
+        return sum(loader.get_loaded_pages() for loader in self.__loaders)
+
+    def get_total_pages(self) -> int:
+        return sum(loader.get_total_pages() for loader in self.__loaders)
+
+    def is_completed(self) -> bool:
+        return all(loader.is_completed() for loader in self.__loaders)
+
+    def get(self) -> VectorStore:
+        # Replaced only if a shard is replaced, so that handlers built on it are reused.
+        shards = [loader.get() for loader in self.__loaders]
+        vectorstore = self.__vectorstore
+        if vectorstore is None or any(a is not b for a, b in zip(vectorstore.get_shards(), shards)):
+            vectorstore = ShardedVectorStore(shards)
+            self.__vectorstore = vectorstore
+        return vectorstore
+
+    def wait_till_completed(self) -> VectorStore:
+        for loader in self.__loaders:
+            loader.wait_till_completed()
+        return self.get()
@@ -29,33 +29,49 @@ class WebVar(str, Enum):
     HEADING = 'heading'
     CHAT_FILE = ChatVar.FILE.value
     CHAT_FILES = "chat_files"
+    # The files of the session's current chat. One or more.
+    SELECTED_CHAT_FILES = "selected_chat_files"
+    CHAT_FILE_NAMES = "chat_file_names"
     CHAT_MODELS = 'chat_models'
     CHAT_MODEL = 'chat_model'
 
 class WebData:
     @staticmethod
     def get(request, key: str, result_if_none: any = None) -> str or None:
-        val = request.args.get(key)
+        return WebData.get_value(request.args, request.form, key, result_if_none)
+
+    @staticmethod
+    def get_value(args, form, key: str, result_if_none: any = None) -> str or None:
+        val = args.get(key)
         if not val:
-            val = request.form.get(key)
+            val = form.get(key)
         return result_if_none if not val else val
 
     @staticmethod
-    def get_session_id() -> str:
-        session_id = session.get(WebVar.SESSION_ID.value, None)
+    def get_session_id(session_data=None) -> str:
+        # The session defaults to Flask's. The async app passes in its own.
+        session_data = session if session_data is None else session_data
+        session_id = session_data.get(WebVar.SESSION_ID.value, None)
         if session_id is None:
             session_id = str(uuid.uuid4().hex)
-            session[WebVar.SESSION_ID.value] = session_id
+            session_data[WebVar.SESSION_ID.value] = session_id
         logger.debug('session_id: %s', session_id)
         return session_id
 
     @staticmethod
-    def collect_request_form(request) -> dict[str, any]:
+    def collect_request_form(request, session_data=None) -> dict[str, any]:
+        return WebData.collect_form(request.args, request.form, session_data)
+
+    @staticmethod
+    def collect_form(args, form, session_data=None) -> dict[str, any]:
         try:
-            web_data = dict(request.form)
-            web_data[ChatVar.REQUEST.value] = WebData.get(request, ChatVar.REQUEST.value)
+            web_data = dict(form)
+            web_data[ChatVar.REQUEST.value] = WebData.get_value(args, form, ChatVar.REQUEST.value)
             web_data = WebData.strip_values(web_data)
-            web_data[WebVar.SESSION_ID.value] = WebData.get_session_id()
+            web_data[WebVar.SESSION_ID.value] = WebData.get_session_id(session_data)
+            # So that the chat AI can be recreated, once the session store has evicted it.
+            web_data[WebVar.SELECTED_CHAT_FILES.value] = \
+                (session if session_data is None else session_data).get(WebVar.SELECTED_CHAT_FILES.value, [])
             logger.debug(f"Form data: {web_data}")
             return web_data
         except ValueError as value_ex:
@@ -63,14 +79,17 @@ class WebData:
             raise ValidationError(value_ex.args[0])
 
     @staticmethod
-    def update_session(response_data: dict[str, any]):
+    def update_session(response_data: dict[str, any], session_data=None):
+        session_data = session if session_data is None else session_data
         chat_file: dict[str, any] = response_data[ChatVar.FILE.value]
-        session[WebVar.CHAT_FILE.value] = chat_file
-        session[WebVar.CHAT_MODEL] = response_data[WebVar.CHAT_MODEL]
+        session_data[WebVar.CHAT_FILE.value] = chat_file
+        session_data[WebVar.CHAT_MODEL] = response_data[WebVar.CHAT_MODEL]
+        selected_chat_files = response_data.get(WebVar.SELECTED_CHAT_FILES.value, [chat_file])
+        session_data[WebVar.SELECTED_CHAT_FILES.value] = selected_chat_files
 
-        chat_files = session.get(WebVar.CHAT_FILES.value, [])
-        chat_files.append(chat_file)
-        session[WebVar.CHAT_FILES.value] = chat_files
+        chat_files = session_data.get(WebVar.CHAT_FILES.value, [])
+        chat_files.extend(selected_chat_files)
+        session_data[WebVar.CHAT_FILES.value] = chat_files
 
     @staticmethod
     def strip_values(data: dict[str, any]):
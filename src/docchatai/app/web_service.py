@@ -1,5 +1,7 @@
+import asyncio
 import json
 import logging
+from typing import AsyncIterator, Iterator
 
 from .chat_service import ChatService, ChatAI
 from .config import AppConfig, ChatConfig
@@ -32,14 +34,13 @@ class WebService:
         session_id = web_data[WebVar.SESSION_ID.value]
 
         saved_files: [UploadedFile] = self.__file_service.save_files(session_id, files)
-        if len(saved_files) > 1:
-            raise NotImplementedError('Multiple file uploads is not yet supported')
-        elif len(saved_files) == 1:
+        if len(saved_files) > 0:
             web_data[WebVar.CHAT_FILE.value] = saved_files[0].to_dict()
-        # for saved_file in saved_files:
-        #     web_data[saved_file.name] = saved_file.to_dict()
+            web_data[WebVar.CHAT_FILE_NAMES.value] = ', '.join(f.original_filename for f in saved_files)
+            # The session will chat about all the files at once.
+            web_data[WebVar.SELECTED_CHAT_FILES.value] = [f.to_dict() for f in saved_files]
 
-        chat_config = ChatConfig.from_dict(self.__app_config, web_data)
+        chat_config = self.__chat_config(web_data)
 
         chat_ai = self.__chat_service.add_chat_ai(session_id, chat_config, False)
 
@@ -54,19 +55,22 @@ class WebService:
 
         loaded_pages = -1 if chat_ai is None else chat_ai.get_loader().get_loaded_pages()
         total_pages = -1 if chat_ai is None else chat_ai.get_loader().get_total_pages()
+        completed = chat_ai is None or chat_ai.get_loader().is_completed()
 
-        return json.dumps({"progress": loaded_pages, "total": total_pages})
+        return json.dumps({"progress": loaded_pages, "total": total_pages, "completed": completed})
 
     def chat_request(self, web_data: dict[str, any]) -> dict[str, any]:
         logger.debug('chat_request, web_data: %s', web_data)
 
-        chat_config = ChatConfig.from_dict(self.__app_config, web_data)
+        chat_config = self.__chat_config(web_data)
 
         chat_request = web_data.get('chat_request', None)
         if not chat_request:
             raise ValidationError('Chat message text is required')
 
-        chats = self.__chat_service.chat_request(WebData.get_session_id(), chat_request, chat_config)
+        session_id = web_data[WebVar.SESSION_ID.value]
+
+        chats = self.__chat_service.chat_request(session_id, chat_request, chat_config)
 
         #logger.debug('Session chats: %s', chats)
 
@@ -74,6 +78,65 @@ class WebService:
 
         return self._with_default_page_variables(response_data)
 
+    def chat_request_stream(self, web_data: dict[str, any]) -> Iterator[str]:
+        logger.debug('chat_request_stream, web_data: %s', web_data)
+
+        chat_config = self.__chat_config(web_data)
+
+        chat_request = web_data.get('chat_request', None)
+        if not chat_request:
+            raise ValidationError('Chat message text is required')
+
+        # The session id is read now, as the tokens are streamed after the request context is gone.
+        session_id = web_data[WebVar.SESSION_ID.value]
+
+        return self.__chat_service.chat_request_stream(session_id, chat_request, chat_config)
+
+    async def achat_file_upload(self, web_data: dict[str, any], files) -> dict[str, any]:
+        # Saving the files and starting the load both block, so they are done off the event loop.
+        return await asyncio.to_thread(self.chat_file_upload, web_data, files)
+
+    async def achat_request(self, web_data: dict[str, any]) -> dict[str, any]:
+        logger.debug('achat_request, web_data: %s', web_data)
+
+        chat_config = self.__chat_config(web_data)
+
+        chat_request = web_data.get('chat_request', None)
+        if not chat_request:
+            raise ValidationError('Chat message text is required')
+
+        session_id = web_data[WebVar.SESSION_ID.value]
+
+        chats = await self.__chat_service.achat_request(session_id, chat_request, chat_config)
+
+        response_data = {WebVar.CHATS.value: chats}
+
+        return self._with_default_page_variables(response_data)
+
+    def achat_request_stream(self, web_data: dict[str, any]) -> AsyncIterator[str]:
+        logger.debug('achat_request_stream, web_data: %s', web_data)
+
+        chat_config = self.__chat_config(web_data)
+
+        chat_request = web_data.get('chat_request', None)
+        if not chat_request:
+            raise ValidationError('Chat message text is required')
+
+        session_id = web_data[WebVar.SESSION_ID.value]
+
+        return self.__chat_service.achat_request_stream(session_id, chat_request, chat_config)
+
+    def __chat_config(self, web_data: dict[str, any]) -> ChatConfig:
+        # Chat requests carry no file. The session's selected files are used, so that its chat AI
+        # can be recreated, once the session store has evicted it.
+        selected_chat_files = web_data.get(WebVar.SELECTED_CHAT_FILES.value, None)
+        if selected_chat_files:
+            web_data = {**web_data, WebVar.CHAT_FILE.value: selected_chat_files}
+        chat_config = ChatConfig.from_dict(self.__app_config, web_data)
+        if chat_config.chat_file is None and self.__chat_service.get_chat_ai(web_data[WebVar.SESSION_ID.value]) is None:
+            raise ValidationError('Upload a file to chat about')
+        return chat_config
+
     def _with_default_page_variables(self, variables: dict[str, any] = None):
         if variables is None:
             variables = {}
@@ -0,0 +1,154 @@
+import json
+import logging.config
+import time
+
+import jinja2.utils
+from quart import g, render_template, request, session, Response
+from werkzeug.datastructures import FileStorage, MultiDict
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from docchatai.app.app import App
+from docchatai.app.doc_loader import UnsupportedFileTypeError
+from docchatai.app.file_service import UploadTooLargeError
+from docchatai.app.metrics import Metrics
+from docchatai.app.web_data import ValidationError, WebData, WebVar
+from docchatai.app.asgi_app import asgi_app
+from docchatai.app.web_service import WebService
+
+
+INDEX_TEMPLATE = 'index.html'
+
+app_config = asgi_app.config['app_config']
+web_service: WebService = asgi_app.config['web_service']
+
+logging.config.dictConfig(app_config.logging_config)
+logger = logging.getLogger(__name__)
+
+async def render(page_variables: dict[str, any]) -> str:
+    with Metrics.span('render'):
+        return await render_template(INDEX_TEMPLATE, **page_variables)
+
+@asgi_app.before_serving
+async def startup():
+    App.init(app_config)
+
+@asgi_app.after_serving
+async def shutdown():
+    App.shutdown()
+
+@asgi_app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@asgi_app.after_request
+async def observe_request(response):
+    # Streamed responses are timed by their generator, till their last byte, as this runs before
+    # their first byte is ready.
+    started = g.get('request_started', None)
+    if started is not None and g.get('request_streamed', False) is False:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        Metrics.observe_request(endpoint, time.perf_counter() - started)
+    return response
+
+@asgi_app.template_filter('url_quote')
+def url_quote_filter(s):
+    return jinja2.utils.url_quote(s)
+
+@asgi_app.errorhandler(ValidationError)
+async def handle_validation_error(e):
+    return await render(web_service.index({"error": e.message})), 400
+
+@asgi_app.errorhandler(UnsupportedFileTypeError)
+async def handle_validation_error(e):
+    return await render(web_service.index({"error": e.message})), 400
+
+@asgi_app.errorhandler(UploadTooLargeError)
+async def handle_upload_too_large_error(e):
+    return await render(web_service.index({"error": e.message})), 413
+
+@asgi_app.errorhandler(RequestEntityTooLarge)
+async def handle_request_entity_too_large_error(_):
+    error = f"Upload too large. Max: {app_config.max_upload_bytes} bytes"
+    return await render(web_service.index({"error": error})), 413
+
+async def collect_request_form() -> dict[str, any]:
+    return WebData.collect_form(request.args, await request.form, session)
+
+@asgi_app.route('/metrics')
+async def metrics():
+    return Response(Metrics.to_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@asgi_app.route('/')
+async def index():
+    return await render(web_service.index())
+
+@asgi_app.route('/chat/model')
+async def chat_model():
+    return await render(web_service.index({"error": "Not yet implemented!"}))
+
+@asgi_app.route('/chat/file/select')
+async def chat_file_select():
+    chat_file = WebData.get_value(request.args, await request.form, WebVar.CHAT_FILE.value)
+    if not chat_file:
+        return await render(web_service.index({"error": "No file selected"}))
+    return await render(web_service.index({"error": "Not yet implemented!"}))
+
+@asgi_app.route('/chat/file/upload', methods=['POST'])
+async def chat_file_upload():
+    form_data = await collect_request_form()
+
+    # Quart's files are saved asynchronously. The file service saves them from a worker thread.
+    files = MultiDict([(name, FileStorage(stream=file.stream, filename=file.filename, name=file.name,
+                                          content_type=file.content_type, headers=file.headers))
+                       for name, file in (await request.files).items(multi=True)])
+
+    response_data = await web_service.achat_file_upload(form_data, files)
+
+    WebData.update_session(response_data, session)
+
+    return await render(web_service.index(response_data))
+
+@asgi_app.route('/chat/file/upload/progress')
+async def chat_file_upload_progress():
+    return str(web_service.chat_file_upload_progress(WebData.get_session_id(session)))
+
+@asgi_app.route('/chat/request')
+async def chat_request():
+
+    form_data = await collect_request_form()
+
+    response_data = await web_service.achat_request(form_data)
+
+    return await render(web_service.index(response_data))
+
+@asgi_app.route('/chat/request/stream')
+async def chat_request_stream():
+
+    form_data = await collect_request_form()
+
+    tokens = web_service.achat_request_stream(form_data)
+
+    g.request_streamed = True
+    started, endpoint = g.request_started, request.url_rule.rule
+
+    # Server-Sent Events. Each token is JSON encoded, as tokens may contain new lines.
+    async def generate():
+        try:
+            async for token in tokens:
+                yield f'data: {json.dumps(token)}\n\n'
+            yield 'event: chat_end\ndata: {}\n\n'
+        except Exception as ex:
+            logger.error('Error streaming chat response. %s', ex, exc_info=True)
+            yield f'event: chat_error\ndata: {json.dumps("Sorry, an error occurred.")}\n\n'
+        finally:
+            Metrics.observe_request(endpoint, time.perf_counter() - started)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+if __name__ == '__main__':
+    asgi_app.run(
+        host='0.0.0.0',
+        port=app_config.app_port,
+        debug=app_config.is_production is False)
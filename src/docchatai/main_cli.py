@@ -15,7 +15,7 @@ if __name__ == '__main__':
 
         chat_config = ChatConfig.from_sys_args(app_config)
 
-        chat_ai = ChatService(app_config.default_chat_message_limit).create_chat_ai(chat_config)
+        chat_ai = ChatService(app_config.default_chat_message_limit, app_config).create_chat_ai(chat_config)
 
         # Start asking questions and getting answers in a loop
         print(f"{datetime.now().time()} Document: {chat_config.chat_file}")
@@ -1,10 +1,15 @@
+import json
 import logging.config
+import time
 
 import jinja2.utils
-from flask import render_template, request
+from flask import g, render_template, request, Response, stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge
 
 from docchatai.app.app import App
 from docchatai.app.doc_loader import UnsupportedFileTypeError
+from docchatai.app.file_service import UploadTooLargeError
+from docchatai.app.metrics import Metrics
 from docchatai.app.web_data import ValidationError, WebData, WebVar
 from docchatai.app.web_app import web_app
 from docchatai.app.web_service import WebService
@@ -16,6 +21,25 @@ app_config = web_app.config['app_config']
 web_service: WebService = web_app.config['web_service']
 
 logging.config.dictConfig(app_config.logging_config)
+logger = logging.getLogger(__name__)
+
+def render(page_variables: dict[str, any]) -> str:
+    with Metrics.span('render'):
+        return render_template(INDEX_TEMPLATE, **page_variables)
+
+@web_app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@web_app.after_request
+def observe_request(response):
+    # Streamed responses are timed by their generator, till their last byte, as this runs before
+    # their first byte is ready.
+    started = g.get('request_started', None)
+    if started is not None and g.get('request_streamed', False) is False:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        Metrics.observe_request(endpoint, time.perf_counter() - started)
+    return response
 
 @web_app.template_filter('url_quote')
 def url_quote_filter(s):
@@ -23,26 +47,39 @@ def url_quote_filter(s):
 
 @web_app.errorhandler(ValidationError)
 def handle_validation_error(e):
-    return render_template(INDEX_TEMPLATE, **web_service.index({"error": e.message})), 400
+    return render(web_service.index({"error": e.message})), 400
 
 @web_app.errorhandler(UnsupportedFileTypeError)
 def handle_validation_error(e):
-    return render_template(INDEX_TEMPLATE, **web_service.index({"error": e.message})), 400
+    return render(web_service.index({"error": e.message})), 400
+
+@web_app.errorhandler(UploadTooLargeError)
+def handle_upload_too_large_error(e):
+    return render(web_service.index({"error": e.message})), 413
+
+@web_app.errorhandler(RequestEntityTooLarge)
+def handle_request_entity_too_large_error(_):
+    error = f"Upload too large. Max: {app_config.max_upload_bytes} bytes"
+    return render(web_service.index({"error": error})), 413
+
+@web_app.route('/metrics')
+def metrics():
+    return Response(Metrics.to_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 @web_app.route('/')
 def index():
-    return render_template(INDEX_TEMPLATE, **web_service.index())
+    return render(web_service.index())
 
 @web_app.route('/chat/model')
 def chat_model():
-    return render_template(INDEX_TEMPLATE, **web_service.index({"error": "Not yet implemented!"}))
+    return render(web_service.index({"error": "Not yet implemented!"}))
 
 @web_app.route('/chat/file/select')
 def chat_file_select():
     chat_file = WebData.get(request, WebVar.CHAT_FILE.value)
     if not chat_file:
-        return render_template(INDEX_TEMPLATE, **web_service.index({"error": "No file selected"}))
-    return render_template(INDEX_TEMPLATE, **web_service.index({"error": "Not yet implemented!"}))
+        return render(web_service.index({"error": "No file selected"}))
+    return render(web_service.index({"error": "Not yet implemented!"}))
 
 @web_app.route('/chat/file/upload', methods=['POST'])
 def chat_file_upload():
@@ -52,7 +89,7 @@ def chat_file_upload():
 
     WebData.update_session(response_data)
 
-    return render_template(INDEX_TEMPLATE, **web_service.index(response_data))
+    return render(web_service.index(response_data))
 
 @web_app.route('/chat/file/upload/progress')
 def chat_file_upload_progress():
@@ -65,7 +102,32 @@ def chat_request():
 
     response_data = web_service.chat_request(form_data)
 
-    return render_template(INDEX_TEMPLATE, **web_service.index(response_data))
+    return render(web_service.index(response_data))
+
+@web_app.route('/chat/request/stream')
+def chat_request_stream():
+
+    form_data = WebData.collect_request_form(request)
+
+    tokens = web_service.chat_request_stream(form_data)
+
+    g.request_streamed = True
+    started, endpoint = g.request_started, request.url_rule.rule
+
+    # Server-Sent Events. Each token is JSON encoded, as tokens may contain new lines.
+    def generate():
+        try:
+            for token in tokens:
+                yield f'data: {json.dumps(token)}\n\n'
+            yield 'event: chat_end\ndata: {}\n\n'
+        except Exception as ex:
+            logger.error('Error streaming chat response. %s', ex, exc_info=True)
+            yield f'event: chat_error\ndata: {json.dumps("Sorry, an error occurred.")}\n\n'
+        finally:
+            Metrics.observe_request(endpoint, time.perf_counter() - started)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 if __name__ == '__main__':
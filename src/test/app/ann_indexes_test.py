@@ -0,0 +1,78 @@
+import unittest
+from datetime import datetime
+
+import faiss
+import numpy as np
+
+from docchatai.app.ann_indexes import AnnIndexes
+from docchatai.app.config import AppConfig
+
+
+class TestAppConfig(AppConfig):
+    def __init__(self, vector_index_type: str, vector_encoding: str = 'float32'):
+        super().__init__()
+        self.__vector_index_type = vector_index_type
+        self.__vector_encoding = vector_encoding
+
+    @property
+    def vector_index_type(self) -> str:
+        return self.__vector_index_type
+
+    @property
+    def vector_encoding(self) -> str:
+        return self.__vector_encoding
+
+    @property
+    def ann_index_min_vectors(self) -> int:
+        return 1000
+
+    @property
+    def pq_subquantizers(self) -> int:
+        return 8
+
+    @property
+    def ann_training_sample_size(self) -> int:
+        return 2000
+
+
+class AnnIndexesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.flat_index = faiss.IndexFlatL2(16)
+        self.flat_index.add(np.random.default_rng(1).random((3000, 16), dtype=np.float32))
+
+    def test_auto_keeps_small_indexes_flat(self):
+        print(f'{datetime.now().time()} test_auto_keeps_small_indexes_flat')
+        small_index = faiss.IndexFlatL2(16)
+        small_index.add(self.flat_index.reconstruct_n(0, 999))
+        self.assertIsNone(AnnIndexes.build(small_index, TestAppConfig('auto')))
+        self.assertIsNone(AnnIndexes.build(self.flat_index, TestAppConfig('flat')))
+
+    def test_built_indexes_keep_vector_ids(self):
+        print(f'{datetime.now().time()} test_built_indexes_keep_vector_ids')
+        queries = self.flat_index.reconstruct_n(0, 100)
+        for index_type in ['auto', 'ivf', 'hnsw', 'ivfpq']:
+            index = AnnIndexes.build(self.flat_index, TestAppConfig(index_type))
+            self.assertIsNotNone(index, index_type)
+            self.assertEqual(self.flat_index.ntotal, index.ntotal)
+            _, ids = index.search(queries, 1)
+            # Each vector is its own nearest neighbour. PQ vectors are approximate, so allow some misses.
+            recall = float(np.mean(ids[:, 0] == np.arange(100)))
+            self.assertGreaterEqual(recall, 0.5 if index_type == 'ivfpq' else 0.9, index_type)
+
+    def test_encoded_vectors_use_less_memory(self):
+        print(f'{datetime.now().time()} test_encoded_vectors_use_less_memory')
+        queries = self.flat_index.reconstruct_n(0, 100)
+        for index_type in ['flat', 'ivf', 'hnsw']:
+            for encoding, code_size in [('float16', 2 * 16), ('int8', 16)]:
+                index = AnnIndexes.build(self.flat_index, TestAppConfig(index_type, encoding))
+                self.assertIsNotNone(index, f'{index_type}-{encoding}')
+                # HNSW indexes keep their vectors in a separate storage index.
+                codes = faiss.downcast_index(faiss.downcast_index(index).storage) if index_type == 'hnsw' else index
+                self.assertEqual(code_size, codes.code_size, f'{index_type}-{encoding}')
+                _, ids = index.search(queries, 1)
+                recall = float(np.mean(ids[:, 0] == np.arange(100)))
+                self.assertGreaterEqual(recall, 0.9, f'{index_type}-{encoding}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,16 @@
+import asyncio
+import os
+import tempfile
 import unittest
 from datetime import datetime
 
-from docchatai.app.chat_service import ChatService
-from docchatai.app.config import ChatConfig
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import DeterministicFakeEmbedding, FakeEmbeddings
+from langchain_core.language_models import FakeListChatModel
+from langchain_core.prompts import ChatPromptTemplate
+
+from docchatai.app.chat_service import ChatService, ChatAI, EchoChatService
+from docchatai.app.config import AppConfig, ChatConfig, ChatVar
 from docchatai.app.vectorstores import VectorStoreLoader, \
     VectorStoreLoaderMultiThreaded, VectorStoreLoaderSync
 from test.app.base_test_case import BaseTestCase
@@ -42,6 +50,111 @@ class ChatServiceTestCase(BaseTestCase):
         print(f'{datetime.now().time()} test_create_chat_ai_multi_threaded')
         self._test_create_chat_ai(VectorStoreLoaderMultiThreaded())
 
+    def test_chat_ai_reuses_handler_until_vectorstore_changes(self):
+        print(f'{datetime.now().time()} test_chat_ai_reuses_handler_until_vectorstore_changes')
+        embeddings = FakeEmbeddings(size=8)
+
+        class TestLoader(VectorStoreLoaderSync):
+            vectorstore = FAISS.from_texts(['one'], embeddings)
+            def get(self):
+                return self.vectorstore
+
+        loader = TestLoader()
+        chat_ai = ChatAI(loader, FakeListChatModel(responses=['response']),
+                         ChatPromptTemplate.from_template('{request} {context}'), {'k': 1})
+        handler = chat_ai.get_handler()
+        self.assertIs(handler, chat_ai.get_handler())
+        self.assertEqual('response', chat_ai.invoke('request'))
+
+        loader.vectorstore = FAISS.from_texts(['two'], embeddings)
+        self.assertIsNot(handler, chat_ai.get_handler())
+
+    def test_chat_ai_ainvoke_and_astream(self):
+        print(f'{datetime.now().time()} test_chat_ai_ainvoke_and_astream')
+        embeddings = FakeEmbeddings(size=8)
+
+        class TestLoader(VectorStoreLoaderSync):
+            vectorstore = FAISS.from_texts(['one'], embeddings)
+            def get(self):
+                return self.vectorstore
+
+        chat_ai = ChatAI(TestLoader(), FakeListChatModel(responses=['first', 'second']),
+                         ChatPromptTemplate.from_template('{request} {context}'), {'k': 1})
+
+        async def chat():
+            response = await chat_ai.ainvoke('request')
+            tokens = [token async for token in chat_ai.astream('request')]
+            return response, ''.join(tokens)
+
+        self.assertEqual(('first', 'second'), asyncio.run(chat()))
+
+    def test_echo_chat_service_echoes_requests(self):
+        print(f'{datetime.now().time()} test_echo_chat_service_echoes_requests')
+
+        class TestAppConfig(AppConfig):
+            @property
+            def chat_service(self) -> str:
+                return 'echo'
+
+            @property
+            def echo_chat_seconds(self) -> float:
+                return 0
+
+        chat_service = ChatService.of(TestAppConfig())
+        self.assertIsInstance(chat_service, EchoChatService)
+        chat_ai = chat_service.add_chat_ai('session', self.run_config, False)
+        self.assertTrue(chat_ai.get_loader().is_completed())
+        self.assertEqual('echo', chat_ai.get_model().name)
+        chats = chat_service.chat_request('session', 'Who is the wolf?', self.run_config)
+        self.assertEqual('Who is the wolf?', chats[-1]['response'])
+
+    def test_idle_chat_ai_is_evicted_with_its_vectorstores_when_over_budget(self):
+        print(f'{datetime.now().time()} test_idle_chat_ai_is_evicted_with_its_vectorstores_when_over_budget')
+        with tempfile.TemporaryDirectory() as app_dir:
+            under_budget = self._chat_service_after_switching_files(app_dir, 1024 * 1024 * 1024).get_metrics()
+            # The first chat AI, and its vectorstore, are idle but kept.
+            self.assertEqual(6, under_budget['pooled_resources'])
+            self.assertGreater(under_budget['pooled_bytes'], 0)
+
+            over_budget = self._chat_service_after_switching_files(app_dir, 1).get_metrics()
+            # Only the chat AI in use remains, with its model, embeddings and vectorstore.
+            self.assertEqual(4, over_budget['pooled_resources'])
+            self.assertEqual(0, over_budget['pooled_bytes'])
+            self.assertLess(over_budget['loaded_vectors'], under_budget['loaded_vectors'])
+
+    def _chat_service_after_switching_files(self, app_dir: str, max_pool_bytes: int) -> ChatService:
+
+        class TestAppConfig(AppConfig):
+            @property
+            def app_dir(self) -> str:
+                return app_dir
+
+            @property
+            def max_pool_bytes(self) -> int:
+                return max_pool_bytes
+
+            @property
+            def response_cache_enabled(self) -> bool:
+                return False
+
+        class TestLoader(VectorStoreLoaderSync):
+            def load(self, chat_config: ChatConfig, _) -> VectorStoreLoader:
+                return super().load(chat_config, DeterministicFakeEmbedding(size=8))
+
+        class TestChatService(ChatService):
+            def new_vectorstore_loader(self) -> VectorStoreLoader:
+                return TestLoader()
+
+        app_config = TestAppConfig()
+        chat_service = TestChatService(app_config=app_config)
+        for name in ['first', 'second']:
+            path = os.path.join(app_dir, f'{name}.txt')
+            with open(path, 'w') as file:
+                file.write('\n\n'.join(f'The {name} document, paragraph {i}.' for i in range(20)))
+            # The session's previous chat AI, about the other file, is released.
+            chat_service.add_chat_ai('session', ChatConfig(app_config, {ChatVar.FILE.value: path}))
+        return chat_service
+
     def _test_create_chat_ai(self, vectorstore_loader: VectorStoreLoader):
 
         class TestChatService(ChatService):
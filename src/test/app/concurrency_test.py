@@ -1,8 +1,12 @@
 import asyncio
 import logging.config
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from docchatai.app.concurrency import SingleFlight, WorkerPool
 from test.app.test_functions import get_logging_config
 
 logging.config.dictConfig(get_logging_config())
@@ -67,6 +71,75 @@ class ConcurrencyTestCase(unittest.IsolatedAsyncioTestCase):
         result = asyncio.run(ConcurrencyTestCase.task())
         print(f"{datetime.now()} Result: {result}")
 
+    def test_single_flight_shares_one_call_between_concurrent_callers(self):
+        calls = []
+        started = threading.Event()
+        single_flight = SingleFlight()
+
+        def load():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            return 'loaded'
+
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            leader = executor.submit(single_flight.do, 'key', load)
+            started.wait()
+            followers = [executor.submit(single_flight.do, 'key', load) for _ in range(4)]
+            results = [leader.result()] + [f.result() for f in followers]
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual(['loaded'] * 5, results)
+
+    def test_worker_pool_groups_take_turns(self):
+        order = []
+        started, release = threading.Event(), threading.Event()
+        pool = WorkerPool('test', 1)
+        try:
+            # Occupy the only worker, while tasks are queued.
+            blocker = pool.submit('large', lambda: started.set() or release.wait())
+            started.wait()
+            futures = [pool.submit('large', order.append, f'large-{i}') for i in range(3)]
+            futures.append(pool.submit('small', order.append, 'small-0'))
+            self.assertEqual(4, pool.get_metrics()['queue_depth'])
+
+            release.set()
+            for future in [blocker] + futures:
+                future.result(timeout=5)
+        finally:
+            pool.shutdown(wait=True)
+
+        self.assertEqual(['large-0', 'small-0', 'large-1', 'large-2'], order)
+        metrics = pool.get_metrics()
+        self.assertEqual(0, metrics['queue_depth'])
+        self.assertEqual(5, metrics['completed'])
+        self.assertEqual(1, metrics['workers'])
+
+    def test_worker_pool_runs_tasks_on_spare_workers(self):
+        # Both tasks must run at once, to pass the barrier.
+        barrier = threading.Barrier(2, timeout=5)
+        pool = WorkerPool('test', 2)
+        try:
+            futures = [pool.submit('group', barrier.wait) for _ in range(2)]
+            self.assertEqual({0, 1}, {future.result(timeout=10) for future in futures})
+        finally:
+            pool.shutdown(wait=True)
+        self.assertEqual(2, pool.get_metrics()['workers'])
+
+    def test_worker_pool_cancels_queued_tasks_on_shutdown(self):
+        started, release = threading.Event(), threading.Event()
+        pool = WorkerPool('test', 1)
+        blocker = pool.submit('group', lambda: started.set() or release.wait())
+        started.wait()
+        queued = pool.submit('group', lambda: 1)
+        pool.shutdown(cancel_futures=True)
+        release.set()
+
+        self.assertTrue(blocker.result(timeout=5))
+        self.assertTrue(queued.cancelled())
+        with self.assertRaises(RuntimeError):
+            pool.submit('group', lambda: 1)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,55 @@
+import os.path
+import tempfile
+import unittest
+from datetime import datetime
+
+from docchatai.app.concurrency import Processes
+from docchatai.app.config import AppConfig
+from docchatai.app.doc_loader import DocLoader
+
+
+class TestAppConfig(AppConfig):
+    @property
+    def chunk_size(self) -> int:
+        return 100
+
+    @property
+    def chunk_overlap(self) -> int:
+        return 0
+
+
+class DocLoaderTestCase(unittest.TestCase):
+    def test_yield_pages_yields_every_chunk(self):
+        print(f'{datetime.now().time()} test_yield_pages_yields_every_chunk')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file = os.path.join(temp_dir, 'long-page.txt')
+            with open(file, 'w') as f:
+                f.write(' '.join(['word'] * 500))
+
+            text_splitter = DocLoader.new_text_splitter(TestAppConfig())
+            chunks = list(DocLoader.yield_pages(file, text_splitter))
+
+            self.assertGreater(len(chunks), 1)
+            self.assertEqual(list(range(len(chunks))), [c.metadata['chunk'] for c in chunks])
+            self.assertEqual(0, chunks[0].metadata['page'])
+            self.assertEqual(0, chunks[0].metadata['start_index'])
+            self.assertGreater(chunks[-1].metadata['start_index'], 0)
+
+    def test_yield_pages_in_parallel_matches_sequential(self):
+        print(f'{datetime.now().time()} test_yield_pages_in_parallel_matches_sequential')
+        file = './test/resources/CODE REVIEW BEST PRACTICES.pdf'
+        text_splitter = DocLoader.new_text_splitter(TestAppConfig())
+        sequential = list(DocLoader.yield_pages(file, text_splitter))
+
+        Processes.init(2)
+        try:
+            parallel = list(DocLoader.yield_pages(file, text_splitter, pages_per_task=2))
+        finally:
+            Processes.shutdown(wait=True)
+
+        self.assertEqual([d.page_content for d in sequential], [d.page_content for d in parallel])
+        for key in ['page', 'chunk', 'start_index']:
+            self.assertEqual([d.metadata[key] for d in sequential], [d.metadata[key] for d in parallel])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from langchain_core.embeddings import FakeEmbeddings
+
+from docchatai.app.config import AppConfig
+from docchatai.app.embedding_scheduler import EmbeddingScheduler
+
+
+class TestAppConfig(AppConfig):
+    @property
+    def embedding_batch_size(self) -> int:
+        return 2
+
+    @property
+    def embedding_retry_delay_seconds(self) -> float:
+        return 0.01
+
+
+class FlakyEmbeddings(FakeEmbeddings):
+    failures: int = 1
+    batch_sizes: list[int] = []
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError('Embeddings server is busy')
+        self.batch_sizes.append(len(texts))
+        return super().embed_documents(texts)
+
+
+class EmbeddingSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        EmbeddingScheduler.init(TestAppConfig())
+
+    def tearDown(self):
+        EmbeddingScheduler.init(AppConfig())
+
+    def test_embed_documents_retries_then_embeds_in_fixed_size_batches(self):
+        embeddings = FlakyEmbeddings(size=8, batch_sizes=[])
+        vectors = EmbeddingScheduler.schedule(embeddings).embed_documents(['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(5, len(vectors))
+        self.assertEqual([2, 2, 1], embeddings.batch_sizes)
+
+    def test_embed_documents_raises_after_max_retries(self):
+        embeddings = FlakyEmbeddings(size=8, failures=10, batch_sizes=[])
+        with self.assertRaises(ConnectionError):
+            EmbeddingScheduler.schedule(embeddings).embed_documents(['a'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import os.path
+import tempfile
+import time
+import unittest
+from datetime import datetime
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from docchatai.app.config import AppConfig, ChatConfig
+from docchatai.app.embedding_stores import EmbeddingStores, LruByteStore, SqliteByteStore
+from docchatai.app.vectorstores import VectorStores
+
+
+class SqliteByteStoreTestCase(unittest.TestCase):
+    def test_mset_then_mget(self):
+        print(f'{datetime.now().time()} test_mset_then_mget')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = SqliteByteStore(os.path.join(temp_dir, 'embeddings.sqlite'))
+            store.mset([(f'key-{i}', f'value-{i}'.encode()) for i in range(1200)])
+            keys = ['missing', *[f'key-{i}' for i in range(1200)]]
+            self.assertEqual([None, *[f'value-{i}'.encode() for i in range(1200)]], store.mget(keys))
+            store.mset([('key-0', b'replaced')])
+            self.assertEqual([b'replaced'], store.mget(['key-0']))
+            self.assertEqual(1200, len(store))
+            store.close()
+
+    def test_values_survive_reopening(self):
+        print(f'{datetime.now().time()} test_values_survive_reopening')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_file = os.path.join(temp_dir, 'embeddings.sqlite')
+            store = SqliteByteStore(db_file)
+            store.mset([('a', b'12345'), ('b', b'123')])
+            store.close()
+            store = SqliteByteStore(db_file)
+            self.assertEqual([b'12345', b'123'], store.mget(['a', 'b']))
+            self.assertEqual(8, store.get_size_in_bytes())
+            store.close()
+
+    def test_evicts_least_recently_used_values(self):
+        print(f'{datetime.now().time()} test_evicts_least_recently_used_values')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = SqliteByteStore(os.path.join(temp_dir, 'embeddings.sqlite'), max_bytes=30)
+            for key in ['a', 'b', 'c']:
+                store.mset([(key, b'x' * 10)])
+                time.sleep(0.01)
+            store.mget(['a'])
+            time.sleep(0.01)
+            store.mset([('d', b'x' * 10)])
+            self.assertEqual([b'x' * 10, None, None, b'x' * 10], store.mget(['a', 'b', 'c', 'd']))
+            self.assertEqual(20, store.get_size_in_bytes())
+            store.compact()
+            store.close()
+
+    def test_mdelete_and_yield_keys(self):
+        print(f'{datetime.now().time()} test_mdelete_and_yield_keys')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = SqliteByteStore(os.path.join(temp_dir, 'embeddings.sqlite'))
+            store.mset([('model_a-1', b'1'), ('model_a-2', b'2'), ('model_b-1', b'3')])
+            self.assertEqual(['model_a-1', 'model_a-2'], sorted(store.yield_keys(prefix='model_a')))
+            store.mdelete(['model_a-1'])
+            self.assertEqual(['model_a-2', 'model_b-1'], sorted(store.yield_keys()))
+            self.assertEqual(2, store.get_size_in_bytes())
+            store.close()
+
+
+class LruByteStoreTestCase(unittest.TestCase):
+    def test_reads_missing_values_from_backing_store(self):
+        print(f'{datetime.now().time()} test_reads_missing_values_from_backing_store')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            backing_store = SqliteByteStore(os.path.join(temp_dir, 'embeddings.sqlite'))
+            backing_store.mset([('a', b'1'), ('b', b'2')])
+            store = LruByteStore(1024, backing_store)
+            self.assertEqual([b'1', b'2', None], store.mget(['a', 'b', 'c']))
+            self.assertEqual([b'1', b'2'], store.mget(['a', 'b']))
+            store.mset([('c', b'3')])
+            self.assertEqual([b'3'], backing_store.mget(['c']))
+            metrics = store.get_metrics()
+            self.assertEqual((2, 2, 1), (metrics['hits'], metrics['store_hits'], metrics['misses']))
+            self.assertEqual(3, len(store))
+            store.close()
+
+    def test_evicts_least_recently_used_values_beyond_budget(self):
+        print(f'{datetime.now().time()} test_evicts_least_recently_used_values_beyond_budget')
+        store = LruByteStore(max_bytes=3 * 11)
+        store.mset([(key, b'x' * 10) for key in ['a', 'b', 'c']])
+        store.mget(['a'])
+        store.mset([('d', b'x' * 10)])
+        self.assertEqual([b'x' * 10, None, b'x' * 10, b'x' * 10], store.mget(['a', 'b', 'c', 'd']))
+        self.assertEqual(3 * 11, store.get_size_in_bytes())
+
+    def test_repeated_queries_are_embedded_once(self):
+        print(f'{datetime.now().time()} test_repeated_queries_are_embedded_once')
+        embedded_queries = []
+
+        class CountingEmbeddings(DeterministicFakeEmbedding):
+            def embed_query(self, text: str) -> list[float]:
+                embedded_queries.append(text)
+                return super().embed_query(text)
+
+        class TestAppConfig(AppConfig):
+            def __init__(self, app_dir: str):
+                super().__init__()
+                self.__app_dir = app_dir
+
+            @property
+            def app_dir(self) -> str:
+                return self.__app_dir
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            chat_config = ChatConfig(TestAppConfig(temp_dir))
+            embeddings = CountingEmbeddings(size=8)
+            first = VectorStores.file_backed_embeddings(chat_config, embeddings).embed_query('Who is the wolf?')
+            second = VectorStores.file_backed_embeddings(chat_config, embeddings).embed_query('Who is the wolf?')
+            self.assertEqual(first, second)
+            self.assertEqual(['Who is the wolf?'], embedded_queries)
+            self.assertEqual(1, EmbeddingStores.get_metrics()['queries']['hits'])
+            EmbeddingStores.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
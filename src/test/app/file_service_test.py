@@ -0,0 +1,120 @@
+import hashlib
+import io
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+from werkzeug.datastructures import FileStorage, MultiDict
+
+from docchatai.app.doc_loader import UnsupportedFileTypeError
+from docchatai.app.file_service import FileService, UploadTooLargeError
+
+
+class FileServiceTestCase(unittest.TestCase):
+    def test_identical_uploads_are_stored_once(self):
+        print(f'{datetime.now().time()} test_identical_uploads_are_stored_once')
+        content = b'The same content, uploaded by two sessions.'
+        with tempfile.TemporaryDirectory() as output_dir:
+            file_service = FileService(output_dir, chunk_size=8)
+
+            def upload(session_id: str):
+                file = FileStorage(stream=io.BytesIO(content), filename='Document.TXT')
+                return file_service.save_files(session_id, {'chat_file': file})[0]
+
+            first, second = upload('session-1'), upload('session-2')
+
+            self.assertEqual(hashlib.sha256(content).hexdigest(), first.digest)
+            self.assertEqual(first.digest, second.digest)
+            self.assertNotEqual(first.output_path, second.output_path)
+            self.assertTrue(os.path.samefile(first.output_path, second.output_path))
+            self.assertEqual([f'{first.digest}.txt'], os.listdir(os.path.join(output_dir, 'blobs')))
+            with open(second.output_path, 'rb') as f:
+                self.assertEqual(content, f.read())
+            self.assertEqual([first.output_path], file_service.list_files('session-1'))
+
+    def test_reuploading_a_changed_file_keeps_the_previous_version(self):
+        print(f'{datetime.now().time()} test_reuploading_a_changed_file_keeps_the_previous_version')
+        with tempfile.TemporaryDirectory() as output_dir:
+            file_service = FileService(output_dir)
+
+            def upload(session_id: str, content: bytes):
+                file = FileStorage(stream=io.BytesIO(content), filename='contract.txt')
+                return file_service.save_files(session_id, {'chat_file': file})[0]
+
+            first = upload('session-1', b'version one')
+            other = upload('session-2', b'version one')
+            second = upload('session-1', b'version two')
+
+            self.assertNotEqual(first.output_path, second.output_path)
+            for path, content in [(first.output_path, b'version one'), (other.output_path, b'version one'),
+                                  (second.output_path, b'version two'),
+                                  (os.path.join(output_dir, 'blobs', f'{first.digest}.txt'), b'version one')]:
+                with open(path, 'rb') as f:
+                    self.assertEqual(content, f.read())
+            self.assertFalse(any(name.endswith('.tmp') for name in os.listdir(os.path.join(output_dir, 'session-1'))))
+
+    def test_upload_with_content_not_matching_its_type_is_rejected(self):
+        print(f'{datetime.now().time()} test_upload_with_content_not_matching_its_type_is_rejected')
+        with tempfile.TemporaryDirectory() as output_dir:
+            file_service = FileService(output_dir)
+            file = FileStorage(stream=io.BytesIO(b'Not a PDF'), filename='document.pdf')
+            with self.assertRaises(UnsupportedFileTypeError):
+                file_service.save_files('session', {'chat_file': file})
+            self.assertEqual([], os.listdir(os.path.join(output_dir, 'blobs')))
+
+    def test_upload_type_is_checked_across_short_reads(self):
+        print(f'{datetime.now().time()} test_upload_type_is_checked_across_short_reads')
+
+        class ShortReads(io.BytesIO):
+            # Returns a byte at a time, as a network stream may.
+            def read(self, size: int = -1) -> bytes:
+                return super().read(1)
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            file_service = FileService(output_dir)
+            file = FileStorage(stream=ShortReads(b'%PDF-1.7 and the rest of the document'), filename='document.pdf')
+            saved = file_service.save_files('session', {'chat_file': file})
+            self.assertEqual(1, len(saved))
+            file = FileStorage(stream=ShortReads(b'%PNG and the rest of the image'), filename='image.pdf')
+            with self.assertRaises(UnsupportedFileTypeError):
+                file_service.save_files('session', {'chat_file': file})
+
+    def test_empty_upload_is_rejected(self):
+        print(f'{datetime.now().time()} test_empty_upload_is_rejected')
+        with tempfile.TemporaryDirectory() as output_dir:
+            file_service = FileService(output_dir)
+            file = FileStorage(stream=io.BytesIO(b''), filename='empty.txt')
+            with self.assertRaises(UnsupportedFileTypeError):
+                file_service.save_files('session', {'chat_file': file})
+            self.assertEqual([], file_service.list_files('session'))
+
+    def test_rejected_upload_removes_the_files_saved_by_the_same_request(self):
+        print(f'{datetime.now().time()} test_rejected_upload_removes_the_files_saved_by_the_same_request')
+        with tempfile.TemporaryDirectory() as output_dir:
+            file_service = FileService(output_dir)
+            files = MultiDict([('chat_file', FileStorage(stream=io.BytesIO(b'A text file'), filename='a.txt')),
+                               ('chat_file', FileStorage(stream=io.BytesIO(b'Not a PDF'), filename='b.pdf'))])
+            with self.assertRaises(UnsupportedFileTypeError):
+                file_service.save_files('session', files)
+            self.assertEqual([], file_service.list_files('session'))
+
+    def test_upload_over_the_limit_is_rejected(self):
+        print(f'{datetime.now().time()} test_upload_over_the_limit_is_rejected')
+        with tempfile.TemporaryDirectory() as output_dir:
+            file_service = FileService(output_dir, chunk_size=4, max_file_bytes=10, max_session_bytes=15)
+
+            def upload(content: bytes):
+                file = FileStorage(stream=io.BytesIO(content), filename='document.txt')
+                return file_service.save_files('session', {'chat_file': file})
+
+            with self.assertRaises(UploadTooLargeError):
+                upload(b'More than ten bytes')
+            self.assertEqual(1, len(upload(b'Ten bytes.')))
+            # Only 5 bytes of the session's quota remain.
+            with self.assertRaises(UploadTooLargeError):
+                upload(b'Six b.')
+            self.assertEqual(1, len(file_service.list_files('session')))
+
+if __name__ == '__main__':
+    unittest.main()
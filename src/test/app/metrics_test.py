@@ -0,0 +1,68 @@
+import re
+import unittest
+from datetime import datetime
+
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import FakeEmbeddings
+from langchain_core.language_models import FakeListChatModel
+from langchain_core.prompts import ChatPromptTemplate
+
+from docchatai.app.chat_service import ChatAI
+from docchatai.app.metrics import Metrics
+from docchatai.app.vectorstores import VectorStoreLoaderSync
+
+
+def get_count(text: str, stage: str) -> int:
+    match = re.search(f'docchatai_stage_seconds_count{{stage="{stage}"}} (\\d+)', text)
+    return 0 if match is None else int(match.group(1))
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_spans_are_exposed_as_histograms(self):
+        print(f'{datetime.now().time()} test_spans_are_exposed_as_histograms')
+        before = get_count(Metrics.to_prometheus(), 'test_span')
+        with Metrics.span('test_span'):
+            pass
+        Metrics.observe('test_span', 1000)
+        text = Metrics.to_prometheus()
+        self.assertEqual(before + 2, get_count(text, 'test_span'))
+        self.assertIn('# TYPE docchatai_stage_seconds histogram', text)
+        self.assertRegex(text, f'docchatai_stage_seconds_bucket{{stage="test_span",le="\\+Inf"}} {before + 2}')
+
+    def test_timed_iterator_counts_only_time_spent_producing(self):
+        print(f'{datetime.now().time()} test_timed_iterator_counts_only_time_spent_producing')
+        before = get_count(Metrics.to_prometheus(), 'test_iterator')
+        self.assertEqual([1, 2, 3], list(Metrics.timed('test_iterator', iter([1, 2, 3]))))
+        self.assertEqual(before + 1, get_count(Metrics.to_prometheus(), 'test_iterator'))
+
+    def test_collectors_are_read_when_scraped(self):
+        print(f'{datetime.now().time()} test_collectors_are_read_when_scraped')
+        Metrics.register('test', lambda: Metrics.samples_of(
+            'docchatai_test', {'depth': 3, 'done': 7, 'name': 'ignored'}, {'pool': 'a'}, ('done',)))
+        text = Metrics.to_prometheus()
+        self.assertIn('# TYPE docchatai_test_depth gauge\ndocchatai_test_depth{pool="a"} 3', text)
+        self.assertIn('# TYPE docchatai_test_done_total counter\ndocchatai_test_done_total{pool="a"} 7', text)
+        self.assertNotIn('ignored', text)
+
+    def test_chat_ai_times_retrieval_prompt_and_generation(self):
+        print(f'{datetime.now().time()} test_chat_ai_times_retrieval_prompt_and_generation')
+        embeddings = FakeEmbeddings(size=8)
+
+        class TestLoader(VectorStoreLoaderSync):
+            vectorstore = FAISS.from_texts(['one'], embeddings)
+            def get(self):
+                return self.vectorstore
+
+        chat_ai = ChatAI(TestLoader(), FakeListChatModel(responses=['first', 'second']),
+                         ChatPromptTemplate.from_template('{request} {context}'), {'k': 1})
+        stages = ['retrieve', 'prompt', 'generate', 'first_token']
+        before = {stage: get_count(Metrics.to_prometheus(), stage) for stage in stages}
+        chat_ai.invoke('request')
+        self.assertEqual('second', ''.join(chat_ai.stream('request')))
+        text = Metrics.to_prometheus()
+        self.assertEqual({'retrieve': 2, 'prompt': 2, 'generate': 2, 'first_token': 1},
+                         {stage: get_count(text, stage) - before[stage] for stage in stages})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from docchatai.app.resource_pool import ResourcePool
+
+
+class ResourcePoolTestCase(unittest.TestCase):
+    def test_acquire_shares_resource_per_key(self):
+        pool = ResourcePool()
+        first = pool.acquire('key', lambda: object())
+        second = pool.acquire('key', lambda: object())
+        self.assertIs(first, second)
+        self.assertEqual(2, pool.get_ref_count('key'))
+
+    def test_concurrent_acquires_create_a_resource_once(self):
+        created = []
+        pool = ResourcePool()
+        barrier = threading.Barrier(8)
+
+        def acquire(key: str):
+            barrier.wait()
+            return pool.acquire(key, lambda: created.append(key) or object())
+
+        with ThreadPoolExecutor(8) as executor:
+            for key in [f'key-{i}' for i in range(50)]:
+                values = list(executor.map(acquire, [key] * 8))
+                self.assertEqual(1, len({id(value) for value in values}))
+                self.assertEqual(8, pool.get_ref_count(key))
+        self.assertEqual(50, len(created))
+
+    def test_release_evicts_least_recently_used_idle_resources(self):
+        evicted = []
+        pool = ResourcePool(max_idle_items=1, on_evict=lambda key, _: evicted.append(key))
+        pool.acquire('a', lambda: 'A')
+        pool.acquire('b', lambda: 'B')
+        pool.release('a')
+        self.assertEqual([], evicted)
+        pool.release('b')
+        self.assertEqual(['a'], evicted)
+        self.assertEqual(1, len(pool))
+
+    def test_release_evicts_idle_resources_when_over_budget(self):
+        evicted = []
+        pool = ResourcePool(max_bytes=10, size_of=len, on_evict=lambda key, _: evicted.append(key))
+        pool.acquire('a', lambda: 'x' * 8)
+        pool.acquire('b', lambda: 'x' * 8)
+        pool.release('a')
+        self.assertEqual([], evicted)
+        pool.release('b')
+        self.assertEqual(['a'], evicted)
+
+    def test_only_idle_resources_are_counted(self):
+        pool = ResourcePool(max_bytes=10, size_of=len)
+        pool.acquire('a', lambda: 'x' * 8)
+        pool.release('a')
+        self.assertEqual(8, pool.get_size_in_bytes())
+        pool.acquire('a', lambda: 'x' * 8)
+        self.assertEqual(0, pool.get_size_in_bytes())
+
+    def test_resources_in_use_are_never_evicted(self):
+        evicted = []
+        pool = ResourcePool(max_idle_items=0, on_evict=lambda key, _: evicted.append(key))
+        pool.acquire('a', lambda: 'A')
+        pool.acquire('a', lambda: 'A')
+        pool.release('a')
+        self.assertEqual([], evicted)
+        pool.release('a')
+        self.assertEqual(['a'], evicted)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os.path
+import tempfile
+import time
+import unittest
+
+from langchain_core.embeddings import Embeddings
+
+from docchatai.app.response_cache import ResponseCache
+from test.app.base_test_case import BaseTestCase
+
+
+class TopicEmbeddings(Embeddings):
+    # Requests that mention the same topic, are embedded identically.
+    topics = ['refund', 'delivery', 'warranty']
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return [1.0 if topic in text.lower() else 0.0 for topic in self.topics] + [0.1]
+
+
+class ResponseCacheTestCase(BaseTestCase):
+    def test_get_returns_response_for_normalized_request(self):
+        cache = ResponseCache(None)
+        cache.put('What is the refund policy?', 'Refunds within 30 days')
+        self.assertEqual('Refunds within 30 days', cache.get('  what is the REFUND policy '))
+        self.assertIsNone(cache.get('What is the delivery policy?'))
+
+    def test_get_returns_response_for_similar_request(self):
+        cache = ResponseCache(TopicEmbeddings(), threshold=0.9)
+        cache.put('What is the refund policy?', 'Refunds within 30 days')
+        self.assertEqual('Refunds within 30 days', cache.get('How do refunds work?'))
+        self.assertIsNone(cache.get('How long does delivery take?'))
+        self.assertEqual(1, cache.get_hits())
+        self.assertEqual(1, cache.get_misses())
+
+    def test_get_ignores_expired_responses(self):
+        cache = ResponseCache(None, ttl_seconds=0)
+        cache.put('request', 'response')
+        time.sleep(0.01)
+        self.assertIsNone(cache.get('request'))
+
+    def test_put_evicts_least_recently_used_responses(self):
+        cache = ResponseCache(None, max_entries=2)
+        cache.put('a', 'A')
+        cache.put('b', 'B')
+        cache.get('a')
+        cache.put('c', 'C')
+        self.assertEqual('A', cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+
+    def test_responses_are_reloaded_from_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, 'responses.npz')
+            ResponseCache(TopicEmbeddings(), file_path=file_path).put('refund policy', 'Refunds')
+            for _ in range(100):
+                if os.path.exists(file_path):
+                    break
+                time.sleep(0.05)
+            cache = ResponseCache(TopicEmbeddings(), file_path=file_path)
+            self.assertEqual('Refunds', cache.get('Tell me about refunds'))
+
+if __name__ == '__main__':
+    unittest.main()
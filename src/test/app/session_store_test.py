@@ -0,0 +1,66 @@
+import os.path
+import tempfile
+import time
+import unittest
+
+from docchatai.app.session_store import InMemoryChatHistory, SessionStore, SqliteChatHistory
+
+
+class SessionStoreTestCase(unittest.TestCase):
+    def test_evicts_least_recently_used_sessions(self):
+        evicted = []
+        store = SessionStore(InMemoryChatHistory(), max_sessions=2,
+                             on_evict=lambda session_id, chat_ai, _: evicted.append(chat_ai))
+        store.set_chat_ai('a', 'chat_ai_a', 'config_a')
+        store.set_chat_ai('b', 'chat_ai_b', 'config_b')
+        store.get_chat_ai('a')
+        store.set_chat_ai('c', 'chat_ai_c', 'config_c')
+        self.assertEqual(['chat_ai_b'], evicted)
+        self.assertEqual(2, len(store))
+
+    def test_evicts_expired_sessions(self):
+        evicted = []
+        store = SessionStore(InMemoryChatHistory(), ttl_seconds=0,
+                             on_evict=lambda session_id, chat_ai, _: evicted.append(session_id))
+        store.set_chat_ai('a', 'chat_ai_a', 'config_a')
+        time.sleep(0.01)
+        self.assertIsNone(store.get_chat_ai('a'))
+        self.assertEqual(['a'], evicted)
+
+    def test_set_chat_ai_returns_replaced_chat_config(self):
+        store = SessionStore(InMemoryChatHistory())
+        self.assertIsNone(store.set_chat_ai('a', 'chat_ai_1', 'config_1'))
+        self.assertEqual('config_1', store.set_chat_ai('a', 'chat_ai_2', 'config_2'))
+
+    def test_add_chat_keeps_recent_chats_within_session_budget(self):
+        store = SessionStore(InMemoryChatHistory(), max_session_bytes=10)
+        for i in range(5):
+            chats = store.add_chat('a', {'request': f'{i}', 'response': 'xxxx'}, 100)
+        self.assertEqual(['3', '4'], [chat['request'] for chat in chats])
+        self.assertEqual(10, store.get_size_in_bytes())
+
+    def test_in_memory_chats_are_only_kept_by_their_session(self):
+        chat_history = InMemoryChatHistory()
+        store = SessionStore(chat_history, max_sessions=1, max_session_bytes=1000)
+        for i in range(100):
+            store.add_chat('a', {'request': f'{i:04}', 'response': 'x' * 96}, 100)
+        self.assertEqual([], chat_history.get('a', 100))
+        chats = store.get_chats('a', 100)
+        self.assertEqual(10, len(chats))
+        self.assertEqual('0099', chats[-1]['request'])
+        self.assertEqual(1000, store.get_size_in_bytes())
+        store.add_chat('b', {'request': 'other', 'response': 'answer'}, 100)
+        self.assertEqual([], store.get_chats('a', 100))
+
+    def test_sqlite_chat_history_survives_eviction(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            chat_history = SqliteChatHistory(os.path.join(temp_dir, 'chats.sqlite'))
+            store = SessionStore(chat_history, max_sessions=1)
+            store.add_chat('a', {'request': 'question', 'response': 'answer'}, 100)
+            store.add_chat('b', {'request': 'other', 'response': 'answer'}, 100)
+            self.assertEqual(1, len(store))
+            chats = store.get_chats('a', 100)
+            self.assertEqual([{'request': 'question', 'response': 'answer'}], chats)
+
+if __name__ == '__main__':
+    unittest.main()
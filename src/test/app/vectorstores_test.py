@@ -1,20 +1,55 @@
+import os
+import tempfile
+import threading
+import time
 import unittest
 from datetime import datetime
 
-from langchain_core.embeddings import FakeEmbeddings
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding, FakeEmbeddings
 from langchain_core.vectorstores import VectorStore
 
-from docchatai.app.config import ChatConfig
+from docchatai.app.concurrency import Threads
+from docchatai.app.config import AppConfig, ChatConfig, ChatVar
+from docchatai.app.index_store import IndexStore
 from docchatai.app.vectorstores import VectorStores, VectorStoreLoader, \
-    VectorStoreLoaderMultiThreaded, VectorStoreLoaderSync
+    VectorStoreLoaderMultiThreaded, VectorStoreLoaderSharded, VectorStoreLoaderSync
 from test.app.base_test_case import BaseTestCase
 
 
+class TestAppConfig(AppConfig):
+    # Values not given are those of the app config.
+    def __init__(self, app_dir: str, **values):
+        super().__init__()
+        self.__app_dir = app_dir
+        self.__values = values
+
+    @property
+    def app_dir(self) -> str:
+        return self.__app_dir
+
+    @property
+    def chunk_size(self) -> int:
+        return self.__values.get('chunk_size', super().chunk_size)
+
+    @property
+    def chunk_overlap(self) -> int:
+        return self.__values.get('chunk_overlap', super().chunk_overlap)
+
+    @property
+    def embedding_batch_size(self) -> int:
+        return self.__values.get('embedding_batch_size', super().embedding_batch_size)
+
+    @property
+    def ingestion_queue_size(self) -> int:
+        return self.__values.get('ingestion_queue_size', super().ingestion_queue_size)
+
+
 class VectorStoresTestCase(BaseTestCase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.expected_page_count = 3
-        self.run_config = ChatConfig()
         self.embeddings = FakeEmbeddings(size=128)
 
     def test_vectorstore_loader_sync(self):
@@ -25,8 +60,7 @@ class VectorStoresTestCase(BaseTestCase):
     def test_vectorstore_loader_multi_threaded(self):
         print(f'{datetime.now().time()} test_vectorstore_loader_multi_threaded')
         vectorstore = self._test_vectorstore_loader(VectorStoreLoaderMultiThreaded())
-        # All the pages have not been fully loaded, by the time we get here.
-        self.assertGreater(VectorStores.len(vectorstore), 1)
+        self.assertEqual(self.expected_page_count, VectorStores.len(vectorstore))
 
     def test_vectorstore_loader_get_loaded_pages(self):
         print(f'{datetime.now().time()} test_vectorstore_loader_get_loaded_pages')
@@ -34,8 +68,245 @@ class VectorStoresTestCase(BaseTestCase):
         self._test_vectorstore_loader(loader)
         self.assertEqual(loader.get_total_pages(), loader.get_loaded_pages())
 
+    def test_vectorstore_loader_multi_threaded_get_loaded_pages(self):
+        print(f'{datetime.now().time()} test_vectorstore_loader_multi_threaded_get_loaded_pages')
+        loader = VectorStoreLoaderMultiThreaded()
+        self._test_vectorstore_loader(loader)
+        self.assertEqual(loader.get_total_pages(), loader.get_loaded_pages())
+
+    def test_index_store_save_then_load(self):
+        print(f'{datetime.now().time()} test_index_store_save_then_load')
+        with tempfile.TemporaryDirectory() as store_dir:
+            index_store = IndexStore(store_dir)
+            self.assertIsNone(index_store.load('key', self.embeddings))
+            vectorstore = FAISS.from_texts(['one', 'two', 'three'], self.embeddings)
+            index_store.save('key', vectorstore)
+            loaded = index_store.load('key', self.embeddings)
+            self.assertEqual(VectorStores.len(vectorstore), VectorStores.len(loaded))
+
+    def test_index_store_key_differs_by_model_provider(self):
+        print(f'{datetime.now().time()} test_index_store_key_differs_by_model_provider')
+        values = {ChatVar.FILE.value: 'document.txt', 'chat_file_digest': 'digest', ChatVar.MODEL.value: 'model'}
+        keys = {IndexStore.key(ChatConfig(AppConfig(), {**values, ChatVar.MODEL_PROVIDER.value: provider}))
+                for provider in ['ollama', 'openai']}
+        self.assertEqual(2, len(keys))
+
+    def test_index_store_loads_documents_lazily_by_vector_position(self):
+        print(f'{datetime.now().time()} test_index_store_loads_documents_lazily_by_vector_position')
+        embeddings = DeterministicFakeEmbedding(size=128)
+        texts = ['one', 'two', 'three', 'four']
+        with tempfile.TemporaryDirectory() as store_dir:
+            vectorstore = FAISS.from_texts(texts, embeddings, metadatas=[{'page': i} for i in range(len(texts))])
+            IndexStore(store_dir).save('key', vectorstore)
+            for mmap_docstore in [True, False]:
+                loaded = IndexStore(store_dir, mmap_docstore).load('key', embeddings)
+                self.assertEqual(mmap_docstore, not hasattr(loaded.docstore, '_dict'))
+                for i, text in enumerate(texts):
+                    doc = loaded.similarity_search(text, k=1)[0]
+                    self.assertEqual(text, doc.page_content)
+                    self.assertEqual({'page': i}, doc.metadata)
+
+    def test_revised_document_embeds_only_changed_chunks(self):
+        print(f'{datetime.now().time()} test_revised_document_embeds_only_changed_chunks')
+
+        embedded_texts = []
+
+        class CountingEmbeddings(DeterministicFakeEmbedding):
+            def embed_documents(self, texts: list[str]) -> list[list[float]]:
+                embedded_texts.extend(texts)
+                return super().embed_documents(texts)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            app_config = TestAppConfig(temp_dir, chunk_size=100, chunk_overlap=0)
+            lines = [f'Line {i} of the original document.' for i in range(40)]
+
+            def load(file_name: str) -> VectorStore:
+                chat_file = os.path.join(temp_dir, file_name)
+                with open(chat_file, 'w') as f:
+                    f.write('\n'.join(lines))
+                chat_config = ChatConfig.from_dict(app_config, {ChatVar.FILE.value: chat_file})
+                return VectorStoreLoaderSync().load(chat_config, embeddings).wait_till_completed()
+
+            embeddings = CountingEmbeddings(size=8)
+            original = load('original.txt')
+            embedded_count = len(embedded_texts)
+            self.assertEqual(VectorStores.len(original), embedded_count)
+
+            embedded_texts.clear()
+            lines[-1] = 'Line 39 of the modified document.'
+            revised = load('revised.txt')
+            self.assertEqual(VectorStores.len(original), VectorStores.len(revised))
+            self.assertEqual(1, len(embedded_texts))
+            self.assertIn(lines[-1], embedded_texts[0])
+
+    def test_vectorstore_loader_multi_threaded_streams_pages_within_the_queue_size(self):
+        print(f'{datetime.now().time()} test_vectorstore_loader_multi_threaded_streams_pages_within_the_queue_size')
+        gate = threading.Event()
+        embedded = []
+
+        class GatedEmbeddings(DeterministicFakeEmbedding):
+            # The first page, and batch, are embedded at once, the rest wait for the gate, as if
+            # ingestion fell behind.
+            def embed_documents(self, texts: list[str]) -> list[list[float]]:
+                embedded.append(texts)
+                if len(embedded) > 2:
+                    gate.wait(30)
+                return super().embed_documents(texts)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            chat_config = self._new_chat_config(temp_dir, [f'Line {i} of the document.' for i in range(40)])
+            loader = VectorStoreLoaderMultiThreaded().load(chat_config, GatedEmbeddings(size=8))
+            try:
+                self._wait_for(lambda: loader.get_loaded_pages() >= 3)
+                self.assertFalse(loader.is_completed())
+                self.assertEqual(2, len(loader.get().similarity_search('Line 1 of the document.', k=2)))
+                # The parser waits, with only the batch of two pages being embedded pending.
+                time.sleep(0.2)
+                self.assertLessEqual(loader.get_total_pages() - loader.get_loaded_pages(), 2)
+            finally:
+                gate.set()
+            vectorstore = loader.wait_till_completed()
+
+            self.assertTrue(loader.is_completed())
+            self.assertGreater(loader.get_total_pages(), 10)
+            self.assertEqual(loader.get_total_pages(), VectorStores.len(vectorstore))
+            self.assertTrue(IndexStore.of(chat_config).contains(IndexStore.key(chat_config)))
+
+    def test_vectorstore_loader_multi_threaded_completes_despite_failed_pages(self):
+        print(f'{datetime.now().time()} test_vectorstore_loader_multi_threaded_completes_despite_failed_pages')
+
+        class FailingEmbeddings(DeterministicFakeEmbedding):
+            def embed_documents(self, texts: list[str]) -> list[list[float]]:
+                if any('can not be embedded' in text for text in texts):
+                    raise ValueError('Can not embed')
+                return super().embed_documents(texts)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = [f'Line {i} of the document.' for i in range(40)]
+            lines[7] = 'This line can not be embedded.'
+            chat_config = self._new_chat_config(temp_dir, lines)
+            loader = VectorStoreLoaderMultiThreaded().load(chat_config, FailingEmbeddings(size=8))
+            vectorstore = loader.wait_till_completed()
+
+            self.assertTrue(loader.is_completed())
+            self.assertEqual(2, loader.get_failed_pages())
+            self.assertEqual(loader.get_total_pages(), VectorStores.len(vectorstore) + loader.get_failed_pages())
+            # Incomplete indexes are not saved.
+            self.assertFalse(IndexStore.of(chat_config).contains(IndexStore.key(chat_config)))
+
+    def test_vectorstore_loader_multi_threaded_documents_take_turns_in_the_pools(self):
+        print(f'{datetime.now().time()} test_vectorstore_loader_multi_threaded_documents_take_turns_in_the_pools')
+        gate = threading.Event()
+
+        class GatedEmbeddings(DeterministicFakeEmbedding):
+            # The large document's first page is embedded at once, the rest wait for the gate.
+            def embed_documents(self, texts: list[str]) -> list[list[float]]:
+                if any('large' in text for text in texts) and not any('Line 0 ' in text for text in texts):
+                    gate.wait(30)
+                return super().embed_documents(texts)
+
+        # A single parse, and build, worker for both documents.
+        app_config = AppConfig()
+        Threads.init(app_config.max_worker_threads, {Threads.PARSE: 1, Threads.EMBED: 4, Threads.BUILD: 1})
+        try:
+            with tempfile.TemporaryDirectory() as large_dir, tempfile.TemporaryDirectory() as small_dir:
+                embeddings = GatedEmbeddings(size=8)
+                large_config = self._new_chat_config(large_dir, [f'Line {i} of the large document.' for i in range(40)])
+                small_config = self._new_chat_config(small_dir, [f'Line {i} of the small document.' for i in range(8)])
+                large = VectorStoreLoaderMultiThreaded().load(large_config, embeddings)
+                try:
+                    small = VectorStoreLoaderMultiThreaded().load(small_config, embeddings)
+                    self._wait_for(small.is_completed)
+                    self.assertEqual(small.get_total_pages(), VectorStores.len(small.wait_till_completed()))
+                    self.assertFalse(large.is_completed())
+                finally:
+                    gate.set()
+                large.wait_till_completed()
+                self.assertTrue(large.is_completed())
+        finally:
+            Threads.init(app_config.max_worker_threads, {
+                Threads.PARSE: app_config.parse_worker_threads,
+                Threads.EMBED: app_config.embed_worker_threads,
+                Threads.BUILD: app_config.build_worker_threads,
+            })
+
+    def test_pages_being_added_are_never_found_without_their_documents(self):
+        print(f'{datetime.now().time()} test_pages_being_added_are_never_found_without_their_documents')
+        embeddings = DeterministicFakeEmbedding(size=8)
+        vectorstore = FAISS.from_texts(['one'], embeddings)
+        found = []
+
+        class SearchingIndex:
+            # Searches once the vectors are added to the index, as a concurrent search may.
+            def __init__(self, index):
+                self.index = index
+
+            def __getattr__(self, name: str):
+                return getattr(self.index, name)
+
+            def add(self, vectors):
+                self.index.add(vectors)
+                found.extend(vectorstore.similarity_search('two', k=3))
+
+        vectorstore.index = SearchingIndex(vectorstore.index)
+        pages = [Document(page_content=text) for text in ['two', 'three']]
+        VectorStores.add_embeddings(vectorstore, pages, embeddings.embed_documents(['two', 'three']))
+
+        self.assertEqual({'one', 'two', 'three'}, {doc.page_content for doc in found})
+        self.assertEqual(3, VectorStores.len(vectorstore))
+
+    def test_sharded_vectorstore_merges_results_by_score(self):
+        print(f'{datetime.now().time()} test_sharded_vectorstore_merges_results_by_score')
+        embeddings = DeterministicFakeEmbedding(size=16)
+
+        class ShardLoader(VectorStoreLoaderSync):
+            def __init__(self, texts: [str]):
+                super().__init__()
+                self.vectorstore = FAISS.from_texts(texts, embeddings)
+
+            def get(self):
+                return self.vectorstore
+
+            def wait_till_completed(self):
+                return self.vectorstore
+
+        loader = VectorStoreLoaderSharded([ShardLoader(['one', 'two']), ShardLoader(['three', 'four'])])
+        vectorstore = loader.wait_till_completed()
+        self.assertIs(vectorstore, loader.get())
+
+        results = vectorstore.similarity_search_with_score('three', k=3)
+        self.assertEqual(3, len(results))
+        self.assertEqual('three', results[0][0].page_content)
+        self.assertEqual(sorted(score for _, score in results), [score for _, score in results])
+        retrieved = vectorstore.as_retriever(search_kwargs={'k': 1}).invoke('two')
+        self.assertEqual(['two'], [doc.page_content for doc in retrieved])
+
+    @staticmethod
+    def _new_chat_config(app_dir: str, lines: [str]) -> ChatConfig:
+        # Two lines per page, two pages per batch, and at most one batch pending.
+        app_config = TestAppConfig(app_dir, chunk_size=60, chunk_overlap=0,
+                                   embedding_batch_size=2, ingestion_queue_size=1)
+        chat_file = os.path.join(app_dir, 'document.txt')
+        with open(chat_file, 'w') as f:
+            f.write('\n'.join(lines))
+        return ChatConfig.from_dict(app_config, {ChatVar.FILE.value: chat_file})
+
+    def _wait_for(self, condition, timeout_seconds: float = 10):
+        deadline = time.monotonic() + timeout_seconds
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail(f'Timed out after {timeout_seconds} seconds')
+            time.sleep(0.01)
+
     def _test_vectorstore_loader(self, loader: VectorStoreLoader) -> VectorStore:
-        vectorstore = loader.load(self.run_config, self.embeddings).wait_till_completed()
+        # Each test has an app dir of its own, so that the vectorstore is built, not loaded from the index cache.
+        with tempfile.TemporaryDirectory() as app_dir:
+            run_config = ChatConfig(TestAppConfig(app_dir))
+            index_store, key = IndexStore.of(run_config), IndexStore.key(run_config)
+            self.assertFalse(index_store.contains(key))
+            vectorstore = loader.load(run_config, self.embeddings).wait_till_completed()
+            # Saved once built.
+            self.assertTrue(index_store.contains(key))
         print(f'{datetime.now().time()} DONE loading pages, len: {VectorStores.len(vectorstore)}')
         return vectorstore
 
@@ -0,0 +1,86 @@
+import io
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models import FakeListChatModel
+from werkzeug.datastructures import FileStorage, MultiDict
+
+from docchatai.app.chat_service import ChatService
+from docchatai.app.config import AppConfig, ChatVar
+from docchatai.app.file_service import FileService
+from docchatai.app.vectorstores import VectorStoreLoader, VectorStoreLoaderSync
+from docchatai.app.web_data import WebData, WebVar, ValidationError
+from docchatai.app.web_service import WebService
+from test.app.base_test_case import BaseTestCase
+
+class WebServiceTestCase(BaseTestCase):
+    def test_chat_ai_is_recreated_from_the_session_files_after_the_session_is_evicted(self):
+        print(f'{datetime.now().time()} test_chat_ai_is_recreated_from_the_session_files_after_the_session_is_evicted')
+        with tempfile.TemporaryDirectory() as app_dir:
+            web_service, chat_service = self._web_service(app_dir)
+            session = self._upload(web_service, {}, ['first.txt', 'second.txt'])
+            self.assertEqual(['first.txt', 'second.txt'],
+                             [f['original_filename'] for f in session[WebVar.CHAT_FILES.value]])
+            # Another session's upload evicts the first session.
+            self._upload(web_service, {}, ['other.txt'])
+            self.assertIsNone(chat_service.get_chat_ai(session[WebVar.SESSION_ID.value]))
+
+            web_data = WebData.collect_form(MultiDict({ChatVar.REQUEST.value: 'Who is first?'}), MultiDict(), session)
+            response_data = web_service.chat_request(web_data)
+
+            self.assertEqual('response', response_data[WebVar.CHATS.value][-1]['response'])
+            chat_ai = chat_service.get_chat_ai(session[WebVar.SESSION_ID.value])
+            # Both of the session's files are chatted about again.
+            self.assertEqual(2, len(chat_ai.get_loader().get_loaders()))
+
+    def test_chat_request_without_an_uploaded_file_is_rejected(self):
+        print(f'{datetime.now().time()} test_chat_request_without_an_uploaded_file_is_rejected')
+        # Without a CHAT_FILE, to default to.
+        environ = {k: v for k, v in os.environ.items() if k != 'CHAT_FILE'}
+        with tempfile.TemporaryDirectory() as app_dir, mock.patch.dict(os.environ, environ, clear=True):
+            web_data = WebData.collect_form(MultiDict({ChatVar.REQUEST.value: 'Who is first?'}), MultiDict(), {})
+            with self.assertRaises(ValidationError):
+                self._web_service(app_dir)[0].chat_request(web_data)
+
+    @staticmethod
+    def _web_service(app_dir: str) -> (WebService, ChatService):
+
+        class TestAppConfig(AppConfig):
+            @property
+            def app_dir(self) -> str:
+                return app_dir
+
+            @property
+            def max_sessions(self) -> int:
+                return 1
+
+        class TestChatService(ChatService):
+            @staticmethod
+            def model(name: str, provider: str):
+                return FakeListChatModel(responses=['response'])
+
+            @staticmethod
+            def embeddings(name: str, provider: str):
+                return DeterministicFakeEmbedding(size=8)
+
+            def new_vectorstore_loader(self) -> VectorStoreLoader:
+                return VectorStoreLoaderSync()
+
+        app_config = TestAppConfig()
+        chat_service = TestChatService(app_config=app_config)
+        return WebService(app_config, chat_service, FileService(app_config.uploads_dir)), chat_service
+
+    @staticmethod
+    def _upload(web_service: WebService, session: dict[str, any], filenames: [str]) -> dict[str, any]:
+        files = MultiDict([(ChatVar.FILE.value, FileStorage(stream=io.BytesIO(f'The {name} document.'.encode()),
+                                                             filename=name)) for name in filenames])
+        web_data = WebData.collect_form(MultiDict(), MultiDict(), session)
+        WebData.update_session(web_service.chat_file_upload(web_data, files), session)
+        return session
+
+if __name__ == '__main__':
+    unittest.main()
@@ -23,6 +23,25 @@ class MainWebTestCase(BaseTestCase):
         response = self.client.get("/")
         self.assertEqual(response.status_code, 200)
 
+    def test_metrics(self):
+        self.client.get("/")
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('docchatai_request_seconds_count{endpoint="/"}', response.text)
+        self.assertIn('docchatai_stage_seconds_count{stage="render"}', response.text)
+        self.assertIn('docchatai_chat_sessions ', response.text)
+
+    def test_streamed_request_is_timed_till_its_last_byte(self):
+        response = self.client.get("/chat/request/stream", query_string={ChatVar.REQUEST.value: "Who is the wolf?"})
+        self.assertEqual(response.status_code, 200)
+        # Not timed, till the stream has been read.
+        metrics = self.client.get("/metrics").text
+        self.assertNotIn('docchatai_request_seconds_count{endpoint="/chat/request/stream"}', metrics)
+        response.get_data()
+        response.close()
+        metrics = self.client.get("/metrics").text
+        self.assertIn('docchatai_request_seconds_count{endpoint="/chat/request/stream"} 1', metrics)
+
     @unittest.skip("Takes too long, because it takes a while to create the chat ai.")
     def test_chat_file_upload(self):
         file = "./test/resources/LITTLE RED RIDING HOOD.pdf"